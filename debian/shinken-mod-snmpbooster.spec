@@ -29,7 +29,6 @@ without any SNMP plugin.
 %install
 rm -rf %{buildroot}/*
 
-rm module/tools/dump_redis.py
 install -d %{buildroot}/usr/share/pyshared/shinken/modules/
 
 %{__python} setup.py install -O1 --skip-build --root %{buildroot} --install-lib=%{python_sitelib}
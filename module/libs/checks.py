@@ -40,17 +40,32 @@ except ImportError as exp:
 
 from snmpworker import callback_mapping_next, callback_mapping_bulk
 from snmpworker import callback_get
+from metrics import Counter, Histogram
+from oidresult import OidResult
 
 
 __all__ = ("check_cache", "check_snmp")
 
 
-def check_cache(check, arguments, db_client):
-    """ Get data from database """
+DB_LATENCY = Histogram("snmpbooster_db_seconds",
+                       "Database request time",
+                       ("operation", ))
+MAPPING_WALKS = Counter("snmpbooster_mapping_walks",
+                        "SNMP walks of mapping tables",
+                        ("result", ))
+
+
+def check_cache(check, arguments, db_client, trace=None):
+    """ Get data from database
+    trace is the Trace of the check if it is sampled
+    """
     start_time = time.time()
     # Get current service
-    current_service = db_client.get_service(arguments.get('host'),
-                                            arguments.get('service'))
+    with DB_LATENCY.labels("get_service").time():
+        current_service = db_client.get_service(arguments.get('host'),
+                                                arguments.get('service'))
+    if trace is not None:
+        trace.add_span("check_cache", start_time)
     # Check if the service is in the database
     if current_service is None:
         error_message = ("[SnmpBooster] [code 0202] [%s, %s] Not found in "
@@ -66,6 +81,7 @@ def check_cache(check, arguments, db_client):
                        'output': "Service not found in the database",
                        'db_data': None,
                        'execution_time': time.time() - start_time,
+                       'trace': trace,
                        }
         setattr(check, "result", dict_result)
         return None
@@ -78,6 +94,7 @@ def check_cache(check, arguments, db_client):
                    'state': 'received',
                    'output': None,
                    'db_data': current_service,
+                   'trace': trace,
                    }
     setattr(check, "result", dict_result)
     # Save execution time
@@ -86,10 +103,17 @@ def check_cache(check, arguments, db_client):
     return current_service
 
 
-def check_snmp(check, arguments, db_client, task_queue, result_queue):
-    """ Prepare snmp requests """
+def check_snmp(check, arguments, db_client, task_queue, result_queue,
+               trace=None):
+    """ Prepare snmp requests
+    trace is the Trace of the check if it is sampled
+
+    Return
+    :nb_requests: int, number of get requests (None if the service
+    is not found)
+    """
     # Get current service
-    current_service = check_cache(check, arguments, db_client)
+    current_service = check_cache(check, arguments, db_client, trace)
 
     if current_service is None:
         return None
@@ -98,8 +122,11 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
     check_interval = current_service.get('check_interval')
 
     # Get all services with this host and check_interval
-    services = db_client.get_services(arguments.get('host'),
-                                      current_service.get('check_interval'))
+    stage_start = time.time()
+    services = get_services(db_client, arguments, check_interval)
+    if trace is not None:
+        stage_start = trace.add_span("get_services", stage_start,
+                                     services=len(services or []))
     # Mapping needed ?
     # Get all services which need mapping
     mappings = [serv for serv in services
@@ -135,6 +162,9 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
             mapping_task = {}
             # Add address
             mapping_task['host'] = snmp_info.address
+            # Add trace
+            mapping_task['trace'] = trace
+            mapping_task['queued_time'] = time.time()
             # Get concurrency
             mapping_task['no_concurrency'] = serv.get('no_concurrency', False)
             mapping_task['data'] = {"authData": cmdgen.CommunityData(communityIndex=snmp_info.community,
@@ -174,6 +204,7 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
             # Wait mapping completed or timeout (100 * 0.1 second)
             counter += 1
             time.sleep(0.1)
+        MAPPING_WALKS.labels("done" if result['finished'] else "timeout").inc()
 
         # Todo: What if there is the same iname for 2 serv => override one, not good
         map_inst_serv = dict([(serv['instance_name'], serv['service']) for serv in mappings])
@@ -184,11 +215,14 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
                 # Don't save instances which are not mapped
                 continue
             service = map_inst_serv[instance_name]
-            db_client.update_service(arguments.get('host'), service, {"instance": instance})
+            with DB_LATENCY.labels("update_service").time():
+                db_client.update_service(arguments.get('host'), service, {"instance": instance})
         # refresh all services list
         # NOTE Is this refresh mandatory ????
-        services = db_client.get_services(arguments.get('host'),
-                                          current_service.get('check_interval'))
+        services = get_services(db_client, arguments, check_interval)
+        if trace is not None:
+            stage_start = trace.add_span("mapping", stage_start,
+                                         finished=result['finished'])
         # MAPPING DONE
 
     # Prepare oids
@@ -198,6 +232,15 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
     fnc = partial(prepare_oids,
                   group_size=serv.get('request_group_size', 64))
     splitted_oids_list = reduce(fnc, services, [{}, ])
+    if trace is not None:
+        trace.add_span("prepare_oids", stage_start,
+                       requests=len(splitted_oids_list))
+
+    # The check is finished when the SNMP callback gets all values
+    # It must be set before the SNMP worker gets the tasks
+    check.result['state'] = 'sent'
+    # Get tasks of the check (the SNMP worker sets their dispatch time)
+    check.result['tasks'] = []
 
     # Prepare get task
     for oids in splitted_oids_list:
@@ -220,6 +263,14 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
         get_task['no_concurrency'] = arguments.get('no_concurrency', False)
         # Add address
         get_task['host'] = arguments.get('address')
+        # Get tasks with the same key can be merged by the SNMP worker
+        get_task['snmp_key'] = (arguments.get('address'),
+                                arguments.get('port'),
+                                arguments.get('community'),
+                                arguments.get('version'))
+        # Add trace
+        get_task['trace'] = trace
+        get_task['queued_time'] = time.time()
         # Put all oid in the same list
         oids_list = {}
         # Merge oids lists in one list
@@ -229,10 +280,26 @@ def check_snmp(check, arguments, db_client, task_queue, result_queue):
                                       (oids_list,
                                        check.result,
                                        result_queue))
+        check.result['tasks'].append(get_task)
         task_queue.put(get_task, block=False)
 
     # NOTE Is it useful ?
     del services
+    # Number of get requests (used to compute the check deadline)
+    return len(splitted_oids_list)
+
+
+def get_services(db_client, arguments, check_interval):
+    """ Get all services of the host with the check_interval and with
+    the intervals the Scheduler aligned with it (-I option), so their
+    OIDs are in the same SNMP requests
+    """
+    services = []
+    for interval in [check_interval] + arguments.get('with_intervals', []):
+        with DB_LATENCY.labels("get_services").time():
+            services.extend(db_client.get_services(arguments.get('host'),
+                                                   interval) or [])
+    return services
 
 
 def prepare_oids(ret, service, group_size=64):
@@ -260,7 +327,7 @@ def prepare_oids(ret, service, group_size=64):
                 if oid in tmp_dict:
                     # If we have already added the oid
                     # We only add the ds_name
-                    tmp_dict[oid]['key']['ds_names'].append(ds_name)
+                    tmp_dict[oid].ds_names += (ds_name, )
                 else:
                     # Check if we have a ds_max and get the oid
                     ds_max_oid = None
@@ -271,32 +338,15 @@ def prepare_oids(ret, service, group_size=64):
                     if ds_data.get('ds_min_oid'):
                         ds_min_oid = ds_data.get('ds_min_oid') % service
                     # This is a new oid, we add it to the result list
-                    # The key is use to retreive the service in database
-                    tmp_dict[oid] = {'key': {'host': service['host'],
-                                             'service': service['service'],
-                                             'ds_names': [ds_name],
-                                             'oid_type': oid_type,
-                                             },
-                                     # ds_type == "DERIVE", "GAUGE",
-                                     # "TEXT", "DERIVE64", ...
-                                     'type': ds_data['ds_type'],
-                                     # We will put the collected value here
-                                     'value': None,
-                                     # We put the last collected value here
-                                     'value_last': ds_data.get(oid_type + "_value"),
-                                     # We put the last computed (derive and
-                                     # calculation) value here
-                                     'value_last_computed': ds_data.get(oid_type + "_value_computed"),
-                                     # We will put the timestamp when data arrive
-                                     'check_time': None,
-                                     # We put the last check time huere
-                                     'check_time_last': service.get('check_time'),
-                                     # We put the calculation here (to make
-                                     # calculation before database saving)
-                                     'calc': ds_data['ds_calc'],
-                                     # Get max oid
-                                     'ds_max_oid': ds_max_oid,
-                                     # Get min oid
-                                     'ds_min_oid': ds_min_oid,
-                                     }
+                    tmp_dict[oid] = OidResult(service['host'],
+                                              service['service'],
+                                              ds_name,
+                                              oid_type,
+                                              ds_data['ds_type'],
+                                              ds_data.get(oid_type + "_value"),
+                                              ds_data.get(oid_type + "_value_computed"),
+                                              service.get('check_time'),
+                                              ds_data['ds_calc'],
+                                              ds_max_oid,
+                                              ds_min_oid)
     return ret
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains functions to read the datasource files (genDevConfig
+ini files) and to store/load the merged datasource in a compiled cache file
+"""
+
+
+import os
+import glob
+import hashlib
+import cPickle
+
+from shinken.log import logger
+
+try:
+    from configobj import ConfigObj
+except ImportError, exp:
+    logger.error("[SnmpBooster] [code 0901] Import error. Maybe one of this "
+                 "module is missing: ConfigObj")
+    raise ImportError(exp)
+
+
+__all__ = ("read_datasource", "load_datasource", "compile_datasource",
+           "verify_datasource_cache")
+
+
+# Name of the compiled cache file when the datasource is a folder
+CACHE_FILENAME = ".snmpbooster_datasource.cache"
+# Bump it when the compiled cache format changes
+CACHE_VERSION = 1
+
+
+def get_datasource_files(datasource_path):
+    """ Return the list of ini files which compose the datasource """
+    # if file
+    if os.path.isfile(datasource_path):
+        return [datasource_path]
+    # if directory
+    elif os.path.isdir(datasource_path):
+        return glob.glob(os.path.join(datasource_path, 'Default*.ini'))
+    # Normal error with scheduler and poller module
+    # The configuration will be read in the database
+    raise IOError("[SnmpBooster] File or folder not "
+                  "found: %s" % datasource_path)
+
+
+def get_cache_path(datasource_path):
+    """ Return the path of the compiled cache file
+
+    >>> get_cache_path("/etc/shinken/genconfig/Default.ini")
+    '/etc/shinken/genconfig/Default.ini.cache'
+    """
+    if os.path.isdir(datasource_path):
+        return os.path.join(datasource_path, CACHE_FILENAME)
+    return datasource_path + ".cache"
+
+
+def get_fingerprint(files, with_hash=False):
+    """ Return a list of (path, mtime, size, md5) used to know if
+    the datasource files changed since the cache compilation.
+    md5 is only computed if with_hash is True
+    """
+    fingerprint = []
+    for filename in sorted(files):
+        stat = os.stat(filename)
+        md5 = None
+        if with_hash:
+            with open(filename, 'rb') as file_handler:
+                md5 = hashlib.md5(file_handler.read()).hexdigest()
+        fingerprint.append((os.path.abspath(filename),
+                            stat.st_mtime,
+                            stat.st_size,
+                            md5))
+    return fingerprint
+
+
+def read_datasource(datasource_path):
+    """ Read and merge all datasource files and return them as a dict """
+    datasource = None
+    current_file = None
+    try:
+        for current_file in get_datasource_files(datasource_path):
+            if datasource is None:
+                datasource = ConfigObj(current_file,
+                                       interpolation='template')
+            else:
+                ctemp = ConfigObj(current_file,
+                                  interpolation='template')
+                datasource.merge(ctemp)
+            if current_file == datasource_path:
+                logger.info("[SnmpBooster] [code 0902] Reading input "
+                            "configuration file: "
+                            "%s" % current_file)
+            else:
+                logger.info("[SnmpBooster] [code 0903] Reading "
+                            "input configuration file: "
+                            "%s" % current_file)
+    # raise if reading error
+    except Exception as exp:
+        if current_file is not None:
+            error_message = ("[SnmpBooster] [code 0904] Datasource "
+                             "error while reading or merging in %s: "
+                             "`%s'" % (str(current_file), str(exp)))
+        else:
+            error_message = ("[SnmpBooster] [code 0905] Datasource "
+                             "error while reading or merging: "
+                             "`%s'" % str(exp))
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    if datasource is None:
+        error_message = ("[SnmpBooster] [code 0905] Datasource "
+                         "error while reading or merging: "
+                         "`No datasource file found in %s'" % datasource_path)
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    # Convert datasource to dict
+    try:
+        return datasource.dict()
+    except Exception as exp:
+        error_message = ("[SnmpBooster] [code 0906] Error during the "
+                         "config conversion: %s" % (str(exp)))
+        logger.error(error_message)
+        raise Exception(error_message)
+
+
+def read_compiled_datasource(cache_path, header_only=False):
+    """ Read the compiled cache file
+
+    Return
+    * header: dict
+    * datasource: dict (None if header_only is True)
+    """
+    with open(cache_path, 'rb') as cache_file:
+        # The header is a separated pickle, so we can check it
+        # without loading the whole datasource
+        header = cPickle.load(cache_file)
+        if header_only:
+            return header, None
+        return header, cPickle.load(cache_file)
+
+
+def write_compiled_datasource(cache_path, fingerprint, datasource):
+    """ Write the compiled cache file
+    We write a temporary file and rename it, so a reader never sees
+    a partial cache file
+    """
+    header = {'version': CACHE_VERSION,
+              'files': fingerprint,
+              }
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, 'wb') as cache_file:
+        cPickle.dump(header, cache_file, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump(datasource, cache_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, cache_path)
+
+
+def is_fresh(header, fingerprint, check_hash=False):
+    """ Compare a cache header with the current files fingerprint """
+    if header.get('version') != CACHE_VERSION:
+        return False
+    cached = header.get('files', [])
+    if len(cached) != len(fingerprint):
+        return False
+    for (path, mtime, size, md5), (c_path, c_mtime, c_size, c_md5) in zip(fingerprint, cached):
+        if path != c_path or size != c_size:
+            return False
+        if check_hash:
+            # The content is the same, the mtime doesn't matter
+            if md5 != c_md5:
+                return False
+        elif mtime != c_mtime:
+            return False
+    return True
+
+
+def compile_datasource(datasource_path):
+    """ Read the datasource files and write the compiled cache file
+
+    Return
+    * datasource: dict
+    """
+    # Get the fingerprint before reading, so a file modified
+    # during the reading makes the cache stale
+    try:
+        fingerprint = get_fingerprint(get_datasource_files(datasource_path),
+                                      with_hash=True)
+    except (IOError, OSError):
+        # read_datasource will log and raise the right error
+        fingerprint = None
+    datasource = read_datasource(datasource_path)
+    if fingerprint is None:
+        return datasource
+    cache_path = get_cache_path(datasource_path)
+    try:
+        write_compiled_datasource(cache_path, fingerprint, datasource)
+    except Exception as exp:
+        # Not fatal, we just need to read ini files at the next start
+        logger.warning("[SnmpBooster] [code 1501] Can not write the "
+                       "compiled datasource %s: %s" % (cache_path, str(exp)))
+    else:
+        logger.info("[SnmpBooster] [code 1502] Compiled datasource "
+                    "written in %s" % cache_path)
+    return datasource
+
+
+def load_datasource(datasource_path, use_cache=True):
+    """ Return the datasource as a dict
+    The compiled cache is used if no datasource file changed
+    (mtime and size), else the ini files are read and the cache is
+    compiled again
+    """
+    if not use_cache or not datasource_path:
+        # Without path, there is no cache and read_datasource reports
+        # the error
+        return read_datasource(datasource_path)
+
+    cache_path = get_cache_path(datasource_path)
+    if os.path.isfile(cache_path):
+        try:
+            fingerprint = get_fingerprint(get_datasource_files(datasource_path))
+            header, _ = read_compiled_datasource(cache_path, header_only=True)
+            if is_fresh(header, fingerprint):
+                _, datasource = read_compiled_datasource(cache_path)
+                logger.info("[SnmpBooster] [code 1503] Reading compiled "
+                            "datasource: %s" % cache_path)
+                return datasource
+            logger.info("[SnmpBooster] [code 1504] Compiled datasource %s "
+                        "is outdated" % cache_path)
+        except Exception as exp:
+            logger.warning("[SnmpBooster] [code 1505] Can not read the "
+                           "compiled datasource %s: %s" % (cache_path,
+                                                           str(exp)))
+
+    return compile_datasource(datasource_path)
+
+
+def verify_datasource_cache(datasource_path):
+    """ Check if the compiled cache exists and matches the datasource files
+    (content hash and merged data)
+
+    Return
+    * valid: bool
+    * message: str
+    """
+    cache_path = get_cache_path(datasource_path)
+    if not os.path.isfile(cache_path):
+        return False, "Compiled datasource %s not found" % cache_path
+    try:
+        header, datasource = read_compiled_datasource(cache_path)
+    except Exception as exp:
+        return False, "Compiled datasource %s is unreadable: %s" % (cache_path,
+                                                                     str(exp))
+    fingerprint = get_fingerprint(get_datasource_files(datasource_path),
+                                  with_hash=True)
+    if not is_fresh(header, fingerprint, check_hash=True):
+        return False, ("Compiled datasource %s doesn't match the datasource "
+                       "files" % cache_path)
+    if datasource != read_datasource(datasource_path):
+        return False, ("Compiled datasource %s content differs from the "
+                       "datasource files" % cache_path)
+    return True, "Compiled datasource %s is up to date" % cache_path
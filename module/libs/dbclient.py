@@ -23,10 +23,12 @@
 """ This module contains database/cache abstraction class """
 
 
+import time
+
 from shinken.log import logger
 
 try:
-    from pymongo import MongoClient
+    from pymongo import MongoClient, ASCENDING, UpdateOne
 except ImportError as exp:
     logger.error("[SnmpBooster] [code 1201] Import error. Pymongo seems missing.")
     raise ImportError(exp)
@@ -34,63 +36,88 @@ except ImportError as exp:
 from utils import flatten_dict
 
 
+# Fields not needed to prepare SNMP requests
+# Triggers are only needed to compute the output of a check
+GET_SERVICES_PROJECTION = {"_id": False,
+                           "triggers": False,
+                           }
+
+
 class DBClient(object):
     """ Class used to abstract the use of the database/cache """
 
-    def __init__(self, db_host, db_port, db_name):
+    def __init__(self, db_host, db_port=27017, db_name="booster_snmp",
+                 unix_socket=None, pool_size=None, socket_timeout=None,
+                 connect_timeout=None, **kwargs):
         self.db_host = db_host
         self.db_port = db_port
         self.db_name = db_name
+        self.unix_socket = unix_socket
+        self.pool_size = pool_size
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
 
         self.db_conn = None
 
+    @property
+    def services(self):
+        """ Services collection """
+        return getattr(self.db_conn, self.db_name).services
+
     def connect(self):
-        """ This function inits the connection to the database """
+        """ This function inits the connection to the database
+        and creates indexes used by queries
+        """
+        kwargs = {}
+        if self.pool_size:
+            kwargs['maxPoolSize'] = self.pool_size
+        if self.socket_timeout:
+            kwargs['socketTimeoutMS'] = int(self.socket_timeout * 1000)
+        if self.connect_timeout:
+            kwargs['connectTimeoutMS'] = int(self.connect_timeout * 1000)
         try:
-            self.db_conn = MongoClient(self.db_host, self.db_port)
+            if self.unix_socket:
+                self.db_conn = MongoClient(self.unix_socket, **kwargs)
+            else:
+                self.db_conn = MongoClient(self.db_host, self.db_port, **kwargs)
+            self.create_indexes()
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1202] Mongodb Connection error:"
                          " %s" % str(exp))
             return False
         return True
 
+    def create_indexes(self):
+        """ Create indexes used by queries
+        It does nothing if they already exist
+        """
+        # get_service, update_service
+        self.services.create_index([("host", ASCENDING),
+                                    ("service", ASCENDING)],
+                                   unique=True)
+        # get_services
+        self.services.create_index([("host", ASCENDING),
+                                    ("check_interval", ASCENDING)])
+        # delete_old_services
+        self.services.create_index([("check_time", ASCENDING)])
+
     def disconnect(self):
         """ This function kills the connection to the database """
         #self.db_conn.disconnect()
         pass
 
-    @staticmethod
-    def handle_error(result, context=""):
-        """ This function handles mongodb errors """
-        # NOTE make a decorator of it ...
-        # If error
-        if result['err'] is not None:
-            # Prepare error context
-            context_str = ""
-            if context and isinstance(context, dict):
-                # NOTE: warning what append with unicode ?
-                context_str = ",".join(["%s:%s" % (key, val)
-                                        for key, val in context.items()])
-                context_str = "[" + context_str + "]"
-            elif context and isinstance(context, str):
-                context_str = context
-            elif context:
-                context_str = str(context_str)
-            # Prepare error message
-            error_message = ("[SnmpBooster] [code 1203] %s error putting "
-                             "data in cache: %s" % (context_str,
-                                                    str(result['err'])))
-            logger.error(error_message)
-            return True
-        return False
-
     def update_service_init(self, host, service, data):
-            self.update_service(host, service, data)
+        """ Insert a service from the Arbiter
+        Collected values of an existing service are kept
+        """
+        return self.update_service(host, service, data)
 
-    def update_service(self, host, service, data):
+    def update_service(self, host, service, data, force=False):
         """ This function updates/inserts a service
         It used by arbiter in hook_late_configuration
         to put the configuration in the database
+        The 'force' is used to overwrite the service datas (used in
+        cache manager)
         Return
         * query_result: None
         * error: bool
@@ -98,14 +125,15 @@ class DBClient(object):
         # Prepare mongo Filter
         mongo_filter = {"host": host,
                         "service": service}
-        # Flatten dict serv
-        data = flatten_dict(data)
         # Save in mongo
         try:
-            mongo_res = getattr(self.db_conn,
-                                self.db_name).services.update(mongo_filter,
-                                                              {"$set": data},
-                                                              upsert=True)
+            if force:
+                self.services.replace_one(mongo_filter, data, upsert=True)
+            else:
+                # Flatten dict serv
+                self.services.update_one(mongo_filter,
+                                         {"$set": flatten_dict(data)},
+                                         upsert=True)
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1204] [%s, %s] "
                          "%s" % (host,
@@ -113,7 +141,32 @@ class DBClient(object):
                                  str(exp)))
             return (None, True)
 
-        return (None, self.handle_error(mongo_res, mongo_filter))
+        return (None, False)
+
+    def update_services(self, service_list):
+        """ This function updates several services with one bulk write
+        It used by Poller to save results of SNMP requests
+        :service_list: list of (host, service, data)
+        Return
+        * query_result: None
+        * error: bool
+        """
+        if not service_list:
+            return (None, False)
+        requests = [UpdateOne({"host": host, "service": service},
+                              {"$set": flatten_dict(data)},
+                              upsert=True)
+                    for host, service, data in service_list]
+        try:
+            # Ordered, so several updates of a service are done in order
+            self.services.bulk_write(requests)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1203] Error putting %d "
+                         "service(s) in database: %s" % (len(requests),
+                                                         str(exp)))
+            return (None, True)
+
+        return (None, False)
 
     def update_service_instance(self, host, instance_name, instance):
         """ This function update a instance from SNMP mapping requests
@@ -128,10 +181,7 @@ class DBClient(object):
         data = {"$set": {"instance": instance}}
         # Save in mongo
         try:
-            mongo_res = getattr(self.db_conn,
-                                self.db_name).services.update(mongo_filter,
-                                                              data,
-                                                              )
+            self.services.update_many(mongo_filter, data)
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1206] [%s, %s] "
                          "%s" % (host,
@@ -139,7 +189,7 @@ class DBClient(object):
                                  str(exp)))
             return (None, True)
 
-        return (None, self.handle_error(mongo_res, mongo_filter))
+        return (None, False)
 
     def get_service(self, host, service):
         """ This function gets one service from the database
@@ -151,9 +201,7 @@ class DBClient(object):
                         "service": service}
         # Get service
         try:
-            service = getattr(self.db_conn,
-                              self.db_name).services.find_one(mongo_filter,
-                                                              {"_id": False})
+            service = self.services.find_one(mongo_filter, {"_id": False})
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1207] [%s, %s] "
                          "%s" % (host,
@@ -174,8 +222,9 @@ class DBClient(object):
                         "check_interval": check_interval}
         # Get services
         try:
-            services = getattr(self.db_conn,
-                               self.db_name).services.find(mongo_filter)
+            services = self.services.find(mongo_filter,
+                                          GET_SERVICES_PROJECTION)
+            return [s for s in services]
 
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1208] [%s] "
@@ -183,4 +232,56 @@ class DBClient(object):
                                  str(exp)))
             return None
 
-        return [s for s in services]
+    # Cache manager queries
+    def show_keys(self):
+        """ Get all services as host:service """
+        return ["%s:%s" % (serv['host'], serv['service'])
+                for serv in self.services.find({}, {"_id": False,
+                                                    "host": True,
+                                                    "service": True})]
+
+    def get_hosts_from_service(self, service):
+        """ List hosts with a service which match with the pattern """
+        return list(self.services.find({"service": {"$regex": service}},
+                                       {"_id": False}))
+
+    def get_services_from_host(self, host):
+        """ List all services from hosts which match the pattern """
+        return list(self.services.find({"host": {"$regex": host}},
+                                       {"_id": False}))
+
+    def clear_cache(self):
+        """ Clear all datas in database """
+        self.services.drop()
+        self.create_indexes()
+
+    def get_all_services(self):
+        """ List all services """
+        return list(self.services.find({}, {"_id": False}))
+
+    def delete_services(self, key_list):
+        """ Delete services which match keys in key_list """
+        if not key_list:
+            return 0
+        return self.services.delete_many({"$or": [{"host": host,
+                                                   "service": service}
+                                                  for host, service in key_list]
+                                          }).deleted_count
+
+    def delete_old_services(self, max_age, pending=False):
+        """ Delete services not checked since max_age seconds
+        If pending is True, services never checked are deleted too
+        """
+        mongo_filter = {"check_time": {"$lt": time.time() - max_age}}
+        if pending:
+            mongo_filter = {"$or": [mongo_filter, {"check_time": None}]}
+        return self.services.delete_many(mongo_filter).deleted_count
+
+    def delete_host(self, host):
+        """ Delete all services in the specified host """
+        return self.services.delete_many({"host": host}).deleted_count
+
+    def rebuild_indexes(self):
+        """ Create indexes and return the number of services """
+        self.create_indexes()
+        return self.services.count()
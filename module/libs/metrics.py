@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains counters, gauges and histograms of SNMP Booster
+internals, and a HTTP server which exposes them in the OpenMetrics text
+format (readable by Prometheus)
+
+Metrics are plain Python objects updated in place: the cost in the
+checks path is a lock and an addition. Gauges which can be read when
+needed (queue sizes, ...) are functions called by the HTTP server.
+"""
+
+
+import time
+import socket
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from shinken.log import logger
+
+
+__all__ = ("Counter", "Gauge", "Histogram", "REGISTRY",
+           "register_route", "start_metrics_server")
+
+
+# Default histogram buckets (in seconds)
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10)
+# Number of ports tried when the metrics port is already used
+# Each Poller worker process needs its own port
+PORT_RANGE = 16
+CONTENT_TYPE = ("application/openmetrics-text; version=1.0.0; "
+                "charset=utf-8")
+# Other pages of the HTTP server (traces, ...)
+# path => function(query) which returns (content_type, body)
+ROUTES = {}
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    """ Format labels of a sample
+
+    >>> format_labels(("device",), ("10.0.0.1",), ("le", "0.5"))
+    '{device="10.0.0.1",le="0.5"}'
+    """
+    labels = zip(labelnames, labelvalues)
+    if extra is not None:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name,
+                                           str(value).replace("\\", "\\\\")
+                                                     .replace('"', '\\"')
+                                                     .replace("\n", "\\n"))
+                              for name, value in labels])
+
+
+def format_value(value):
+    """ Format a sample value """
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Registry(object):
+    """ All metrics of the process """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """ Add a metric """
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Return all metrics in the OpenMetrics text format """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.extend(metric.samples())
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    """ Base class of metrics
+    A metric with labels has one child (a metric without label) by
+    label values
+    """
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=(), registry=REGISTRY,
+                 _labelvalues=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.labelvalues = _labelvalues
+        self.lock = threading.Lock()
+        self.children = {}
+        self.init()
+        if registry is not None:
+            registry.register(self)
+
+    def init(self):
+        """ Init values of a metric without labels """
+        pass
+
+    def labels(self, *labelvalues):
+        """ Get the child of label values """
+        child = self.children.get(labelvalues)
+        if child is None:
+            with self.lock:
+                child = self.children.get(labelvalues)
+                if child is None:
+                    child = self.__class__(self.name, self.help,
+                                           registry=None,
+                                           _labelvalues=labelvalues,
+                                           **self.child_kwargs())
+                    child.labelnames = self.labelnames
+                    self.children[labelvalues] = child
+        return child
+
+    def child_kwargs(self):
+        """ Arguments of children """
+        return {}
+
+    def samples(self):
+        """ Lines of the metric """
+        if not self.labelnames:
+            return self.own_samples()
+        lines = []
+        for _, child in sorted(self.children.items()):
+            lines.extend(child.own_samples())
+        return lines
+
+    def own_samples(self):
+        """ Lines of a metric without labels """
+        return []
+
+
+class Counter(Metric):
+    """ Value which only goes up """
+    kind = "counter"
+
+    def init(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """ Increment the counter """
+        with self.lock:
+            self.value += amount
+
+    def own_samples(self):
+        return ["%s_total%s %s" % (self.name,
+                                   format_labels(self.labelnames,
+                                                 self.labelvalues),
+                                   format_value(self.value))]
+
+
+class Gauge(Metric):
+    """ Value which goes up and down
+    The value can be read from a function, when the HTTP server
+    renders metrics
+    """
+    kind = "gauge"
+
+    def init(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        """ Set the gauge """
+        self.value = value
+
+    def inc(self, amount=1):
+        """ Increment the gauge """
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        """ Decrement the gauge """
+        with self.lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """ Read the value from the function """
+        self.function = function
+
+    def own_samples(self):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                return []
+        return ["%s%s %s" % (self.name,
+                             format_labels(self.labelnames, self.labelvalues),
+                             format_value(value))]
+
+
+class Histogram(Metric):
+    """ Distribution of values (durations, ...) """
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), registry=REGISTRY,
+                 buckets=DEFAULT_BUCKETS, _labelvalues=()):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"), )
+        Metric.__init__(self, name, help_text, labelnames, registry,
+                        _labelvalues)
+
+    def init(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+
+    def child_kwargs(self):
+        return {"buckets": self.buckets[:-1]}
+
+    def observe(self, value):
+        """ Add a value """
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """ Context manager which observes its duration """
+        return Timer(self)
+
+    def own_samples(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (self.name,
+                                             format_labels(self.labelnames,
+                                                           self.labelvalues,
+                                                           ("le", format_value(bound))),
+                                             cumulative))
+        labels = format_labels(self.labelnames, self.labelvalues)
+        lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        lines.append("%s_sum%s %s" % (self.name, labels, format_value(self.sum)))
+        return lines
+
+
+class Timer(object):
+    """ Observe the duration of a with block """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.time() - self.start)
+        return False
+
+
+def register_route(path, function):
+    """ Serve an other page on the metrics HTTP server
+    function gets the query string as a dict and returns
+    (content_type, body)
+    """
+    ROUTES[path] = function
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serve metrics on /metrics, and pages of ROUTES """
+    registry = REGISTRY
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path in ("/", "/metrics"):
+            content_type, body = CONTENT_TYPE, self.registry.render()
+        elif url.path in ROUTES:
+            query = dict([(name, values[-1]) for name, values
+                          in urlparse.parse_qs(url.query).items()])
+            try:
+                content_type, body = ROUTES[url.path](query)
+            except Exception as exp:
+                self.send_error(500, str(exp))
+                return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # Don't log each scrape
+        pass
+
+
+def start_metrics_server(address, port, handler=MetricsHandler):
+    """ Start the HTTP server in a daemon thread
+    If the port is already used (by an other Poller worker), the next
+    ports are tried
+
+    Return
+    :port: int (None if no port is free)
+    """
+    for current_port in xrange(port, port + PORT_RANGE):
+        try:
+            server = HTTPServer((address, current_port), handler)
+        except socket.error:
+            continue
+        thread = threading.Thread(target=server.serve_forever,
+                                  name="snmpbooster-metrics")
+        thread.daemon = True
+        thread.start()
+        logger.info("[SnmpBooster] [code 1801] Metrics available on "
+                    "http://%s:%d/metrics" % (address, current_port))
+        return current_port
+    logger.error("[SnmpBooster] [code 1802] Can not start the metrics "
+                 "server: ports %d to %d are used" % (port,
+                                                      port + PORT_RANGE - 1))
+    return None
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the OidResult class, the record of one OID
+of a real check: created by prepare_oids, filled by the SNMP callbacks
+and saved by the Poller
+"""
+
+
+__all__ = ("OidResult", )
+
+
+class OidResult(object):
+    """ One OID asked to a device
+
+    >>> result = OidResult("myhost1", "if.lo", "ifOutErrors", "ds_oid",
+    ...                    "GAUGE", calc=["value", "%(ds_max)s", "div"])
+    >>> result.ds_max = 100
+    >>> [elt % result for elt in result.calc]
+    ['value', '100', 'div']
+    """
+    __slots__ = ("host", "service", "ds_names", "oid_type", "type",
+                 "value", "value_last", "value_last_computed",
+                 "check_time", "check_time_last", "calc",
+                 "ds_max_oid", "ds_min_oid", "ds_max", "ds_min", "error")
+
+    def __init__(self, host, service, ds_name, oid_type, oid_data_type,
+                 value_last=None, value_last_computed=None,
+                 check_time_last=None, calc=None,
+                 ds_max_oid=None, ds_min_oid=None):
+        # The key is use to retreive the service in database
+        self.host = host
+        self.service = service
+        # Datasources which use this OID
+        self.ds_names = (ds_name, )
+        self.oid_type = oid_type
+        # ds_type == "DERIVE", "GAUGE", "TEXT", "DERIVE64", ...
+        self.type = oid_data_type
+        # We will put the collected value here
+        self.value = None
+        # The last collected value
+        self.value_last = value_last
+        # The last computed (derive and calculation) value
+        self.value_last_computed = value_last_computed
+        # We will put the timestamp when data arrive
+        self.check_time = None
+        self.check_time_last = check_time_last
+        # The calculation (made before database saving)
+        self.calc = calc
+        # OIDs of ds_max and ds_min, and their values (set by the Poller)
+        self.ds_max_oid = ds_max_oid
+        self.ds_min_oid = ds_min_oid
+        self.ds_max = None
+        self.ds_min = None
+        # SNMP error
+        self.error = None
+
+    def __getitem__(self, name):
+        """ Fields by name, for calculations: "%(ds_max)s" % result """
+        return getattr(self, name)
+
+    def __repr__(self):
+        return "<OidResult %s, %s, %s: %r>" % (self.host, self.service,
+                                               ",".join(self.ds_names),
+                                               self.value)
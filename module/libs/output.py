@@ -22,83 +22,109 @@
 
 """ This module contains a set of functions to format the plugin output which
 is shown on the UI
+
+The output of a service is rendered by a renderer compiled once by
+dstemplate: the constant parts (names, units, separators) are prepared,
+and each check only formats values and joins the strings
 """
 
 
-def get_output(service):
-    """ Prepare service output """
-    outputs = []
-    perfdatas = []
-    for ds_name, _ in service['ds'].items():
-        output, perfdata = format_output(service, ds_name)
-        if output != "":
-            outputs.append(output)
-        if perfdata != "":
-            perfdatas.append(perfdata)
-    #Old code block, not sure why he didn't just use a map....
-    #output = " # ".join(outputs)
-    output = ""
-    perfdata = " ".join(perfdatas)
-    for element in outputs:
-        output = output + formatElement(element)
-    output = output[:-2]
-    if perfdata == '':
-        return output
-    else:
-        return output + " | " + perfdata
+__all__ = ("get_output", "get_renderer", "OutputRenderer")
 
-def formatElement(element):
-    a,b = element.split(":")
-    if(b is None or b == ""):
-        return str(a) + " = " + "ERROR " + "(" + str(b) + "), "
-    else:
-        return str(a) + " = " + "OK " + "(" + str(b) + "), "
-
-
-def format_output(service, ds_name):
-    """ Format value for derive type """
-    ds_data = service['ds'][ds_name]
-
-    # Check if we have an error
-    if ds_data.get('error') is not None:
-        output = ds_data.get('error')
-        return output, ''
-
-    # Here get computed_value
-    value = ds_data.get('ds_oid_value_computed')
-    if value is None:
-        # No data
-        output = "%s: No Data found" % ds_name
-        return output, ''
-
-    # Prepare dict to write output and perfdata
-    format_dict = prepare_format(value, service['ds'][ds_name])
-
-    output = "%(ds_name)s: %(value)s%(ds_unit)s" % format_dict
-    perfdata = ("%(ds_name)s=%(value)s%(ds_unit)s;;;"
-                "%(ds_min_oid_value_computed)s;"
-                "%(ds_max_oid_value_computed)s" % format_dict)
-    return output, perfdata
-
-
-def prepare_format(value, ds_data):
-    """ Prepare a dict to put in string formatting """
-    format_dict = {}
-    # Prepare value
-    if isinstance(value, float):
-        format_dict['value'] = "%0.2f" % value
-    elif value is None:
-        format_dict['value'] = "No data"
+
+# Compiled renderers
+# (dstemplate, template key or datasources signature) => OutputRenderer
+RENDERERS = {}
+# Maximum number of compiled renderers
+MAX_RENDERERS = 1024
+
+
+class OutputRenderer(object):
+    """ Output and perfdata of all datasources of a dstemplate
+
+    Each datasource gets formats with slots for its value, min and max:
+
+    ``name = OK (<value>unit)`` or ``name = ERROR (<error>)``
+
+    ``name=<value>unit;;;<min>;<max>``
+    """
+
+    def __init__(self, ds_dict):
+        self.slots = []
+        for ds_name, ds_data in ds_dict.items():
+            # Names and units are constants of the formats
+            name = ds_data.get('ds_name', ds_name).replace("%", "%%")
+            unit = ds_data.get('ds_unit', "").replace("%", "%%")
+            self.slots.append((ds_name,
+                               name + " = OK (%s" + unit + ")",
+                               name + " = ERROR (%s)",
+                               name + "=%s" + unit + ";;;%s;%s",
+                               ))
+
+    def render(self, ds_dict):
+        """ Render the output and the perfdata of the service """
+        outputs = []
+        perfdatas = []
+        for ds_name, ok_format, error_format, perf_format in self.slots:
+            ds_data = ds_dict[ds_name]
+            # Check if we have an error
+            error = ds_data.get('error')
+            if error is not None:
+                outputs.append(error_format % (error, ))
+                continue
+            # Here get computed_value
+            value = ds_data.get('ds_oid_value_computed')
+            if value is None:
+                outputs.append(error_format % ("No Data found", ))
+                continue
+            value = "%0.2f" % value if isinstance(value, float) else str(value)
+            if value == "":
+                outputs.append(error_format % ("", ))
+            else:
+                outputs.append(ok_format % (value, ))
+            ds_min = ds_data.get('ds_min_oid_value_computed')
+            ds_max = ds_data.get('ds_max_oid_value_computed')
+            perfdatas.append(perf_format % (value,
+                                            "%0.2f" % ds_min
+                                            if isinstance(ds_min, float) else "",
+                                            "%0.2f" % ds_max
+                                            if isinstance(ds_max, float) else ""))
+        if not perfdatas:
+            return ", ".join(outputs)
+        return ", ".join(outputs) + " | " + " ".join(perfdatas)
+
+
+def get_renderer(service):
+    """ Get the compiled renderer of the service dstemplate
+    The template key of the datasources (md5 of their definitions, set
+    by the Redis backend) is in the key, so a new datasource file with
+    the same dstemplate name gets a new renderer. Without template
+    key, the signature of the datasources (names and units) is used
+    """
+    ds_dict = service['ds']
+    if service.get('ds_template') is not None:
+        key = (service.get('dstemplate'), service['ds_template'])
     else:
-        format_dict['value'] = str(value)
-    # Prepare data name
-    format_dict['ds_name'] = ds_data['ds_name']
-    # Prepare data unit
-    format_dict['ds_unit'] = ds_data.get('ds_unit', "")
-    # Prepare data max and min
-    for min_max in ['ds_min_oid_value_computed', 'ds_max_oid_value_computed']:
-        if min_max in ds_data and isinstance(ds_data[min_max], float):
-            format_dict[min_max] = "%0.2f" % float(ds_data[min_max])
-        else:
-            format_dict[min_max] = ""
-    return format_dict
+        key = (service.get('dstemplate'),
+               tuple([(ds_name, ds_data.get('ds_name'), ds_data.get('ds_unit'))
+                      for ds_name, ds_data in ds_dict.iteritems()]))
+    renderer = RENDERERS.get(key)
+    if renderer is None:
+        if len(RENDERERS) >= MAX_RENDERERS:
+            RENDERERS.clear()
+        renderer = RENDERERS[key] = OutputRenderer(ds_dict)
+    return renderer
+
+
+def get_output(service):
+    """ Prepare service output
+
+    >>> get_output({'dstemplate': 'test',
+    ...             'ds': {'ifInOctets': {'ds_name': 'in',
+    ...                                   'ds_unit': 'B/s',
+    ...                                   'ds_oid_value_computed': 12.5,
+    ...                                   'ds_max_oid_value_computed': 100.0},
+    ...                    }})
+    'in = OK (12.50B/s) | in=12.50B/s;;;;100.00'
+    """
+    return get_renderer(service).render(service['ds'])
@@ -24,42 +24,153 @@
 
 
 import re
+import time
+import hashlib
 
 from collections import OrderedDict
 
 from shinken.log import logger
 
 try:
-    from redis import StrictRedis
+    from redis import StrictRedis, ConnectionPool, UnixDomainSocketConnection
+    from redis.exceptions import ConnectionError as RedisConnectionError
+    from redis.exceptions import TimeoutError as RedisTimeoutError
 except ImportError as exp:
     logger.error("[SnmpBooster] [code 1301] Import error. "
                  "Python Redis seems missing.")
     raise ImportError(exp)
 
-from utils import merge_dicts
+from utils import merge_dicts, get_collected_values
+
+
+# Prefix of the keys which are not host:service or host:interval keys
+META_PREFIX = "snmpbooster"
+# Secondary indexes, updated when the Arbiter writes a service
+# Set of all hosts
+INDEX_HOSTS = META_PREFIX + ":index:hosts"
+# Set of all service names
+INDEX_SERVICES = META_PREFIX + ":index:services"
+# Set of services of a host
+INDEX_HOST = META_PREFIX + ":index:host:%s"
+# Set of hosts having a service
+INDEX_SERVICE = META_PREFIX + ":index:service:%s"
+# Set of check intervals of a host (host:interval keys)
+INDEX_INTERVALS = META_PREFIX + ":index:intervals:%s"
+# Sorted set of host:service, scored by the last check_time
+# Updated by the poller at each write
+INDEX_CHECK_TIME = META_PREFIX + ":index:check_time"
+# Number of keys read in one request by admin queries
+BATCH_SIZE = 500
+# Connection errors which open the circuit breaker
+CONNECTION_ERRORS = (RedisConnectionError, RedisTimeoutError)
+# Delays (in seconds) before a new try when Redis is unreachable
+# The delay is doubled at each failure
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+# Connection pools shared by clients of the same process
+# connection parameters => ConnectionPool
+CONNECTION_POOLS = {}
 
 
 class DBClient(object):
-    """ Class used to abstract the use of the database/cache """
-
-    def __init__(self, db_host, db_port=6379, db_name=None):
+    """ Class used to abstract the use of the database/cache
+
+    Datasource definitions and triggers are the same for all services
+    using the same dstemplate and triggergroup. They are stored once in
+    template keys (snmpbooster:template:<kind>:<md5>), and the service
+    key only contains a reference to them and the collected values.
+    The template content never changes for a key, so templates read
+    are cached in the process without invalidation. Templates are
+    written at each service update (SET NX), so they come back after a
+    flush of the database. Templates without service are deleted by
+    'sbcm clear templates'.
+
+    When Redis is unreachable, the circuit breaker opens: checks fail
+    fast without waiting for the socket timeout, until the next try.
+    The delay between tries grows from BACKOFF_MIN to BACKOFF_MAX.
+    """
+
+    def __init__(self, db_host, db_port=6379, db_name=None,
+                 unix_socket=None, pool_size=None, socket_timeout=None,
+                 connect_timeout=None, keepalive=False):
         self.db_host = db_host
         self.db_port = db_port
+        self.unix_socket = unix_socket
+        self.pool_size = pool_size
+        self.socket_timeout = socket_timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive = keepalive
         self.db_conn = None
+        # template key => template
+        self.templates = {}
+        # Circuit breaker
+        self.failures = 0
+        self.retry_at = 0
+
+    def get_pool(self):
+        """ Get the connection pool shared by all clients of the process
+        which use the same connection parameters
+        """
+        pool_key = (self.db_host, self.db_port, self.unix_socket,
+                    self.pool_size, self.socket_timeout,
+                    self.connect_timeout, self.keepalive)
+        if pool_key not in CONNECTION_POOLS:
+            kwargs = {'socket_timeout': self.socket_timeout}
+            if self.pool_size:
+                kwargs['max_connections'] = self.pool_size
+            if self.unix_socket:
+                # Pollers on the Redis server can skip the TCP stack
+                kwargs['connection_class'] = UnixDomainSocketConnection
+                kwargs['path'] = self.unix_socket
+            else:
+                kwargs['host'] = self.db_host
+                kwargs['port'] = self.db_port
+                kwargs['socket_connect_timeout'] = self.connect_timeout
+                kwargs['socket_keepalive'] = self.keepalive
+            CONNECTION_POOLS[pool_key] = ConnectionPool(**kwargs)
+        return CONNECTION_POOLS[pool_key]
 
     def connect(self):
         """ This function inits the connection to the database """
         try:
-            self.db_conn = StrictRedis(host=self.db_host, port=self.db_port)
+            self.db_conn = StrictRedis(connection_pool=self.get_pool())
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1302] Redis Connection error:"
                          " %s" % str(exp))
             return False
+        # Check the server now, but don't die if it's down:
+        # the circuit breaker will try again later
+        try:
+            self.db_conn.ping()
+        except CONNECTION_ERRORS as exp:
+            logger.error("[SnmpBooster] [code 1302] Redis Connection error:"
+                         " %s" % str(exp))
+            self.connection_failed()
         return True
 
     def disconnect(self):
         """ This function kills the connection to the database """
-        pass
+        self.templates = {}
+
+    def is_available(self):
+        """ Return False while the circuit breaker is open """
+        return self.failures == 0 or time.time() >= self.retry_at
+
+    def connection_failed(self):
+        """ Open the circuit breaker for a longer delay at each failure """
+        self.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** (self.failures - 1))
+        self.retry_at = time.time() + delay
+        logger.warning("[SnmpBooster] [code 1311] Redis is unreachable "
+                       "(%d failure(s)), next try in %ds" % (self.failures,
+                                                            delay))
+
+    def connection_succeeded(self):
+        """ Close the circuit breaker """
+        if self.failures > 0:
+            logger.info("[SnmpBooster] [code 1312] Redis is reachable "
+                        "again after %d failure(s)" % self.failures)
+            self.failures = 0
 
     @staticmethod
     def build_key(part1, part2):
@@ -70,6 +181,81 @@ class DBClient(object):
         """
         return ":".join((str(part1), str(part2)))
 
+    @staticmethod
+    def is_meta_key(key):
+        """ Is it a template key (or any other non service key) ? """
+        return key.startswith(META_PREFIX + ":")
+
+    def store_template(self, kind, template):
+        """ Store a template (datasources or triggers) if it is not
+        already in Redis and return its key
+        """
+        template_repr = repr(template)
+        key = ":".join((META_PREFIX, "template", kind,
+                        hashlib.md5(template_repr).hexdigest()))
+        # The key content never changes, so we don't overwrite it
+        # It is written each time: the database can be flushed while
+        # the process runs
+        self.db_conn.set(key, template_repr, nx=True)
+        self.templates[key] = template
+        return key
+
+    def get_template(self, key):
+        """ Get a template from the process cache or from Redis """
+        template = self.templates.get(key)
+        if template is None:
+            data = self.db_conn.get(key)
+            if data is None:
+                return None
+            template = eval(data)
+            self.templates[key] = template
+        return template
+
+    def expand_service(self, data):
+        """ Add datasources definitions and triggers from templates
+        to the service data read in Redis
+        """
+        if data is None or 'ds_template' not in data:
+            # Service stored before the use of templates
+            return data
+        ds_template = self.get_template(data['ds_template'])
+        triggers = self.get_template(data['triggers_template'])
+        if ds_template is None or triggers is None:
+            logger.error("[SnmpBooster] [code 1310] [%s, %s] "
+                         "Template %s or %s is missing. Please restart "
+                         "the Arbiter" % (data.get('host'),
+                                          data.get('service'),
+                                          data['ds_template'],
+                                          data['triggers_template']))
+            return None
+        collected = data['ds']
+        data['ds'] = OrderedDict()
+        for ds_name, ds_data in ds_template.items():
+            ds_data = ds_data.copy()
+            ds_data.update(collected.get(ds_name, {}))
+            data['ds'][ds_name] = ds_data
+        # Triggers are only read, we can share them
+        data['triggers'] = triggers
+        return data
+
+    def strip_service(self, data):
+        """ Remove datasources definitions and triggers, which are in
+        templates, from an expanded service
+        """
+        if 'ds_template' not in data:
+            return data
+        ds_template = self.get_template(data['ds_template'])
+        if ds_template is None:
+            return data
+        data = data.copy()
+        data.pop('triggers', None)
+        data['ds'] = dict([(ds_name,
+                            dict([(name, value)
+                                  for name, value in data['ds'].get(ds_name, {}).items()
+                                  if name not in ds_data or ds_data[name] != value]))
+                           for ds_name, ds_data in ds_template.items()])
+        return data
+
     def update_service_init(self, host, service, data):
         """ Insert/Update/Upsert service information in Redis by Arbiter """
         # We need to generate key for redis :
@@ -77,16 +263,47 @@ class DBClient(object):
         # check interval to a service list
         key_ci = self.build_key(host, data["check_interval"])
         # Add service in host:interval list
+        # and in secondary indexes
         try:
-            self.db_conn.sadd(key_ci, service)
+            pipe = self.db_conn.pipeline(transaction=False)
+            pipe.sadd(key_ci, service)
+            pipe.sadd(INDEX_HOSTS, host)
+            pipe.sadd(INDEX_SERVICES, service)
+            pipe.sadd(INDEX_HOST % host, service)
+            pipe.sadd(INDEX_SERVICE % service, host)
+            pipe.sadd(INDEX_INTERVALS % host, data["check_interval"])
+            pipe.execute()
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1303] [%s, %s] "
                          "%s" % (host,
                                  service,
                                  str(exp)))
             return (None, True)
+
+        # Move datasources definitions and triggers in templates
+        data = data.copy()
+        ds_template = data.pop('ds', {})
+        triggers = data.pop('triggers', {})
+        try:
+            data['ds_template'] = self.store_template('ds', ds_template)
+            data['triggers_template'] = self.store_template('triggers',
+                                                            triggers)
+            old_dict = self.db_conn.get(self.build_key(host, service))
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1309] [%s, %s] "
+                         "%s" % (host,
+                                 service,
+                                 str(exp)))
+            return (None, True)
+        old_dict = eval(old_dict) if old_dict is not None else {}
+        # We don't want to lose values collected by the pollers
+        # But the new configuration wins over the old one
+        data['ds'] = get_collected_values(old_dict.get('ds', {}), ds_template)
+        # Remove triggers saved before the use of templates
+        old_dict.pop('triggers', None)
+        old_dict.update(data)
         # Then update propely host:service key
-        self.update_service(host, service, data)
+        return self.update_service(host, service, old_dict, force=True)
 
     def update_service(self, host, service, data, force=False):
         """ This function updates/inserts a service
@@ -101,28 +318,98 @@ class DBClient(object):
         * error: bool
         """
 
+        # Fail fast if Redis is unreachable
+        if not self.is_available():
+            return (None, True)
         # Get key
         key = self.build_key(host, service)
         if not force:
-            old_dict = self.db_conn.get(key)
+            try:
+                old_dict = self.db_conn.get(key)
+            except CONNECTION_ERRORS as exp:
+                logger.error("[SnmpBooster] [code 1304] [%s, %s] "
+                             "%s" % (host,
+                                     service,
+                                     str(exp)))
+                self.connection_failed()
+                return (None, True)
             if old_dict is not None:
                 old_dict = eval(old_dict)
             # Merge old data and new data
             data = merge_dicts(old_dict, data)
+        elif data is not None:
+            # Don't save templates data in the service key
+            data = self.strip_service(data)
 
         if data is None:
             return (None, True)
 
         # Save in redis
         try:
-            self.db_conn.set(key, data)
+            pipe = self.db_conn.pipeline(transaction=False)
+            pipe.set(key, repr(data))
+            # Keep the age index up to date
+            if data.get('check_time') is not None:
+                pipe.zadd(INDEX_CHECK_TIME, {key: data['check_time']})
+            pipe.execute()
         except Exception as exp:
             logger.error("[SnmpBooster] [code 1304] [%s, %s] "
                          "%s" % (host,
                                  service,
                                  str(exp)))
+            if isinstance(exp, CONNECTION_ERRORS):
+                self.connection_failed()
             return (None, True)
 
+        self.connection_succeeded()
+        return (None, False)
+
+    def update_services(self, service_list):
+        """ This function updates several services with one MGET and
+        one pipelined write
+        It used by Poller to save results of SNMP requests
+        :service_list: list of (host, service, data)
+
+        Return
+        * query_result: None
+        * error: bool
+        """
+        if not service_list:
+            return (None, False)
+        # Fail fast if Redis is unreachable
+        if not self.is_available():
+            return (None, True)
+        # Several updates of the same service are merged
+        keys = []
+        updates = {}
+        for host, service, data in service_list:
+            key = self.build_key(host, service)
+            if key not in updates:
+                keys.append(key)
+                updates[key] = []
+            updates[key].append(data)
+
+        try:
+            pipe = self.db_conn.pipeline(transaction=False)
+            for key, old_dict in zip(keys, self.db_conn.mget(keys)):
+                data = eval(old_dict) if old_dict is not None else None
+                # Merge old data and new data
+                for new_data in updates[key]:
+                    data = merge_dicts(data, new_data)
+                pipe.set(key, repr(data))
+                # Keep the age index up to date
+                if data.get('check_time') is not None:
+                    pipe.zadd(INDEX_CHECK_TIME, {key: data['check_time']})
+            pipe.execute()
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1313] Error putting %d "
+                         "service(s) in database: %s" % (len(keys),
+                                                         str(exp)))
+            if isinstance(exp, CONNECTION_ERRORS):
+                self.connection_failed()
+            return (None, True)
+
+        self.connection_succeeded()
         return (None, False)
 
     def get_service(self, host, service):
@@ -131,6 +418,9 @@ class DBClient(object):
         Return
         :query_result: dict
         """
+        # Fail fast if Redis is unreachable
+        if not self.is_available():
+            return None
         # Get key
         key = self.build_key(host, service)
         # Get service
@@ -141,8 +431,11 @@ class DBClient(object):
                          "%s" % (host,
                                  service,
                                  str(exp)))
+            if isinstance(exp, CONNECTION_ERRORS):
+                self.connection_failed()
             return None
-        return eval(data) if data is not None else None
+        self.connection_succeeded()
+        return self.expand_service(eval(data)) if data is not None else None
 
     def get_services(self, host, check_interval):
         """ This function Gets all services with the same host
@@ -151,6 +444,9 @@ class DBClient(object):
         Return
         :query_result: list of dicts
         """
+        # Fail fast if Redis is unreachable
+        if not self.is_available():
+            return None
         # Get key
         key_ci = self.build_key(host, check_interval)
         # Get services
@@ -161,7 +457,10 @@ class DBClient(object):
             logger.error("[SnmpBooster] [code 1306] [%s] "
                          "%s" % (host,
                                  str(exp)))
+            if isinstance(exp, CONNECTION_ERRORS):
+                self.connection_failed()
             return None
+        self.connection_succeeded()
 
         if servicelist is None:
             # TODO : Bailout properly
@@ -176,41 +475,66 @@ class DBClient(object):
                     logger.error("[SnmpBooster] [code 1307] [%s] "
                                  "Unknown service %s", host, service)
                     continue
-                dict_list.append(eval(data))
+                data = self.expand_service(eval(data))
+                if data is None:
+                    continue
+                dict_list.append(data)
             except Exception as exp:
                 logger.error("[SnmpBooster] [code 1308] [%s] "
                              "%s" % (host,
                                      str(exp)))
+                if isinstance(exp, CONNECTION_ERRORS):
+                    # Don't wait the timeout for each service
+                    self.connection_failed()
+                    return None
         return dict_list
 
     def show_keys(self):
         """ Get all database keys """
-        return self.db_conn.keys()
+        return list(self.db_conn.scan_iter(count=BATCH_SIZE))
 
-    def get_hosts_from_service(self, service):
-        """ List hosts with a service which match with the pattern """
+    def get_services_by_keys(self, key_list):
+        """ Get services from a list of (host, service) """
         results = []
-        for key in self.db_conn.keys():
-            if re.search(":.*"+service, key) is None:
-                # Look for service
+        for index in xrange(0, len(key_list), BATCH_SIZE):
+            keys = [self.build_key(host, service)
+                    for host, service in key_list[index:index + BATCH_SIZE]]
+            for data in self.db_conn.mget(keys):
+                if data is None:
+                    continue
+                data = self.expand_service(eval(data))
+                if data is not None:
+                    results.append(data)
+        return results
+
+    def get_service_keys(self, host_pattern=None, service_pattern=None):
+        """ List (host, service) which match patterns, using indexes """
+        key_list = []
+        if service_pattern is not None:
+            for service in self.db_conn.sscan_iter(INDEX_SERVICES,
+                                                   count=BATCH_SIZE):
+                if re.search(service_pattern, service) is None:
+                    continue
+                key_list.extend([(host, service)
+                                 for host in self.db_conn.smembers(INDEX_SERVICE % service)
+                                 if host_pattern is None
+                                 or re.search(host_pattern, host) is not None])
+            return key_list
+
+        for host in self.db_conn.sscan_iter(INDEX_HOSTS, count=BATCH_SIZE):
+            if host_pattern is not None and re.search(host_pattern, host) is None:
                 continue
-            results.append(eval(self.db_conn.get(key)))
+            key_list.extend([(host, service)
+                             for service in self.db_conn.smembers(INDEX_HOST % host)])
+        return key_list
 
-        return results
+    def get_hosts_from_service(self, service):
+        """ List hosts with a service which match with the pattern """
+        return self.get_services_by_keys(self.get_service_keys(service_pattern=service))
 
     def get_services_from_host(self, host):
         """ List all services from hosts which match the pattern """
-        results = []
-        for key in self.db_conn.keys():
-            if re.search(host+".*:", key)is None:
-                # Look for host
-                continue
-            if re.search(":[0-9]+$", key) is not None:
-                # we skip host:interval
-                continue
-            results.append(eval(self.db_conn.get(key)))
-
-        return results
+        return self.get_services_by_keys(self.get_service_keys(host_pattern=host))
 
     def clear_cache(self):
         """ Clear all datas in database """
@@ -218,39 +542,183 @@ class DBClient(object):
 
     def get_all_services(self):
         """ List all services """
-        results = []
-        for key in self.db_conn.keys():
-            if re.search(":[0-9]*$", key) is None:
-                host, service = key.split(":", 1)
-                results.append(self.get_service(host, service))
-
-        return results
+        return self.get_services_by_keys(self.get_service_keys())
 
     def get_all_interval_keys(self):
-        """ List all host:interval keys which match interval pattern """
+        """ List all host:interval keys """
         results = []
-        for key in self.db_conn.keys():
-            if re.search(":[0-9]*$", key) is not None:
-                results.append(key)
-
+        for host in self.db_conn.sscan_iter(INDEX_HOSTS, count=BATCH_SIZE):
+            results.extend([self.build_key(host, interval)
+                            for interval in self.db_conn.smembers(INDEX_INTERVALS % host)])
         return results
 
     def delete_services(self, key_list):
         """ Delete services which match keys in key_list """
+        if not key_list:
+            return 0
         nb_del = self.db_conn.delete(*[self.build_key(host, service)
                                        for host, service in key_list])
-        if nb_del > 0:
-            interval_key = self.get_all_interval_keys()
-            for host, service in key_list:
-                for key in [key for key in interval_key if key.startswith(host)]:
-                    self.db_conn.srem(key, service)
+        # Get intervals of each host
+        hosts = list(set([host for host, _ in key_list]))
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.smembers(INDEX_INTERVALS % host)
+        intervals = dict(zip(hosts, pipe.execute()))
+        # Remove services from host:interval keys and indexes
+        for host, service in key_list:
+            for interval in intervals[host]:
+                pipe.srem(self.build_key(host, interval), service)
+            pipe.srem(INDEX_HOST % host, service)
+            pipe.srem(INDEX_SERVICE % service, host)
+            pipe.zrem(INDEX_CHECK_TIME, self.build_key(host, service))
+        pipe.execute()
+        self.clean_indexes(key_list)
+        return nb_del
+
+    def delete_old_services(self, max_age, pending=False):
+        """ Delete services not checked since max_age seconds, using
+        the check_time index. If pending is True, services never
+        checked are deleted too
+
+        Return
+        :nb_del: int
+        """
+        nb_del = 0
+        limit = time.time() - max_age
+        while True:
+            # Deleted services are removed from the index,
+            # so we always read the first batch
+            members = self.db_conn.zrangebyscore(INDEX_CHECK_TIME,
+                                                 "-inf",
+                                                 limit,
+                                                 start=0,
+                                                 num=BATCH_SIZE)
+            if not members:
+                break
+            nb_del += self.delete_services([member.split(":", 1)
+                                            for member in members])
+
+        if pending:
+            # Services never checked are not in the check_time index
+            key_list = self.get_service_keys()
+            for index in xrange(0, len(key_list), BATCH_SIZE):
+                batch = key_list[index:index + BATCH_SIZE]
+                pipe = self.db_conn.pipeline(transaction=False)
+                for host, service in batch:
+                    pipe.zscore(INDEX_CHECK_TIME,
+                                self.build_key(host, service))
+                nb_del += self.delete_services([key for key, score
+                                                in zip(batch, pipe.execute())
+                                                if score is None])
         return nb_del
 
+    def delete_unused_templates(self):
+        """ Delete templates which are not used by any service
+        All services are read, so it is only done by 'sbcm clear
+        templates'. A template stored by the Arbiter during the cleaning
+        can be deleted: run it when no Arbiter writes its configuration
+
+        Return
+        :nb_del: int
+        """
+        templates = set(self.db_conn.scan_iter(match=META_PREFIX + ":template:*",
+                                               count=BATCH_SIZE))
+        if not templates:
+            return 0
+        key_list = self.get_service_keys()
+        for index in xrange(0, len(key_list), BATCH_SIZE):
+            keys = [self.build_key(host, service)
+                    for host, service in key_list[index:index + BATCH_SIZE]]
+            for data in self.db_conn.mget(keys):
+                if data is None:
+                    continue
+                data = eval(data)
+                templates.discard(data.get('ds_template'))
+                templates.discard(data.get('triggers_template'))
+        if not templates:
+            return 0
+        nb_del = self.db_conn.delete(*templates)
+        for key in templates:
+            self.templates.pop(key, None)
+        logger.info("[SnmpBooster] [code 1314] %d unused templates "
+                    "deleted" % nb_del)
+        return nb_del
+
+    def clean_indexes(self, key_list):
+        """ Remove hosts and service names without service left """
+        hosts = list(set([host for host, _ in key_list]))
+        services = list(set([service for _, service in key_list]))
+        pipe = self.db_conn.pipeline(transaction=False)
+        for host in hosts:
+            pipe.exists(INDEX_HOST % host)
+        for service in services:
+            pipe.exists(INDEX_SERVICE % service)
+        exists = pipe.execute()
+        for host, host_exists in zip(hosts, exists[:len(hosts)]):
+            if not host_exists:
+                pipe.srem(INDEX_HOSTS, host)
+                pipe.delete(INDEX_INTERVALS % host)
+        for service, service_exists in zip(services, exists[len(hosts):]):
+            if not service_exists:
+                pipe.srem(INDEX_SERVICES, service)
+        pipe.execute()
+
     def delete_host(self, host):
         """ Delete all services in the specified host """
-        to_del = []
-        for key in self.db_conn.keys():
-            if re.search(host+":", key) is not None:
-                to_del.append(key)
-        if len(to_del) > 0:
-            return self.db_conn.delete(*to_del)
+        services = self.db_conn.smembers(INDEX_HOST % host)
+        intervals = self.db_conn.smembers(INDEX_INTERVALS % host)
+        to_del = ([self.build_key(host, service) for service in services] +
+                  [self.build_key(host, interval) for interval in intervals])
+        if len(to_del) == 0:
+            return 0
+        nb_del = self.db_conn.delete(*to_del)
+        pipe = self.db_conn.pipeline(transaction=False)
+        for service in services:
+            pipe.srem(INDEX_SERVICE % service, host)
+            pipe.zrem(INDEX_CHECK_TIME, self.build_key(host, service))
+        pipe.delete(INDEX_HOST % host)
+        pipe.execute()
+        self.clean_indexes([(host, service) for service in services])
+        return nb_del
+
+    def rebuild_indexes(self):
+        """ Build secondary indexes from all keys
+        Needed for a database filled before the use of indexes
+        It uses SCAN, so Redis is not blocked
+        """
+        nb_services = 0
+        service_keys = []
+        pipe = self.db_conn.pipeline(transaction=False)
+        for key in self.db_conn.scan_iter(count=BATCH_SIZE):
+            if self.is_meta_key(key) or ":" not in key:
+                continue
+            host, service = key.split(":", 1)
+            if re.match("[0-9]+$", service) is not None:
+                # host:interval key
+                pipe.sadd(INDEX_INTERVALS % host, service)
+            else:
+                pipe.sadd(INDEX_HOSTS, host)
+                pipe.sadd(INDEX_SERVICES, service)
+                pipe.sadd(INDEX_HOST % host, service)
+                pipe.sadd(INDEX_SERVICE % service, host)
+                service_keys.append(key)
+                nb_services += 1
+            if len(service_keys) >= BATCH_SIZE:
+                self.index_check_times(pipe, service_keys)
+                service_keys = []
+            if len(pipe) >= BATCH_SIZE:
+                pipe.execute()
+        self.index_check_times(pipe, service_keys)
+        pipe.execute()
+        return nb_services
+
+    def index_check_times(self, pipe, key_list):
+        """ Add the check_time of services to the age index """
+        if not key_list:
+            return
+        for key, data in zip(key_list, self.db_conn.mget(key_list)):
+            if data is None:
+                continue
+            check_time = eval(data).get('check_time')
+            if check_time is not None:
+                pipe.zadd(INDEX_CHECK_TIME, {key: check_time})
@@ -86,11 +86,21 @@ def set_output_and_status(check_result):
             else:
                 exit_code = 0
 
+    # Data read while a real check of the host was running
+    if check_result.get('stale'):
+        output = "STALE DATA - %s" % output
+    # Real check of a device which doesn't answer
+    if check_result.get('device_down'):
+        output = "DEVICE DOWN - %s" % output
+        exit_code = 3
+
     # Set state
     check_result['state'] = 'done'
     # Set exit code
     check_result['exit_code'] = exit_code
     # Set output
     check_result['output'] = output
-    # Set execution time
-    check_result['execution_time'] = check_result['execution_time'] + time.time() - start_time
+    # Set execution time, from the check start (the SNMP callback doesn't
+    # set it on errors)
+    check_result['execution_time'] = time.time() - check_result.get('start_time',
+                                                                    start_time)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains a database client which distributes hosts
+across several Redis servers
+"""
+
+
+import bisect
+import hashlib
+
+from shinken.log import logger
+
+import redisclient
+
+
+# Number of points of each shard on the hash ring
+VIRTUAL_NODES = 160
+
+
+def parse_shards(db_host, db_port=6379):
+    """ Parse the list of Redis servers
+
+    >>> parse_shards("10.0.0.1:6380, 10.0.0.2, /var/run/redis.sock")
+    [('10.0.0.1:6380', '10.0.0.1', 6380, None), \
+('10.0.0.2', '10.0.0.2', 6379, None), \
+('/var/run/redis.sock', None, None, '/var/run/redis.sock')]
+    """
+    shards = []
+    for shard in db_host.split(","):
+        shard = shard.strip()
+        if not shard:
+            continue
+        if shard.startswith("/"):
+            # Unix socket
+            shards.append((shard, None, None, shard))
+        elif ":" in shard:
+            host, port = shard.rsplit(":", 1)
+            shards.append((shard, host, int(port), None))
+        else:
+            shards.append((shard, shard, db_port, None))
+    return shards
+
+
+def hash_key(key):
+    """ Position of a key on the hash ring """
+    return long(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class DBClient(object):
+    """ Class used to abstract the use of several Redis servers
+
+    Hosts are distributed with consistent hashing: all keys of a host
+    (host:service, host:interval) are on the same server, and adding a
+    server only moves the hosts it takes. Shards are named by their
+    address, so their order in db_host doesn't matter.
+    Queries on one host use one server, other queries are sent to all
+    servers.
+    """
+
+    def __init__(self, db_host, db_port=6379, db_name=None, **kwargs):
+        self.shards = {}
+        for name, host, port, unix_socket in parse_shards(db_host, db_port):
+            shard_kwargs = dict(kwargs)
+            if unix_socket is not None:
+                shard_kwargs['unix_socket'] = unix_socket
+            self.shards[name] = redisclient.DBClient(host, port, db_name,
+                                                     **shard_kwargs)
+        # Hash ring
+        ring = []
+        for name in self.shards:
+            for index in xrange(VIRTUAL_NODES):
+                ring.append((hash_key("%s-%d" % (name, index)), name))
+        ring.sort()
+        self.ring_keys = [point for point, _ in ring]
+        self.ring_shards = [name for _, name in ring]
+
+    def connect(self):
+        """ This function inits the connection to all servers """
+        if not self.shards:
+            logger.error("[SnmpBooster] [code 1601] No Redis server "
+                         "found in db_host")
+            return False
+        return all([shard.connect() for shard in self.shards.values()])
+
+    def disconnect(self):
+        """ This function kills the connection to all servers """
+        for shard in self.shards.values():
+            shard.disconnect()
+
+    @staticmethod
+    def build_key(part1, part2):
+        """ Build Redis key """
+        return redisclient.DBClient.build_key(part1, part2)
+
+    def get_shard_name(self, host):
+        """ Get the name of the server which stores the host """
+        index = bisect.bisect(self.ring_keys, hash_key(host))
+        return self.ring_shards[index % len(self.ring_shards)]
+
+    def get_shard(self, host):
+        """ Get the client of the server which stores the host """
+        return self.shards[self.get_shard_name(host)]
+
+    def group_by_shard(self, key_list):
+        """ Split a (host, service) list by server """
+        groups = {}
+        for host, service in key_list:
+            groups.setdefault(self.get_shard_name(host),
+                              []).append((host, service))
+        return groups
+
+    # Host queries
+    def update_service_init(self, host, service, data):
+        """ Insert a service from the Arbiter """
+        return self.get_shard(host).update_service_init(host, service, data)
+
+    def update_service(self, host, service, data, force=False):
+        """ Update a service """
+        return self.get_shard(host).update_service(host, service, data, force)
+
+    def update_services(self, service_list):
+        """ Update several services, with one request per server """
+        groups = {}
+        for host, service, data in service_list:
+            groups.setdefault(self.get_shard_name(host),
+                              []).append((host, service, data))
+        error = False
+        for name, services in groups.items():
+            error = self.shards[name].update_services(services)[1] or error
+        return (None, error)
+
+    def get_service(self, host, service):
+        """ Get one service """
+        return self.get_shard(host).get_service(host, service)
+
+    def get_services(self, host, check_interval):
+        """ Get all services with the same host and check_interval """
+        return self.get_shard(host).get_services(host, check_interval)
+
+    def delete_host(self, host):
+        """ Delete all services in the specified host """
+        return self.get_shard(host).delete_host(host)
+
+    # Queries on all servers
+    def show_keys(self):
+        """ Get all database keys """
+        results = []
+        for shard in self.shards.values():
+            results.extend(shard.show_keys())
+        return results
+
+    def get_services_by_keys(self, key_list):
+        """ Get services from a list of (host, service) """
+        results = []
+        for name, keys in self.group_by_shard(key_list).items():
+            results.extend(self.shards[name].get_services_by_keys(keys))
+        return results
+
+    def get_service_keys(self, host_pattern=None, service_pattern=None):
+        """ List (host, service) which match patterns """
+        results = []
+        for shard in self.shards.values():
+            results.extend(shard.get_service_keys(host_pattern,
+                                                  service_pattern))
+        return results
+
+    def get_hosts_from_service(self, service):
+        """ List hosts with a service which match with the pattern """
+        return self.get_services_by_keys(self.get_service_keys(service_pattern=service))
+
+    def get_services_from_host(self, host):
+        """ List all services from hosts which match the pattern """
+        return self.get_services_by_keys(self.get_service_keys(host_pattern=host))
+
+    def clear_cache(self):
+        """ Clear all datas in all servers """
+        for shard in self.shards.values():
+            shard.clear_cache()
+
+    def get_all_services(self):
+        """ List all services """
+        return self.get_services_by_keys(self.get_service_keys())
+
+    def get_all_interval_keys(self):
+        """ List all host:interval keys """
+        results = []
+        for shard in self.shards.values():
+            results.extend(shard.get_all_interval_keys())
+        return results
+
+    def delete_services(self, key_list):
+        """ Delete services which match keys in key_list """
+        return sum([self.shards[name].delete_services(keys)
+                    for name, keys in self.group_by_shard(key_list).items()])
+
+    def delete_old_services(self, max_age, pending=False):
+        """ Delete services not checked since max_age seconds """
+        return sum([shard.delete_old_services(max_age, pending)
+                    for shard in self.shards.values()])
+
+    def delete_unused_templates(self):
+        """ Delete templates not used by any service on all servers """
+        return sum([shard.delete_unused_templates()
+                    for shard in self.shards.values()])
+
+    def rebuild_indexes(self):
+        """ Build secondary indexes on all servers """
+        return sum([shard.rebuild_indexes()
+                    for shard in self.shards.values()])
@@ -32,6 +32,8 @@ import time
 
 from shinken.log import logger
 
+from metrics import Counter, Gauge, Histogram
+
 
 try:
     from pysnmp.entity.rfc3413.oneliner import cmdgen
@@ -41,23 +43,264 @@ except ImportError as exp:
     raise ImportError(exp)
 
 
+SNMP_REQUESTS = Counter("snmpbooster_snmp_requests",
+                        "SNMP tasks sent (a walk is one task)",
+                        ("type", ))
+SNMP_IN_FLIGHT = Gauge("snmpbooster_snmp_requests_in_flight",
+                       "SNMP tasks waiting for an answer")
+SNMP_RTT = Histogram("snmpbooster_snmp_rtt_seconds",
+                     "SNMP answer time by device",
+                     ("device", ))
+SNMP_TIMEOUTS = Counter("snmpbooster_snmp_timeouts",
+                        "SNMP requests without answer after all retries",
+                        ("device", ))
+SNMP_ERRORS = Counter("snmpbooster_snmp_errors",
+                      "SNMP errors which are not timeouts",
+                      ("device", ))
+TASK_QUEUE_AGE = Histogram("snmpbooster_task_queue_age_seconds",
+                           "Time spent by SNMP tasks in the task queue")
+SNMP_COALESCED = Counter("snmpbooster_snmp_coalesced_oids",
+                         "OIDs not sent because an other task of the "
+                         "same device asked for them")
+DEVICES_DOWN = Gauge("snmpbooster_devices_down",
+                     "Devices marked down after consecutive timeouts")
+DEVICE_DOWN_TASKS = Counter("snmpbooster_device_down_tasks",
+                            "SNMP tasks not sent because the device is down")
+
+# OID asked to check if a down device answers again (sysUpTime)
+PROBE_OID = "1.3.6.1.2.1.1.3.0"
+# Maximum time between two probes of a down device (seconds)
+PROBE_MAX_INTERVAL = 300
+# Error given to tasks of down devices
+DEVICE_DOWN_ERROR = "Device down: no SNMP response received before timeout"
+
+
+class DeviceState(object):
+    """ Health of a device """
+    __slots__ = ("timeouts", "down_since", "next_probe", "backoff",
+                 "probe_data")
+
+    def __init__(self):
+        self.timeouts = 0
+        self.down_since = None
+        self.next_probe = None
+        self.backoff = None
+        self.probe_data = None
+
+
+class DeviceHealth(object):
+    """ Circuit breaker by device address
+
+    After max_timeouts consecutive timeouts, the device is down: its
+    tasks are not sent, and a request of one OID (PROBE_OID) is sent
+    every probe_interval seconds (doubled after each probe without
+    answer, up to PROBE_MAX_INTERVAL) until the device answers
+    """
+
+    def __init__(self, max_timeouts=3, probe_interval=10):
+        self.configure(max_timeouts, probe_interval)
+
+    def configure(self, max_timeouts=3, probe_interval=10):
+        """ Set the number of timeouts (0: disabled) and the first
+        probe interval
+        """
+        self.max_timeouts = max_timeouts
+        self.probe_interval = probe_interval
+        self.devices = {}
+        self.down = set()
+
+    def is_down(self, address):
+        """ Is the device marked down ? """
+        return address in self.down
+
+    def remember(self, address, data):
+        """ Keep the SNMP parameters of the device for the probes """
+        if self.max_timeouts <= 0:
+            return
+        state = self.devices.get(address)
+        if state is None:
+            state = self.devices[address] = DeviceState()
+        state.probe_data = (data['authData'], data['transportTarget'])
+
+    def record_answer(self, address):
+        """ The device answered """
+        state = self.devices.get(address)
+        if state is None:
+            return
+        state.timeouts = 0
+        if state.down_since is not None:
+            logger.info("[SnmpBooster] [code 0609] [%s] Device answers "
+                        "again after %d seconds" % (address,
+                                                    time.time() - state.down_since))
+            state.down_since = None
+            self.down.discard(address)
+
+    def record_timeout(self, address, probe=False):
+        """ The device didn't answer
+        probe is True when the request was a probe
+        """
+        state = self.devices.get(address)
+        if state is None or self.max_timeouts <= 0:
+            return
+        state.timeouts += 1
+        now = time.time()
+        if state.down_since is not None:
+            # Requests sent before the device was down don't change
+            # the probe interval
+            if probe:
+                self.record_probe_failure(address)
+        elif state.timeouts >= self.max_timeouts:
+            logger.warning("[SnmpBooster] [code 0608] [%s] Device marked "
+                           "down after %d timeouts" % (address,
+                                                       state.timeouts))
+            state.down_since = now
+            state.backoff = self.probe_interval
+            state.next_probe = now + state.backoff
+            self.down.add(address)
+
+    def record_probe_failure(self, address):
+        """ A probe got no answer (timeout or other error): the next
+        one is sent after a longer interval
+        """
+        state = self.devices.get(address)
+        if state is None or state.down_since is None:
+            return
+        state.backoff = min(state.backoff * 2, PROBE_MAX_INTERVAL)
+        state.next_probe = time.time() + state.backoff
+
+    def get_probes(self, now):
+        """ Return (address, authData, transportTarget) of down devices
+        to probe now
+        """
+        probes = []
+        for address in list(self.down):
+            state = self.devices[address]
+            if state.next_probe is not None and now >= state.next_probe:
+                # No other probe until this one is answered
+                state.next_probe = None
+                probes.append((address, ) + state.probe_data)
+        return probes
+
+
+DEVICE_HEALTH = DeviceHealth()
+DEVICES_DOWN.set_function(lambda: len(DEVICE_HEALTH.down))
+
+
 class SNMPWorker(Thread):
-    """ Thread which execute all SNMP tasks/requests """
-    def __init__(self, mapping_queue, max_prepared_tasks):
+    """ Thread which execute all SNMP tasks/requests
+
+    With coalesce, get tasks of the same device (address, port,
+    community and version) prepared in the same dispatcher run are
+    merged: each OID is asked once, and the answer is given to all
+    tasks which need it
+    """
+    def __init__(self, mapping_queue, max_prepared_tasks, coalesce=True):
         Thread.__init__(self)
         self.cmdgen = None # will be cmdgen.AsynCommandGenerator()
         self.mapping_queue = mapping_queue
         self.max_prepared_tasks = max_prepared_tasks
+        self.coalesce = coalesce
         self.must_run = False
         self.task_prepared = 0
+        # Get tasks to merge: snmp_key => list of tasks
+        self.coalesced_tasks = {}
+
+    def send_request(self, request_type, data, host, trace=None):
+        """ Add a SNMP request to the dispatcher
+        The callback is wrapped to measure the answer time
+        """
+        snmp_command_name = ("async" +
+                             request_type.capitalize() +
+                             "Cmd")
+        DEVICE_HEALTH.remember(host, data)
+        data = dict(data)
+        data['cbInfo'] = (timed_callback, (data['cbInfo'][0],
+                                           data['cbInfo'][1],
+                                           host,
+                                           [time.time()],
+                                           trace))
+        getattr(self.cmdgen, snmp_command_name)(**data)
+        SNMP_REQUESTS.labels(request_type).inc()
+        SNMP_IN_FLIGHT.inc()
+
+    def send_coalesced_requests(self):
+        """ Send merged get tasks """
+        for tasks in self.coalesced_tasks.values():
+            if len(tasks) == 1:
+                self.send_request('get', tasks[0]['data'], tasks[0]['host'],
+                                  tasks[0].get('trace'))
+                continue
+            # Each OID once, without PDUs bigger than the tasks ones
+            oids = []
+            seen = set()
+            for task in tasks:
+                for oid in task['data']['varNames']:
+                    if oid not in seen:
+                        seen.add(oid)
+                        oids.append(oid)
+            SNMP_COALESCED.inc(sum([len(task['data']['varNames'])
+                                    for task in tasks]) - len(oids))
+            group_size = max([len(task['data']['varNames'])
+                              for task in tasks] + [1])
+            chunks = [oids[index:index + group_size]
+                      for index in xrange(0, len(oids), group_size)]
+            group = {'tasks': tasks,
+                     'remaining': len(chunks),
+                     'var_binds': {},
+                     'errors': {},
+                     'start_time': time.time(),
+                     }
+            for chunk in chunks:
+                data = dict(tasks[0]['data'])
+                data['varNames'] = chunk
+                data['cbInfo'] = (callback_coalesced, (group, chunk))
+                self.send_request('get', data, tasks[0]['host'])
+        self.coalesced_tasks = {}
+
+    def send_probes(self):
+        """ Send a request of one OID to down devices """
+        for address, auth_data, transport_target in DEVICE_HEALTH.get_probes(time.time()):
+            try:
+                self.send_request('get', {"authData": auth_data,
+                                          "transportTarget": transport_target,
+                                          "varNames": [PROBE_OID],
+                                          "cbInfo": (callback_probe, None),
+                                          },
+                                  address)
+            except Exception as exp:
+                logger.error("[SnmpBooster] [code 0610] [%s] Probe not "
+                             "sent: %s" % (address, str(exp)))
+                # Without answer, the next probe must be scheduled
+                DEVICE_HEALTH.record_probe_failure(address)
+                continue
+            self.task_prepared += 1
 
     def append_task_to_dispatcher(self, snmp_task):
         if snmp_task['type'] in ['bulk', 'next', 'get']:
-            # Append snmp requests
-            snmp_command_name = ("async" +
-                                 snmp_task['type'].capitalize() +
-                                 "Cmd")
-            getattr(self.cmdgen, snmp_command_name)(**snmp_task['data'])
+            # The deadline of the check starts now
+            snmp_task['dispatched_time'] = time.time()
+            if 'queued_time' in snmp_task:
+                TASK_QUEUE_AGE.observe(time.time() - snmp_task['queued_time'])
+            if DEVICE_HEALTH.is_down(snmp_task['host']):
+                # Don't wait the timeout: give the error to the task now
+                DEVICE_DOWN_TASKS.inc()
+                callback, callback_ctx = snmp_task['data']['cbInfo']
+                callback(None, DEVICE_DOWN_ERROR, 0, 0, [], callback_ctx)
+                self.mapping_queue.task_done()
+                return
+            trace = snmp_task.get('trace')
+            if trace is not None:
+                trace.add_span("task_queue", snmp_task['queued_time'],
+                               type=snmp_task['type'])
+            if (self.coalesce and snmp_task['type'] == 'get'
+                    and snmp_task.get('snmp_key') is not None):
+                # Sent after all tasks of the dispatcher run are prepared
+                self.coalesced_tasks.setdefault(snmp_task['snmp_key'],
+                                                []).append(snmp_task)
+            else:
+                # Append snmp requests
+                self.send_request(snmp_task['type'], snmp_task['data'],
+                                  snmp_task['host'], trace)
             # Mark task as done
             self.mapping_queue.task_done()
             self.task_prepared += 1
@@ -143,6 +386,10 @@ class SNMPWorker(Thread):
                 # Add task dispatcher
                 self.append_task_to_dispatcher(snmp_task)
 
+            # Send merged get tasks
+            self.send_coalesced_requests()
+            # Check if down devices answer again
+            self.send_probes()
             if self.task_prepared > 0:
                 # Launch SNMP requests
                 self.cmdgen.snmpEngine.transportDispatcher.runDispatcher()
@@ -158,6 +405,100 @@ class SNMPWorker(Thread):
         self.must_run = False
 
 
+def is_timeout(error_indication):
+    """ Is the SNMP error a timeout ?
+
+    >>> is_timeout("No SNMP response received before timeout")
+    True
+    >>> is_timeout("requestTimedOut")
+    True
+    """
+    error = str(error_indication).lower()
+    return "timeout" in error or "timedout" in error
+
+
+def timed_callback(send_request_handle, error_indication, error_status,
+                   error_index, var_binds, cb_ctx):
+    """ Count SNMP answers and errors, then call the task callback
+    Sampled checks get the request and the callback stages
+    """
+    callback, callback_ctx, device, start_time, trace = cb_ctx
+    now = time.time()
+    if error_indication is None:
+        SNMP_RTT.labels(device).observe(now - start_time[0])
+        DEVICE_HEALTH.record_answer(device)
+    elif is_timeout(error_indication):
+        SNMP_TIMEOUTS.labels(device).inc()
+        DEVICE_HEALTH.record_timeout(device, callback is callback_probe)
+    else:
+        SNMP_ERRORS.labels(device).inc()
+        if callback is callback_probe:
+            # No other probe is scheduled while this one is in flight
+            DEVICE_HEALTH.record_probe_failure(device)
+    if trace is not None:
+        trace.add_span("snmp_request", start_time[0], now, device=device,
+                       error=str(error_indication) if error_indication else None)
+    ret = callback(send_request_handle, error_indication, error_status,
+                   error_index, var_binds, callback_ctx)
+    if trace is not None:
+        trace.add_span(callback.__name__, now)
+    if ret:
+        # Walks send a new request when the callback returns True
+        start_time[0] = time.time()
+    else:
+        SNMP_IN_FLIGHT.dec()
+    return ret
+
+
+def callback_coalesced(send_request_handle, error_indication, error_status,
+                       error_index, var_binds, cb_ctx):
+    """ Callback function for merged GET SNMP requests
+    When all requests of the group are answered, each task callback
+    gets its OIDs (or the error of the request which asked them)
+    """
+    group, chunk = cb_ctx
+    if error_indication is None:
+        for oid, value in var_binds:
+            group['var_binds'][oid.prettyPrint()] = (oid, value)
+    else:
+        for oid in chunk:
+            group['errors'][oid] = error_indication
+    group['remaining'] -= 1
+    if group['remaining'] > 0:
+        return False
+    # Fan out answers
+    now = time.time()
+    for task in group['tasks']:
+        callback, callback_ctx = task['data']['cbInfo']
+        task_error = None
+        task_var_binds = []
+        for oid in task['data']['varNames']:
+            if oid in group['errors']:
+                task_error = group['errors'][oid]
+                break
+            if oid in group['var_binds']:
+                task_var_binds.append(group['var_binds'][oid])
+        trace = task.get('trace')
+        if trace is not None:
+            trace.add_span("snmp_request", group['start_time'], now,
+                           device=task['host'],
+                           coalesced=len(group['tasks']),
+                           error=str(task_error) if task_error else None)
+        callback(send_request_handle, task_error, error_status, error_index,
+                 task_var_binds if task_error is None else [], callback_ctx)
+        if trace is not None:
+            trace.add_span(callback.__name__, now)
+    return False
+
+
+def callback_probe(send_request_handle, error_indication, error_status,
+                   error_index, var_binds, cb_ctx):
+    """ Callback function for probes of down devices
+    The answer (or the timeout) is handled by timed_callback
+    """
+    return False
+
+
 def handle_snmp_error(error_indication, cb_ctx, request_type):
     """ Handle SNMP errors """
     if error_indication is None:
@@ -177,7 +518,7 @@ def handle_snmp_error(error_indication, cb_ctx, request_type):
     if request_type == "get":
         # We set SNMP error in all oids
         for result in results.values():
-            result['error'] = str(error_indication)
+            result.error = str(error_indication)
 
     return True
 
@@ -197,7 +538,7 @@ def callback_get(send_request_handle, error_indication, error_status,
     if handle_snmp_error(error_indication, cb_ctx, "get"):
         # set as received
         service_result['state'] = 'received'
-        result_queue.put(results)
+        result_queue.put((results, service_result))
         return False
 
     # browse reponses
@@ -212,55 +553,28 @@ def callback_get(send_request_handle, error_indication, error_status,
                 # Log NoSuchInstance SNMP error
                 message = "Oid not found on the device: %s" % oid
                 logger.error("[SnmpBooster] [code 0607] [%s, %s] SNMP Error: "
-                             "%s" % (results.values()[0]['key']['host'],
-                                     results[oid]['key']['service'],
+                             "%s" % (results[oid].host,
+                                     results[oid].service,
                                      message))
-                results[oid]['error'] = message
+                results[oid].error = message
             else:
                 # save value
-                results[oid]['value'] = value
+                results[oid].value = value
 
             # save check time
-            results[oid]['check_time'] = time.time()
+            results[oid].check_time = time.time()
 
     # Check if we get all values
-    result_with_value_or_error = [oid['value'] for oid in results.values()
-                                  if oid.get('value') is None
-                                  and oid.get('error') is None]
+    result_with_value_or_error = [result.value for result in results.values()
+                                  if result.value is None
+                                  and result.error is None]
     if len(result_with_value_or_error) == 0:
         # Add a saving task to the saving queue
         # (processed by the function save_results)
-        result_queue.put(results)
-
-        # Prepare datas for the current service
-        tmp_results = [r for r in results.values()
-                       if r['key']['host'] == service_result['host']
-                       and r['key']['service'] == service_result['service']]
-        for tmp_result in tmp_results:
-            key = tmp_result.get('key')
-            # ds name
-            ds_names = key.get('ds_names')
-            for ds_name in ds_names:
-                # Last value
-                last_value_key = ".".join(("ds",
-                                           ds_name,
-                                           key.get('oid_type') + "_value_last"
-                                           )
-                                          )
-                # New value
-                value_key = ".".join(("ds",
-                                      ds_name,
-                                      key.get('oid_type') + "_value"
-                                      )
-                                     )
-                # Set last value
-                service_result['db_data']['ds'][ds_name][last_value_key] = tmp_result.get('value_last')
-                # Set value
-                service_result['db_data']['ds'][ds_name][value_key] = tmp_result.get('value')
-        # Set last check time
-        service_result['db_data']['check_time_last'] = service_result['db_data'].get('check_time')
-        # Set check time
-        service_result['db_data']['check_time'] = time.time()
+        result_queue.put((results, service_result))
+
+        # The Poller copies the computed values in the db_data of the
+        # check before its output (see SnmpBoosterPoller.save_results)
         # set as received
         service_result['state'] = 'received'
         # Calculate execution time
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains a database client which uses a local SQLite
+file, for Arbiter, Scheduler and Poller running on the same server
+"""
+
+
+import os
+import re
+import time
+import sqlite3
+import cPickle
+
+from shinken.log import logger
+
+from utils import merge_dicts, get_collected_values
+
+
+# Default database file
+DB_PATH = "/var/lib/shinken/snmpbooster.db"
+# Time (in milliseconds) to wait for the writer lock
+BUSY_TIMEOUT = 5000
+# Size of the memory mapped part of the database file
+MMAP_SIZE = 256 * 1024 * 1024
+
+SCHEMA = ("CREATE TABLE IF NOT EXISTS services ("
+          "host TEXT NOT NULL, "
+          "service TEXT NOT NULL, "
+          "check_interval INTEGER, "
+          "check_time REAL, "
+          "data BLOB NOT NULL, "
+          "PRIMARY KEY (host, service))",
+          "CREATE INDEX IF NOT EXISTS services_interval "
+          "ON services (host, check_interval)",
+          "CREATE INDEX IF NOT EXISTS services_check_time "
+          "ON services (check_time)",
+          )
+
+
+def dumps(data):
+    """ Serialize service data """
+    return sqlite3.Binary(cPickle.dumps(data, cPickle.HIGHEST_PROTOCOL))
+
+
+def loads(data):
+    """ Unserialize service data """
+    return cPickle.loads(str(data))
+
+
+class DBClient(object):
+    """ Class used to abstract the use of a SQLite database file
+
+    The database uses the WAL journal: readers (cache checks) don't
+    wait for the writer, and the writer waits for the lock of other
+    writers (Arbiter, other Poller workers) up to BUSY_TIMEOUT.
+    Reads use a memory mapped file, there is no network round trip.
+    SQLite connections can't be shared by forked processes, so each
+    process opens its own connection.
+    """
+
+    def __init__(self, db_host=None, db_port=None, db_name=None,
+                 db_path=None, **kwargs):
+        self.db_path = db_path or DB_PATH
+        self._conn = None
+        self._conn_pid = None
+
+    @property
+    def db_conn(self):
+        """ Connection of the current process """
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path,
+                                         timeout=BUSY_TIMEOUT / 1000.0,
+                                         isolation_level=None)
+            self._conn_pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # Durable enough for a cache, and far faster
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=%d" % BUSY_TIMEOUT)
+            self._conn.execute("PRAGMA mmap_size=%d" % MMAP_SIZE)
+        return self._conn
+
+    def connect(self):
+        """ This function opens the database and creates the table """
+        try:
+            for query in SCHEMA:
+                self.db_conn.execute(query)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1701] SQLite error while "
+                         "opening %s: %s" % (self.db_path, str(exp)))
+            return False
+        return True
+
+    def disconnect(self):
+        """ This function closes the database """
+        if self._conn is not None and self._conn_pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    @staticmethod
+    def build_key(part1, part2):
+        """ Build a key like the Redis backend
+
+        >>> build_key("part1", "part2")
+        'part1:part2'
+        """
+        return ":".join((str(part1), str(part2)))
+
+    def write_services(self, service_list, force=False):
+        """ Merge and write services in one transaction
+        :service_list: list of (host, service, data)
+        """
+        conn = self.db_conn
+        # Take the writer lock now, so data read can't change
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for host, service, data in service_list:
+                if not force:
+                    row = conn.execute("SELECT data FROM services "
+                                       "WHERE host = ? AND service = ?",
+                                       (host, service)).fetchone()
+                    # Merge old data and new data
+                    data = merge_dicts(loads(row[0]) if row else None, data)
+                conn.execute("INSERT OR REPLACE INTO services "
+                             "(host, service, check_interval, check_time, "
+                             "data) VALUES (?, ?, ?, ?, ?)",
+                             (host, service, data.get('check_interval'),
+                              data.get('check_time'), dumps(data)))
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def update_service_init(self, host, service, data):
+        """ Insert/Update service information by Arbiter """
+        old_dict = self.get_service(host, service)
+        if old_dict is not None:
+            # We don't want to lose values collected by the pollers
+            # But the new configuration wins over the old one
+            data = data.copy()
+            collected = get_collected_values(old_dict.get('ds', {}),
+                                             data.get('ds', {}))
+            data['ds'] = dict([(ds_name, dict(ds_data, **collected[ds_name]))
+                               for ds_name, ds_data in data.get('ds', {}).items()])
+            old_dict.update(data)
+            data = old_dict
+        return self.update_service(host, service, data, force=True)
+
+    def update_service(self, host, service, data, force=False):
+        """ This function updates/inserts a service
+        * It used by Arbiter in hook_late_configuration
+          to put the configuration in the database
+        * It used by Poller to put collected data in the database
+        The 'force' is used to overwrite the service datas (used in
+        cache manager)
+
+        Return
+        * query_result: None
+        * error: bool
+        """
+        if data is None:
+            return (None, True)
+        try:
+            self.write_services([(host, service, data)], force)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1702] [%s, %s] "
+                         "%s" % (host,
+                                 service,
+                                 str(exp)))
+            return (None, True)
+        return (None, False)
+
+    def update_services(self, service_list):
+        """ This function updates several services in one transaction
+        It used by Poller to save results of SNMP requests
+        :service_list: list of (host, service, data)
+
+        Return
+        * query_result: None
+        * error: bool
+        """
+        if not service_list:
+            return (None, False)
+        try:
+            self.write_services(service_list)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1703] Error putting %d "
+                         "service(s) in database: %s" % (len(service_list),
+                                                         str(exp)))
+            return (None, True)
+        return (None, False)
+
+    def get_service(self, host, service):
+        """ This function gets one service from the database
+
+        Return
+        :query_result: dict
+        """
+        try:
+            row = self.db_conn.execute("SELECT data FROM services "
+                                       "WHERE host = ? AND service = ?",
+                                       (host, service)).fetchone()
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1704] [%s, %s] "
+                         "%s" % (host,
+                                 service,
+                                 str(exp)))
+            return None
+        return loads(row[0]) if row is not None else None
+
+    def get_services(self, host, check_interval):
+        """ This function Gets all services with the same host
+        and check_interval
+
+        Return
+        :query_result: list of dicts
+        """
+        try:
+            rows = self.db_conn.execute("SELECT data FROM services "
+                                        "WHERE host = ? AND check_interval = ?",
+                                        (host, check_interval)).fetchall()
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1705] [%s] "
+                         "%s" % (host,
+                                 str(exp)))
+            return None
+        return [loads(row[0]) for row in rows]
+
+    # Cache manager queries
+    def show_keys(self):
+        """ Get all services as host:service """
+        return [self.build_key(host, service)
+                for host, service in self.get_service_keys()]
+
+    def get_services_by_keys(self, key_list):
+        """ Get services from a list of (host, service) """
+        results = []
+        for host, service in key_list:
+            data = self.get_service(host, service)
+            if data is not None:
+                results.append(data)
+        return results
+
+    def get_service_keys(self, host_pattern=None, service_pattern=None):
+        """ List (host, service) which match patterns """
+        return [(host, service)
+                for host, service in self.db_conn.execute("SELECT host, service "
+                                                          "FROM services")
+                if (host_pattern is None or re.search(host_pattern, host))
+                and (service_pattern is None or re.search(service_pattern, service))]
+
+    def get_hosts_from_service(self, service):
+        """ List hosts with a service which match with the pattern """
+        return self.get_services_by_keys(self.get_service_keys(service_pattern=service))
+
+    def get_services_from_host(self, host):
+        """ List all services from hosts which match the pattern """
+        return self.get_services_by_keys(self.get_service_keys(host_pattern=host))
+
+    def clear_cache(self):
+        """ Clear all datas in database """
+        self.db_conn.execute("DELETE FROM services")
+
+    def get_all_services(self):
+        """ List all services """
+        return [loads(row[0]) for row in
+                self.db_conn.execute("SELECT data FROM services")]
+
+    def delete_services(self, key_list):
+        """ Delete services which match keys in key_list """
+        conn = self.db_conn
+        conn.execute("BEGIN IMMEDIATE")
+        nb_del = 0
+        try:
+            for host, service in key_list:
+                nb_del += conn.execute("DELETE FROM services "
+                                       "WHERE host = ? AND service = ?",
+                                       (host, service)).rowcount
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return nb_del
+
+    def delete_old_services(self, max_age, pending=False):
+        """ Delete services not checked since max_age seconds
+        If pending is True, services never checked are deleted too
+        """
+        query = "DELETE FROM services WHERE check_time < ?"
+        if pending:
+            query += " OR check_time IS NULL"
+        return self.db_conn.execute(query, (time.time() - max_age,)).rowcount
+
+    def delete_host(self, host):
+        """ Delete all services in the specified host """
+        return self.db_conn.execute("DELETE FROM services WHERE host = ?",
+                                    (host,)).rowcount
+
+    def rebuild_indexes(self):
+        """ Create the table and indexes and return the number of services """
+        self.connect()
+        return self.db_conn.execute("SELECT COUNT(*) FROM services").fetchone()[0]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains a hierarchical timing wheel, used by the Poller
+to find checks which reached their deadline
+
+Adding and cancelling a timer is O(1), and advancing the wheel costs
+the number of expired timers (plus the timers moved from an upper
+wheel to a lower one, once per level)
+"""
+
+
+import math
+
+
+__all__ = ("Timer", "TimerWheel")
+
+
+class Timer(object):
+    """ A deadline and the item returned when it is reached """
+    __slots__ = ("deadline", "item", "cancelled")
+
+    def __init__(self, deadline, item):
+        self.deadline = deadline
+        self.item = item
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    """ Hierarchical timing wheel
+
+    The wheel of level L has wheel_size slots of tick * wheel_size ** L
+    seconds. A timer is put in the lowest level which covers its
+    deadline; when a slot of an upper level is reached, its timers are
+    put again in the lower levels.
+    Deadlines after the last level are kept in its last slot, and put
+    again when the slot is reached: timers of a lowest level slot whose
+    deadline is not reached yet are put again instead of expiring.
+
+    >>> wheel = TimerWheel(tick=1, now=0)
+    >>> timer = wheel.add(5, "check1")
+    >>> _ = wheel.add(200, "check2")
+    >>> wheel.advance(4)
+    []
+    >>> wheel.advance(5)
+    ['check1']
+    >>> wheel.advance(300)
+    ['check2']
+    """
+
+    def __init__(self, tick=1.0, wheel_size=64, levels=4, now=0):
+        self.tick = float(tick)
+        self.wheel_size = wheel_size
+        self.levels = levels
+        # Tick reached by the last advance
+        self.current = int(now / self.tick)
+        self.wheels = [[[] for _ in xrange(wheel_size)]
+                       for _ in xrange(levels)]
+        # Timers whose deadline is already passed
+        self.expired = []
+        self.count = 0
+
+    def __len__(self):
+        """ Number of timers (cancelled timers are counted until their
+        slot is reached)
+        """
+        return self.count
+
+    def add(self, deadline, item):
+        """ Add a timer and return it (to cancel it) """
+        timer = Timer(deadline, item)
+        self.insert(timer)
+        self.count += 1
+        return timer
+
+    @staticmethod
+    def cancel(timer):
+        """ Cancel a timer """
+        if timer is not None:
+            timer.cancelled = True
+
+    def insert(self, timer):
+        """ Put a timer in the slot of its deadline """
+        expires = int(math.ceil(timer.deadline / self.tick))
+        delta = expires - self.current
+        if delta <= 0:
+            self.expired.append(timer)
+            return
+        span = self.wheel_size
+        for level in xrange(self.levels):
+            if delta < span or level == self.levels - 1:
+                if delta >= span:
+                    # After the last level: put it in the last slot
+                    expires = self.current + span - 1
+                slot = (expires // (span // self.wheel_size)) % self.wheel_size
+                self.wheels[level][slot].append(timer)
+                return
+            span *= self.wheel_size
+
+    def advance(self, now):
+        """ Move the wheel to now and return items of expired timers """
+        target = int(now / self.tick)
+        expired = self.expired
+        self.expired = []
+        while self.current < target:
+            self.current += 1
+            # Put timers of upper levels in lower levels, the highest
+            # level first
+            cascade = []
+            span = 1
+            for level in xrange(1, self.levels):
+                span *= self.wheel_size
+                if self.current % span != 0:
+                    break
+                cascade.append((level, span))
+            for level, span in reversed(cascade):
+                slot = (self.current // span) % self.wheel_size
+                timers = self.wheels[level][slot]
+                self.wheels[level][slot] = []
+                for timer in timers:
+                    if not timer.cancelled:
+                        self.insert(timer)
+                    else:
+                        self.count -= 1
+            slot = self.current % self.wheel_size
+            timers = self.wheels[0][slot]
+            self.wheels[0][slot] = []
+            for timer in timers:
+                if (timer.cancelled or
+                        math.ceil(timer.deadline / self.tick) <= self.current):
+                    expired.append(timer)
+                else:
+                    # Deadline after the last level (one level wheel)
+                    self.insert(timer)
+            # Timers put again in the current tick
+            expired.extend(self.expired)
+            self.expired = []
+        items = []
+        for timer in expired:
+            self.count -= 1
+            if not timer.cancelled:
+                items.append(timer.item)
+        return items
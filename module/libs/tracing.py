@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" This module contains the tracing of checks
+
+A sampled check gets a Trace, which records the start and the end of
+each stage of the check (parse_args, check_cache, get_services,
+mapping, prepare_oids, task_queue, snmp_request, callback_get,
+save_results, set_output_and_status).
+Traces of checks in error or timed out end at their last stage.
+Finished traces are kept in a ring buffer, and can be exported as JSON
+or in the Chrome trace format (chrome://tracing, Perfetto) on the
+metrics HTTP server: /traces and /traces/chrome (?host=name to filter)
+"""
+
+
+import os
+import json
+import time
+import random
+import itertools
+import threading
+from collections import deque
+
+from metrics import register_route
+
+
+__all__ = ("Trace", "Tracer", "TRACER")
+
+
+# Number of finished traces kept
+BUFFER_SIZE = 1000
+
+
+class Trace(object):
+    """ Stages of one check
+    Spans are added by the Poller and by the SNMP worker thread
+    (list.append is thread safe)
+    """
+    __slots__ = ("trace_id", "host", "service", "kind", "start", "end",
+                 "spans", "mark")
+
+    def __init__(self, trace_id, host, service, kind, start=None):
+        self.trace_id = trace_id
+        self.host = host
+        self.service = service
+        self.kind = kind
+        self.start = start if start is not None else time.time()
+        self.end = None
+        self.spans = []
+        # Time of the last stage end, used by the next stage
+        self.mark = self.start
+
+    def add_span(self, name, start, end=None, **attrs):
+        """ Add a stage which begins at start and ends at end (now) """
+        if end is None:
+            end = time.time()
+        self.spans.append((name, start, end, attrs))
+        self.mark = end
+        return end
+
+    def to_dict(self):
+        """ Trace as a dict (times are in seconds since epoch) """
+        return {"trace_id": self.trace_id,
+                "host": self.host,
+                "service": self.service,
+                "kind": self.kind,
+                "start": self.start,
+                "end": self.end,
+                "duration": (self.end or time.time()) - self.start,
+                "spans": [dict(attrs, name=name, start=start,
+                               duration=end - start)
+                          for name, start, end, attrs in self.spans],
+                }
+
+    def to_chrome_events(self, pid):
+        """ Trace as Chrome trace events (one thread per check) """
+        events = [{"name": "thread_name", "ph": "M", "pid": pid,
+                   "tid": self.trace_id,
+                   "args": {"name": "%s, %s" % (self.host, self.service)}},
+                  {"name": "check", "cat": self.kind, "ph": "X",
+                   "pid": pid, "tid": self.trace_id,
+                   "ts": int(self.start * 1000000),
+                   "dur": int(((self.end or time.time()) - self.start) * 1000000),
+                   "args": {"host": self.host, "service": self.service}},
+                  ]
+        for name, start, end, attrs in self.spans:
+            events.append({"name": name, "cat": self.kind, "ph": "X",
+                           "pid": pid, "tid": self.trace_id,
+                           "ts": int(start * 1000000),
+                           "dur": int((end - start) * 1000000),
+                           "args": attrs})
+        return events
+
+
+class Tracer(object):
+    """ Choose traced checks and keep finished traces """
+
+    def __init__(self, sample_rate=0.0, buffer_size=BUFFER_SIZE, hosts=()):
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.configure(sample_rate, buffer_size, hosts)
+
+    def configure(self, sample_rate=0.0, buffer_size=BUFFER_SIZE, hosts=()):
+        """ Set the fraction of traced checks (0 to 1), the number of
+        traces kept and the hosts which are always traced
+        """
+        self.sample_rate = sample_rate
+        self.hosts = set(hosts)
+        self.traces = deque(maxlen=max(buffer_size, 1))
+
+    def start_trace(self, host, service, kind, start=None):
+        """ Return a Trace if the check is sampled, else None """
+        if host not in self.hosts and (self.sample_rate <= 0 or
+                                       random.random() >= self.sample_rate):
+            return None
+        with self.lock:
+            trace_id = next(self.ids)
+        return Trace(trace_id, host, service, kind, start)
+
+    def finish_trace(self, trace):
+        """ Keep a finished trace in the ring buffer """
+        trace.end = time.time()
+        self.traces.append(trace)
+
+    def get_traces(self, host=None):
+        """ Finished traces, oldest first """
+        return [trace for trace in list(self.traces)
+                if host is None or trace.host == host]
+
+    def export_json(self, host=None):
+        """ Finished traces in JSON """
+        return json.dumps([trace.to_dict()
+                           for trace in self.get_traces(host)])
+
+    def export_chrome(self, host=None):
+        """ Finished traces in the Chrome trace format """
+        pid = os.getpid()
+        events = []
+        for trace in self.get_traces(host):
+            events.extend(trace.to_chrome_events(pid))
+        return json.dumps({"traceEvents": events,
+                           "displayTimeUnit": "ms"})
+
+
+TRACER = Tracer()
+
+register_route("/traces",
+               lambda query: ("application/json",
+                              TRACER.export_json(query.get("host"))))
+register_route("/traces/chrome",
+               lambda query: ("application/json",
+                              TRACER.export_chrome(query.get("host"))))
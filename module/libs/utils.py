@@ -33,6 +33,11 @@ from collections import OrderedDict
 from shinken.log import logger
 
 
+# Datasource fields collected by the poller
+REGEX_DS_VALUE = re.compile("(_value|_value_last|_value_computed|"
+                            "_value_computed_last)$|^error$")
+
+
 def flatten_dict(tree_dict):
     """ Convert unlimited tree dictionnary to a flat dictionnary
 
@@ -87,6 +92,23 @@ def merge_dicts(old_dict, new_dict):
     return old_dict
 
 
+def get_collected_values(old_ds, ds_template):
+    """ Get values collected by the pollers in old datasources,
+    for datasources still defined in the new configuration
+
+    >>> get_collected_values({'a': {'ds_oid_value': 1, 'ds_oid': '.1'},
+    ...                       'b': {'ds_oid_value': 2}}, {'a': {'ds_oid': '.2'}})
+    {'a': {'ds_oid_value': 1}}
+    """
+    collected = {}
+    for ds_name, ds_data in ds_template.items():
+        collected[ds_name] = dict([(name, value)
+                                   for name, value in old_ds.get(ds_name, {}).items()
+                                   if name not in ds_data
+                                   and REGEX_DS_VALUE.search(name)])
+    return collected
+
+
 def rpn_calculator(rpn_list):
     """ Reverse Polish notation calculator
 
@@ -158,49 +180,30 @@ def derive(value, value_last, check_time, check_time_last, limit=4294967295):
 
 def compute_value(result):
     """ Get a computed value from raw_value, ds_type and calculation
-    result argument must have this form ::
-
-        {'value_last': u'0',
-         'calc': None,
-         'check_time': 1410456115.376102,
-         'key': {'host': u'myhost1',
-                 'ds_names': [u'ifOutErrors'],
-                 'service': u'if.lo',
-                 'oid_type': 'ds_oid'},
-         'check_time_last': 1410456100.722268,
-         'value_last_computed': u'0',
-         'type': u'TEXT',
-         'value': Counter32(0),
-        }
-
-    >>> data = {}
-    >>> data['value_last'] = u'0'
-    >>> data['calc'] = None
-    >>> data['check_time'] = 1410456115.376102
-    >>> data['key'] = {}
-    >>> data['key']['host'] = u'myhost1'
-    >>> data['key']['ds_names'] = [u'ifOutErrors']
-    >>> data['key']['service'] = u'if.lo'
-    >>> data['key']['oid_type'] = 'ds_oid'
-    >>> data['check_time_last'] = 1410456100.722268
-    >>> data['value_last_computed'] = u'Text collected from SNMP'
-    >>> data['type'] = u'TEXT'
-    >>> data['value'] = "Text collected from SNMP"
+    result argument is an OidResult (see libs/oidresult.py)
+
+    >>> from oidresult import OidResult
+    >>> data = OidResult(u'myhost1', u'if.lo', u'ifOutErrors', 'ds_oid',
+    ...                  u'TEXT', value_last=u'0',
+    ...                  value_last_computed=u'Text collected from SNMP',
+    ...                  check_time_last=1410456100.722268)
+    >>> data.check_time = 1410456115.376102
+    >>> data.value = "Text collected from SNMP"
     >>> compute_value(data)
     'Text collected from SNMP'
     """
     # Get format function name
-    format_func_name = 'format_' + result.get('type').lower() + '_value'
+    format_func_name = 'format_' + result.type.lower() + '_value'
     format_func = getattr(sys.modules[__name__], format_func_name, None)
 
     # launch format function
     value = format_func(result)
 
     # Make calculation
-    if result['calc'] is not None:
+    if result.calc is not None:
         # Replace %(ds_max)s and %(ds_min)s
         # example: ds_calc = value, 60, div, %(ds_max)s, 1000, div, div,100 ,mul
-        calculation_element_list = [elt % result for elt in result['calc']]
+        calculation_element_list = [elt % result for elt in result.calc]
         # Make calculation
         value = calculation(value, calculation_element_list)
     return value
@@ -208,7 +211,7 @@ def compute_value(result):
 
 def format_text_value(result):
     """ Format value for text type """
-    return str(result.get('value'))
+    return str(result.value)
 
 
 def format_derive64_value(result):
@@ -219,13 +222,13 @@ def format_derive64_value(result):
 def format_derive_value(result, limit=2 ** 32 - 1):
     """ Format value for derive type """
 
-    if result['value_last'] is None:
+    if result.value_last is None:
         # Need more data to get derive
         raise Exception("Waiting an additional check to calculate derive")
 
     # Get derive
-    value = derive(result['value'], result['value_last'],
-                   result['check_time'], result['check_time_last'],
+    value = derive(result.value, result.value_last,
+                   result.check_time, result.check_time_last,
                    limit)
 
     return float(value)
@@ -233,7 +236,7 @@ def format_derive_value(result, limit=2 ** 32 - 1):
 
 def format_gauge_value(result):
     """ Format value for gauge type """
-    return float(result['value'])
+    return float(result.value)
 
 
 def format_counter64_value(result):
@@ -244,7 +247,7 @@ def format_counter64_value(result):
 def format_counter_value(result, limit=2 ** 32 - 1):
     """ Format value for counter type """
     # NOTE Handle limit ??
-    return float(result['value'])
+    return float(result.value)
 
 
 def parse_args(cmd_args):
@@ -277,14 +280,15 @@ def parse_args(cmd_args):
             "no_concurrency": False,
             "maximise-datasources": None,
             "maximise-datasources-value": None,
-            # Hidden option
+            # Hidden options
             "real_check": False,
+            "with_intervals": [],
             }
 
     # Handle options
     try:
         options, _ = getopt.getopt(cmd_args,
-                                   'H:A:S:C:V:P:s:e:t:i:n:m:N:T:b:M:R:g:c:d:v:r',
+                                   'H:A:S:C:V:P:s:e:t:i:n:m:N:T:b:M:R:g:c:d:v:rI:',
                                    ['host-name=', 'host-address=', 'service=',
                                     'community=', 'snmp-version=', 'port=',
                                     'timeout=', 'retry=',
@@ -295,6 +299,7 @@ def parse_args(cmd_args):
                                     'use-getbulk=', 'max-rep-map=',
                                     'request-group-size=', 'no-concurrency=',
                                     'maximise-datasources=', 'maximise-datasources-value=', 'real-check',
+                                    'with-intervals=',
                                     ]
                                    )
     except getopt.GetoptError as err:
@@ -372,9 +377,13 @@ def parse_args(cmd_args):
 
         elif option_name in ("-v", "--maximise-datasources-value"):
             args['maximise-datasources-value'] = value.split(',')
-        # Hidden option
+        # Hidden options
         elif option_name in ("-r", "--real-check"):
             args['real_check'] = True
+        # Other check intervals of the host polled by the real check
+        elif option_name in ("-I", "--with-intervals"):
+            args['with_intervals'] = [int(interval)
+                                      for interval in value.split(',')]
        
     # If a value is set to "None" we convert it to None
     nullable_args = ['mapping',
@@ -422,10 +431,166 @@ REGEX_OID = re.compile('\.\d+(\.\d+)*')
 REGEX_DS_ATTRIBUTE = re.compile('ds_*')
 
 
-def dict_serialize(serv, mac_resol, datasource):
+def get_cached(ds_cache, key, func, *args):
+    """ Get the result of func(*args) from ds_cache
+    Errors are cached too, so a bad dstemplate or triggergroup
+    is not expanded again for each service which uses it
+    """
+    if key not in ds_cache:
+        try:
+            ds_cache[key] = (func(*args), None)
+        except Exception as exp:
+            ds_cache[key] = (None, str(exp))
+    result, error_message = ds_cache[key]
+    if error_message is not None:
+        raise Exception(error_message)
+    return result
+
+
+def validate_datasource(datasource):
+    """ Check the DATASOURCE section of the datasource """
+    the_datasource = datasource.get('DATASOURCE')
+
+    for key, value in the_datasource.items():
+        if isinstance(value, (str, unicode)):
+            if not REGEX_OID.match(value) and not REGEX_DS_ATTRIBUTE.match(key):
+                raise Exception("OID for %s isn't valid: %r" % (key, value))
+
+        if isinstance(value, dict):
+            if '-' in key:
+                raise Exception("Ds_name  %s isn't valid (contain -)" % key)
+    return True
+
+
+def compute_min_max_values(ds_data):
+    """ Add computed_value for max and min """
+    for max_min in ['ds_max_oid_value', 'ds_min_oid_value']:
+        if ds_data.get(max_min) is not None:
+            try:
+                ds_data[max_min + '_computed'] = float(ds_data.get(max_min))
+            except Exception as exp:
+                raise Exception("Bad format: %s value "
+                                "(must be a float/int)" % max_min)
+
+
+def expand_dstemplate(datasource, dstemplate):
+    """ Get all datasources of a dstemplate with their default values
+
+    Return
+    :ds_dict: OrderedDict ds_name => ds_data
+
+    The returned dicts are shared between all services using the
+    dstemplate, they must not be modified
+    """
+    ds_list = datasource.get('DSTEMPLATE').get(dstemplate)
+    if ds_list is None:
+        raise Exception("DSTEMPLATE %s is empty" % dstemplate)
+
+    # Get DSs in the dstemplate
+    ds_list = ds_list.get('ds')
+    # The 2 following must be useless, but I will let it
+    # In case of the datasource files are not clean ...
+    if isinstance(ds_list, str):
+        # Handle if ds_list is a str and not a list.
+        ds_list = [ds_name.strip() for ds_name in ds_list.split(',')]
+    elif not isinstance(ds_list, list):
+        raise Exception("Bad format: DS %s in datasource files" % str(ds_list))
+
+    # Get default values from DATASOURCE root
+    the_datasource = datasource.get('DATASOURCE')
+
+    default_ds_type = the_datasource.get("ds_type", "TEXT")
+    default_ds_min_oid_value = the_datasource.get("ds_min_oid_value", None)
+
+    ds_dict = OrderedDict()
+    for ds_name in ds_list:
+        ds_data = the_datasource.get(ds_name)
+        if ds_data is None:
+            raise Exception("ds %s is missing in datasource filess" % ds_name)
+        # Don't modify the datasource
+        ds_data = ds_data.copy()
+
+        # Set default values
+        # If no ds name set, we use the ds key as name
+        # ie: `dot3StatsExcessiveCollisions`
+        ds_data.setdefault("ds_name", ds_name)
+        ds_data.setdefault("ds_type", default_ds_type)
+        ds_data.setdefault("ds_min_oid_value", default_ds_min_oid_value)
+        for name in ["ds_unit", ]:
+            ds_data.setdefault(name, "")
+        # Set default ds datas
+        for name in ["ds_calc",
+                     "ds_max_oid",
+                     "ds_min_oid",
+                     ]:
+            ds_data.setdefault(name, None)
+
+        # Add computed_value for max and min
+        compute_min_max_values(ds_data)
+
+        # Check if ds_oid is set
+        if "ds_oid" not in ds_data:
+            raise Exception("ds_oid is not defined in %s" % ds_name)
+
+        # add ds in ds list
+        ds_dict[ds_name] = ds_data
+
+    return ds_dict
+
+
+def expand_triggergroup(datasource, triggergroup):
+    """ Get all triggers of a triggergroup with their default values
+
+    Return
+    :triggers: dict trigger_name => trigger_data
+
+    The returned dicts are shared between all services using the
+    triggergroup, they must not be modified
+    """
+    triggers = {}
+    trigger_list = datasource.get('TRIGGERGROUP').get(triggergroup)
+    if trigger_list is None:
+        return triggers
+    # Check if it's a string, if yes we transform it into a list
+    if isinstance(trigger_list, str):
+        trigger_list = [trigger_list]
+    # Browse all triggers in the triggergroup
+    for trigger_name in trigger_list:
+        if 'TRIGGER' not in datasource:
+            raise Exception("TRIGGER section is not define in the "
+                            "datasource")
+        # Get trigger data
+        trigger_data = datasource.get('TRIGGER').get(trigger_name)
+        if trigger_data is None:
+            raise Exception("TRIGGER %s is not define in the "
+                            "datasource" % trigger_name)
+        # Don't modify the datasource
+        trigger_data = trigger_data.copy()
+        # Get critical trigger (list)
+        trigger_data.setdefault("critical", None)
+        # Get warning trigger (list)
+        trigger_data.setdefault("warning", None)
+        # Get default trigger (int)
+        try:
+            trigger_data.setdefault("default_status", int(datasource.get('TRIGGER').get("default_status", 3)))
+        except:
+            raise Exception("Bad format: default_status value "
+                            "(must be a float/int)")
+        # Add trigger in trigger list
+        triggers[trigger_name] = trigger_data
+    return triggers
+
+
+def dict_serialize(serv, mac_resol, datasource, ds_cache=None):
     """ Get serv, datasource
         And return the service serialized
+
+    ds_cache is a dict which keeps the expanded dstemplates and
+    triggergroups between calls. It must be emptied when the
+    datasource changes
     """
+    if ds_cache is None:
+        ds_cache = {}
     tmp_dict = {}
 
     # Comamnd processing
@@ -478,117 +643,40 @@ def dict_serialize(serv, mac_resol, datasource):
     if 'DSTEMPLATE' not in datasource:
         raise Exception("DSTEMPLATE section is missing in the "
                         "datasource files")
-    tmp_dict['ds'] = OrderedDict()
-
-    ds_list = datasource.get('DSTEMPLATE').get(tmp_dict['dstemplate'])
-    if ds_list is None:
-        raise Exception("DSTEMPLATE %s is empty" % tmp_dict['dstemplate'])
 
     # We don't want to lose the instance id collectd by old snmp requests
     # So we delete 'instance' entry in the data
     if tmp_dict.get('instance_name') is not None and tmp_dict.get('mapping') is not None:
         del tmp_dict['instance']
 
+    # Check the DATASOURCE section once
+    get_cached(ds_cache, ('DATASOURCE', ), validate_datasource, datasource)
     # Get DSs in the dstemplate
-    ds_list = ds_list.get('ds')
-    # The 2 following must be useless, but I will let it
-    # In case of the datasource files are not clean ...
-    if isinstance(ds_list, str):
-        # Handle if ds_list is a str and not a list.
-        ds_list = [ds_name.strip() for ds_name in ds_list.split(',')]
-    elif not isinstance(ds_list, list):
-        raise Exception("Bad format: DS %s in datasource files" % str(ds_list))
-
-    # Get default values from DATASOURCE root
-
-    the_datasource = datasource.get('DATASOURCE')
-
-    default_ds_type = the_datasource.get("ds_type", "TEXT")
-    default_ds_min_oid_value = the_datasource.get("ds_min_oid_value", None)
-
-    for key, value in the_datasource.items():
-        if isinstance(value, (str, unicode)):
-            if not REGEX_OID.match(value) and not REGEX_DS_ATTRIBUTE.match(key):
-                raise Exception("OID for %s isn't valid: %r" % (key, value))
-
-        if isinstance(value, dict):
-            if '-' in key:
-                raise Exception("Ds_name  %s isn't valid (contain -)" % key)
-
-    for ds_name in ds_list:
-        ds_data = the_datasource.get(ds_name)
-        if ds_data is None:
-            raise Exception("ds %s is missing in datasource filess" % ds_name)
-
-        # Set default values
-        # If no ds name set, we use the ds key as name
-        # ie: `dot3StatsExcessiveCollisions`
-        ds_data.setdefault("ds_name", ds_name)
-        ds_data.setdefault("ds_type", default_ds_type)
-        ds_data.setdefault("ds_min_oid_value", default_ds_min_oid_value)
-        for name in ["ds_unit", ]:
-            ds_data.setdefault(name, "")
-        # Set default ds datas
-        for name in ["ds_calc",
-                     "ds_max_oid",
-                     "ds_min_oid",
-                     ]:
-            ds_data.setdefault(name, None)
+    ds_dict = get_cached(ds_cache, ('DSTEMPLATE', tmp_dict['dstemplate']),
+                         expand_dstemplate, datasource, tmp_dict['dstemplate'])
+    tmp_dict['ds'] = OrderedDict(ds_dict)
 
+    for ds_name, value in dict_max.items():
+        if not value or ds_name not in tmp_dict['ds']:
+            continue
         # If we have 'maximise-datasources-value' for the current ds_name, we set ds_max_oid to None
         # And we set our max value to ds_max_oid_value
-        if dict_max.get(ds_name, None):
-            ds_data["ds_max_oid"] = None
-            ds_data['ds_max_oid_value'] = dict_max[ds_name]
-
-        # Add computed_value for max and min
-        for max_min in ['ds_max_oid_value', 'ds_min_oid_value']:
-            if ds_data.get(max_min) is not None:
-                try:
-                    ds_data[max_min + '_computed'] = float(ds_data.get(max_min))
-                except Exception as exp:
-                    raise Exception("Bad format: %s value "
-                                    "(must be a float/int)" % max_min)
-
-        # Check if ds_oid is set
-        if "ds_oid" not in ds_data:
-            raise Exception("ds_oid is not defined in %s" % ds_name)
-
-        # add ds in ds list
+        # The shared ds_data is copied, only this service gets the new value
+        ds_data = tmp_dict['ds'][ds_name].copy()
+        ds_data["ds_max_oid"] = None
+        ds_data['ds_max_oid_value'] = value
+        compute_min_max_values(ds_data)
         tmp_dict['ds'][ds_name] = ds_data
 
     # Prepare triggers
-    tmp_dict['triggers'] = {}
     if 'TRIGGERGROUP' not in datasource:
         raise Exception("TRIGGERGROUP section is missing in the datasource "
                         "files")
 
-    trigger_list = datasource.get('TRIGGERGROUP').get(tmp_dict['triggergroup'])
-    if trigger_list is not None:
-        # Check if it's a string, if yes we transform it into a list
-        if isinstance(trigger_list, str):
-            trigger_list = [trigger_list]
-        # Browse all triggers in the triggergroup
-        for trigger_name in trigger_list:
-            if 'TRIGGER' not in datasource:
-                raise Exception("TRIGGER section is not define in the "
-                                "datasource")
-            # Get trigger data
-            trigger_data = datasource.get('TRIGGER').get(trigger_name)
-            if trigger_data is None:
-                raise Exception("TRIGGER %s is not define in the "
-                                "datasource" % trigger_name)
-            # Get critical trigger (list)
-            trigger_data.setdefault("critical", None)
-            # Get warning trigger (list)
-            trigger_data.setdefault("warning", None)
-            # Get default trigger (int)
-            try:
-                trigger_data.setdefault("default_status", int(datasource.get('TRIGGER').get("default_status", 3)))
-            except:
-                raise Exception("Bad format: default_status value "
-                                "(must be a float/int)")
-            # Add trigger in trigger list
-            tmp_dict['triggers'][trigger_name] = trigger_data
+    tmp_dict['triggers'] = dict(get_cached(ds_cache,
+                                           ('TRIGGERGROUP', tmp_dict['triggergroup']),
+                                           expand_triggergroup,
+                                           datasource,
+                                           tmp_dict['triggergroup']))
 
     return tmp_dict
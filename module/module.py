@@ -27,9 +27,12 @@ Entry file for SNMP Booster module
 
 from shinken.log import logger
 
-from snmpbooster_arbiter import SnmpBoosterArbiter
-from snmpbooster_poller import SnmpBoosterPoller
-from snmpbooster_scheduler import SnmpBoosterScheduler
+
+# loaded_by => (module, class) of the SNMP Booster part of the daemon
+ROLE_CLASSES = {"arbiter": ("snmpbooster_arbiter", "SnmpBoosterArbiter"),
+                "scheduler": ("snmpbooster_scheduler", "SnmpBoosterScheduler"),
+                "poller": ("snmpbooster_poller", "SnmpBoosterPoller"),
+                }
 
 
 properties = {
@@ -42,6 +45,16 @@ properties = {
     }
 
 
+def get_role_class(loaded_by):
+    """ Import the class of a daemon (arbiter, scheduler or poller)
+    Each daemon only imports its part: pysnmp is only loaded by the
+    Poller, ConfigObj and the MacroResolver by the Arbiter
+    """
+    module_name, class_name = ROLE_CLASSES[loaded_by]
+    module = __import__(module_name, globals(), locals(), [class_name])
+    return getattr(module, class_name)
+
+
 def get_instance(mod_conf):
     """called by the plugin manager to get a poller"""
     logger.info("[SnmpBooster] [code 0101] Loading SNMP Booster module "
@@ -58,9 +71,7 @@ def get_instance(mod_conf):
                    "in %s" % str(mod_conf.properties['daemons']))
         logger.error(message)
         raise Exception(message)
-    # Get class name (arbiter, scheduler or poller)
-    class_name = "SnmpBooster%s" % mod_conf.loaded_by.capitalize()
     # Instance it
-    instance = globals()[class_name](mod_conf)
+    instance = get_role_class(mod_conf.loaded_by)(mod_conf)
     # Return it
     return instance
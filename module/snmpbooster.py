@@ -47,9 +47,27 @@ of SNMP Booster loaded in the Arbiter
 
 from shinken.basemodule import BaseModule
 from shinken.log import logger
-from shinken.util import to_int
-#from libs.dbclient import DBClient
-from libs.redisclient import DBClient
+from shinken.util import to_int, to_float
+
+from libs.metrics import start_metrics_server
+
+
+# db_backend parameter => module of libs which contains the DBClient
+DB_BACKENDS = {"redis": "redisclient",
+               "sharded": "shardedclient",
+               "mongodb": "dbclient",
+               "sqlite": "sqliteclient",
+               }
+
+
+def get_db_client_class(db_backend):
+    """ Import the DBClient class of a backend
+    Backend modules are only imported when used, so their dependencies
+    are optional
+    """
+    module = __import__("libs.%s" % DB_BACKENDS[db_backend],
+                        globals(), locals(), ["DBClient"])
+    return module.DBClient
 
 
 class SnmpBooster(BaseModule):
@@ -60,9 +78,26 @@ class SnmpBooster(BaseModule):
         BaseModule.__init__(self, mod_conf)
         self.version = "1.99.7"
         self.datasource_file = getattr(mod_conf, 'datasource', None)
+        self.datasource_cache = bool(to_int(getattr(mod_conf,
+                                                    'datasource_cache', 1)))
+        self.db_backend = getattr(mod_conf, 'db_backend', "redis")
         self.db_host = getattr(mod_conf, 'db_host', "127.0.0.1")
         self.db_port = to_int(getattr(mod_conf, 'db_port', 6379))
         self.db_name = getattr(mod_conf, 'db_name', 'booster_snmp')
+        # SQLite database file
+        self.db_path = getattr(mod_conf, 'db_path', None)
+        # Metrics HTTP server (0: disabled)
+        self.metrics_port = to_int(getattr(mod_conf, 'metrics_port', 0))
+        self.metrics_address = getattr(mod_conf, 'metrics_address',
+                                       "127.0.0.1")
+        # Redis connection pool
+        self.db_unix_socket = getattr(mod_conf, 'db_unix_socket', None)
+        self.db_pool_size = to_int(getattr(mod_conf, 'db_pool_size', 0))
+        self.db_socket_timeout = to_float(getattr(mod_conf,
+                                                  'db_socket_timeout', 5))
+        self.db_connect_timeout = to_float(getattr(mod_conf,
+                                                   'db_connect_timeout', 2))
+        self.db_keepalive = bool(to_int(getattr(mod_conf, 'db_keepalive', 0)))
         self.loaded_by = getattr(mod_conf, 'loaded_by', None)
         self.datasource = None
         self.db_client = None
@@ -84,8 +119,32 @@ class SnmpBooster(BaseModule):
 
         # Prepare database connection
         if self.loaded_by in ['arbiter', 'poller']:
-            self.db_client = DBClient(self.db_host, self.db_port, self.db_name)
+            if self.db_backend not in DB_BACKENDS:
+                logger.error("[SnmpBooster] [code 1103] Unknown db_backend: "
+                             "%s. Supported: %s" % (self.db_backend,
+                                                    ", ".join(DB_BACKENDS)))
+                self.i_am_dying = True
+                return
+            DBClient = get_db_client_class(self.db_backend)
+            if self.db_backend == "sqlite":
+                self.db_client = DBClient(db_path=self.db_path)
+            else:
+                self.db_client = DBClient(self.db_host, self.db_port, self.db_name,
+                                          unix_socket=self.db_unix_socket,
+                                          pool_size=self.db_pool_size or None,
+                                          socket_timeout=self.db_socket_timeout or None,
+                                          connect_timeout=self.db_connect_timeout or None,
+                                          keepalive=self.db_keepalive)
             # Connecting
             if not self.db_client.connect():
                 self.i_am_dying = True
                 return
+
+        # Pollers start the metrics server in their worker process
+        if self.loaded_by in ['arbiter', 'scheduler']:
+            self.start_metrics()
+
+    def start_metrics(self):
+        """ Start the HTTP server which exposes metrics """
+        if self.metrics_port > 0:
+            start_metrics_server(self.metrics_address, self.metrics_port)
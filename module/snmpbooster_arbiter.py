@@ -26,21 +26,22 @@ of SNMP Booster loaded in the Arbiter
 """
 
 
-import os
-import glob
+import time
 
 from shinken.macroresolver import MacroResolver
 from shinken.log import logger
 
-try:
-    from configobj import ConfigObj
-except ImportError, exp:
-    logger.error("[SnmpBooster] [code 0901] Import error. Maybe one of this "
-                 "module is missing: ConfigObj")
-    raise ImportError(exp)
-
 from snmpbooster import SnmpBooster
 from libs.utils import dict_serialize
+from libs.datasource import load_datasource
+from libs.metrics import Counter, Gauge
+
+
+SERVICES = Counter("snmpbooster_arbiter_services",
+                   "Services written in the database by the Arbiter",
+                   ("result", ))
+LATE_CONFIGURATION_TIME = Gauge("snmpbooster_arbiter_late_configuration_seconds",
+                                "Duration of the last database filling")
 
 
 class SnmpBoosterArbiter(SnmpBooster):
@@ -53,95 +54,50 @@ class SnmpBoosterArbiter(SnmpBooster):
 
         # Read datasource files
         # Config validation
-        current_file = None
+        # The compiled datasource is used if no ini file changed
         if not isinstance(self.datasource, dict):
-            try:
-                # Test if self.datasource_file, is file or directory
-                # if file
-                if os.path.isfile(self.datasource_file):
-                    self.datasource = ConfigObj(self.datasource_file,
-                                                interpolation='template')
-                    logger.info("[SnmpBooster] [code 0902] Reading input "
-                                "configuration file: "
-                                "%s" % self.datasource_file)
-
-                # if directory
-                elif os.path.isdir(self.datasource_file):
-                    if not self.datasource_file.endswith("/"):
-                        self.datasource_file += "/"
-                    files = glob.glob(os.path.join(self.datasource_file,
-                                                   'Default*.ini')
-                                      )
-                    for current_file in files:
-                        if self.datasource is None:
-                            self.datasource = ConfigObj(current_file,
-                                                        interpolation='template')
-                        else:
-                            ctemp = ConfigObj(current_file,
-                                              interpolation='template')
-                            self.datasource.merge(ctemp)
-                        logger.info("[SnmpBooster] [code 0903] Reading "
-                                    "input configuration file: "
-                                    "%s" % current_file)
-                else:
-                    # Normal error with scheduler and poller module
-                    # The configuration will be read in the database
-                    raise IOError("[SnmpBooster] File or folder not "
-                                  "found: %s" % self.datasource_file)
-
-            # raise if reading error
-            except Exception as exp:
-                if current_file is not None:
-                    error_message = ("[SnmpBooster] [code 0904] Datasource "
-                                     "error while reading or merging in %s: "
-                                     "`%s'" % (str(current_file), str(exp)))
-                else:
-                    error_message = ("[SnmpBooster] [code 0905] Datasource "
-                                     "error while reading or merging: "
-                                     "`%s'" % str(exp))
-                logger.error(error_message)
-                raise Exception(error_message)
-
-        # Convert datasource to dict
-        if isinstance(self.datasource, ConfigObj):
-            try:
-                self.datasource = self.datasource.dict()
-            except Exception as exp:
-                error_message = ("[SnmpBooster] [code 0906] Error during the "
-                                 "config conversion: %s" % (str(exp)))
-                logger.error(error_message)
-                raise Exception(error_message)
+            self.datasource = load_datasource(self.datasource_file,
+                                              self.datasource_cache)
 
     def hook_late_configuration(self, arb):
         """ Read config and fill database """
+        start_time = time.time()
         mac_resol = MacroResolver()
         mac_resol.init(arb.conf)
+        # Expanded dstemplates and triggergroups, shared by all services
+        # of this configuration
+        ds_cache = {}
         for serv in arb.conf.services:
             if serv.check_command.command.module_type == 'snmp_booster':
                 try:
                     # Serialize service
                     dict_serv = dict_serialize(serv,
                                                mac_resol,
-                                               self.datasource)
+                                               self.datasource,
+                                               ds_cache)
                 except Exception as exp:
                     msg = "[SnmpBooster] [code 0907] [%s,%s] %s" % (
                         serv.host.get_name(), serv.get_name(), exp)
                     logger.error(msg)
                     serv.configuration_errors.append(msg)
+                    SERVICES.labels("error").inc()
                     continue
 
                 # We want to make a diff between arbiter insert and poller insert. Some backend may need it.
                 try:
-                    self.db_client.update_service_init(dict_serv['host'],
-                                                       dict_serv['service'],
-                                                       dict_serv)
+                    _, error = self.db_client.update_service_init(dict_serv['host'],
+                                                                  dict_serv['service'],
+                                                                  dict_serv)
                 except Exception as exp:
                     logger.error("[SnmpBooster] [code 0909] [%s,%s] "
                                  "%s" % (dict_serv['host'],
                                          dict_serv['service'],
                                          str(exp)))
+                    SERVICES.labels("error").inc()
                     continue
+                SERVICES.labels("error" if error else "ok").inc()
 
+        LATE_CONFIGURATION_TIME.set(time.time() - start_time)
         logger.info("[SnmpBooster] [code 0908] Done parsing")
 
         # Disconnect from database
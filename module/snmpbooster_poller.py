@@ -26,25 +26,79 @@ of SNMP Booster loaded in the Poller
 """
 
 
+import re
 import signal
 import time
 import shlex
 
 
 from Queue import Empty, Queue
+from collections import OrderedDict
 import sys
 
 from datetime import datetime, timedelta
 
 from shinken.log import logger
-from shinken.util import to_int
+from shinken.util import to_int, to_float
 from pyasn1.type.univ import OctetString
 
 from snmpbooster import SnmpBooster
 from libs.utils import parse_args, compute_value
 from libs.result import set_output_and_status
-from libs.checks import check_snmp, check_cache
-from libs.snmpworker import SNMPWorker
+from libs.checks import check_snmp, check_cache, DB_LATENCY
+from libs.snmpworker import SNMPWorker, DEVICE_HEALTH
+from libs.metrics import Counter, Gauge, Histogram
+from libs.tracing import TRACER
+from libs.timerwheel import TimerWheel
+
+
+TASK_QUEUE_DEPTH = Gauge("snmpbooster_task_queue_depth",
+                         "SNMP tasks waiting for the SNMP worker")
+RESULT_QUEUE_DEPTH = Gauge("snmpbooster_result_queue_depth",
+                           "SNMP results waiting to be saved")
+CHECKS_ONGOING = Gauge("snmpbooster_checks_ongoing",
+                       "Checks received from the Poller and not finished")
+CHECKS = Counter("snmpbooster_checks",
+                 "Checks launched",
+                 ("type", ))
+CHECKS_DONE = Counter("snmpbooster_checks_done",
+                      "Checks returned to the Poller")
+COMPUTE_TIME = Histogram("snmpbooster_compute_seconds",
+                         "Time to compute collected values and outputs",
+                         ("stage", ))
+ADMISSIONS = Counter("snmpbooster_admissions",
+                     "Real checks admitted, deferred because the SNMP task "
+                     "queue is full, or shed (done as cache checks)",
+                     ("result", ))
+DEFERRED_CHECKS = Gauge("snmpbooster_deferred_checks",
+                        "Real checks waiting for room in the SNMP task queue")
+INFLIGHT_CACHE_CHECKS = Counter("snmpbooster_inflight_cache_checks",
+                                "Cache checks launched while a real check "
+                                "of the same host and interval is running",
+                                ("action", ))
+COMMAND_CACHE_SIZE = Gauge("snmpbooster_command_cache_size",
+                           "Parsed check commands kept by the Poller")
+COMMAND_CACHE_LOOKUPS = Counter("snmpbooster_command_cache_lookups",
+                                "Check commands parsed (miss) or read from "
+                                "the cache (hit)",
+                                ("result", ))
+
+# Deadline of checks without SNMP requests (seconds)
+CHECK_TIMEOUT = 3600
+# Time added to the SNMP timeouts of a real check for the queues and
+# the database (seconds)
+DEADLINE_MARGIN = 5
+
+# What cache checks do when a real check of the same host and
+# check_interval is running
+# none: read the database now
+# wait: wait for the real check result (up to inflight_timeout)
+# stale: return the database data now, flagged as stale
+INFLIGHT_POLICIES = ("none", "wait", "stale")
+
+# Options added by the Scheduler at the end of the command of real
+# checks: -I (other check intervals) and -r (real check)
+REGEX_REAL_CHECK_OPTIONS = re.compile(r"( -I ([0-9,]+))?( -r)?$")
 
 
 class SnmpBoosterPoller(SnmpBooster):
@@ -54,10 +108,55 @@ class SnmpBoosterPoller(SnmpBooster):
     def __init__(self, mod_conf):
         SnmpBooster.__init__(self, mod_conf)
         self.max_prepared_tasks = to_int(getattr(mod_conf, 'max_prepared_tasks', 50))
+        # Real checks wait while the SNMP task queue has more than
+        # max_queued_tasks tasks (0: no limit)
+        self.max_queued_tasks = to_int(getattr(mod_conf, 'max_queued_tasks', 1000))
+        # Real checks waiting more than admission_timeout seconds are
+        # done as cache checks
+        self.admission_timeout = to_int(getattr(mod_conf, 'admission_timeout', 60))
+        self.deferred_checks = 0
+        # Deadlines of launched checks
+        self.deadlines = TimerWheel(now=time.time())
+        # Devices are down after N consecutive timeouts (0: disabled)
+        DEVICE_HEALTH.configure(to_int(getattr(mod_conf, 'device_down_timeouts', 3)),
+                                to_int(getattr(mod_conf, 'device_probe_interval', 10)))
+        # Merge get requests of the same device
+        self.request_coalescing = bool(to_int(getattr(mod_conf,
+                                                      'request_coalescing', 1)))
+        # Parsed arguments of the last check commands (0: disabled)
+        # command => args
+        self.command_cache_size = to_int(getattr(mod_conf,
+                                                 'command_cache_size', 10000))
+        self.parsed_commands = OrderedDict()
+        COMMAND_CACHE_SIZE.set_function(lambda: len(self.parsed_commands))
         self.checks_done = 0
         self.task_queue = Queue()
         self.result_queue = Queue()
         self.last_checks_counted = 0
+        # Delete services not checked since N hours (0: disabled)
+        self.max_service_age = to_int(getattr(mod_conf, 'max_service_age', 0))
+        self.last_clear_old = time.time()
+        # Real checks running: (host, check_interval) => check
+        self.inflight = {}
+        # Cache checks waiting for a real check:
+        # (host, check_interval) => list of (check, args, deadline)
+        self.inflight_waiters = {}
+        self.inflight_policy = getattr(mod_conf, 'inflight_policy', "none")
+        if self.inflight_policy not in INFLIGHT_POLICIES:
+            logger.error("[SnmpBooster] [code 1010] Unknown inflight_policy: "
+                         "%s. Supported: %s. Using "
+                         "none" % (self.inflight_policy,
+                                   ", ".join(INFLIGHT_POLICIES)))
+            self.inflight_policy = "none"
+        self.inflight_timeout = to_float(getattr(mod_conf,
+                                                 'inflight_timeout', 10))
+        # Trace a fraction of checks (0: disabled) and all checks of
+        # trace_hosts
+        TRACER.configure(to_float(getattr(mod_conf, 'trace_sample_rate', 0)),
+                         to_int(getattr(mod_conf, 'trace_buffer_size', 1000)),
+                         [host.strip() for host
+                          in getattr(mod_conf, 'trace_hosts', "").split(",")
+                          if host.strip()])
 
     def get_new_checks(self):
         """ Get new checks if less than nb_checks_max
@@ -82,54 +181,259 @@ class SnmpBoosterPoller(SnmpBooster):
         """ Launch checks that are in status
             REF: doc/shinken-action-queues.png (4)
         """
-        for chk in self.checks:
+        queued = [chk for chk in self.checks if chk.status == 'queue']
+        if self.max_queued_tasks > 0:
+            # The most overdue checks get the room in the task queue first
+            queued.sort(key=lambda chk: getattr(chk, 't_to_go', 0))
+        self.deferred_checks = 0
+        for chk in queued:
             now = time.time()
             if chk.status == 'queue':
                 # Ok we launch it
                 chk.status = 'launched'
                 chk.check_time = now
 
-                # Want the args of the commands so we parse it like a shell
-                # shlex want str only
-                clean_command = shlex.split(chk.command.encode('utf8',
-                                                               'ignore'))
-                # If the command seems good
-                if len(clean_command) > 1:
-                    # we do not want the first member, check_snmp thing
-                    try:
-                        args = parse_args(clean_command[1:])
-                    except Exception as exp:
-                        # if we get a parsing error
-                        error_message = ("[SnmpBooster] [code 1001]"
-                                         "Command line { %s } parsing error: "
-                                         "%s" % (chk.command.encode('utf8',
-                                                                    'ignore'),
-                                                 str(exp)))
-                        logger.error(error_message)
-                        # Check is now marked as done
-                        chk.status = 'done'
-                        # Get exit code
-                        chk.exit_status = 3
-                        chk.get_outputs("Command line parsing error: `%s' - "
-                                        "Please verify your check "
-                                        "command" % str(exp),
-                                        8012)
-                        # Get execution time
-                        chk.execution_time = 0
-
+                # Want the args of the commands (parsed once by command)
+                try:
+                    parse_start = time.time()
+                    args = self.parse_command(chk.command.encode('utf8',
+                                                                 'ignore'))
+                except Exception as exp:
+                    # if we get a parsing error
+                    error_message = ("[SnmpBooster] [code 1001]"
+                                     "Command line { %s } parsing error: "
+                                     "%s" % (chk.command.encode('utf8',
+                                                                'ignore'),
+                                             str(exp)))
+                    logger.error(error_message)
+                    # Check is now marked as done
+                    chk.status = 'done'
+                    # Get exit code
+                    chk.exit_status = 3
+                    chk.get_outputs("Command line parsing error: `%s' - "
+                                    "Please verify your check "
+                                    "command" % str(exp),
+                                    8012)
+                    # Get execution time
+                    chk.execution_time = 0
+
+                    continue
+
+                # Admission control
+                real_check = args.get('real_check', False)
+                if real_check and self.max_queued_tasks > 0:
+                    real_check = self.admit_real_check(chk, now)
+                    if real_check is None:
+                        # Try again in the next loop
+                        chk.status = 'queue'
                         continue
 
+                # Checks of down devices don't send requests
+                device_down = real_check and DEVICE_HEALTH.is_down(args.get('address'))
+                if device_down:
+                    real_check = False
+
                 # Ok we are good, we go on
-                if args.get('real_check', False):
+                check_type = "real" if real_check else "cache"
+                CHECKS.labels(check_type).inc()
+                # Sampled checks record their stages
+                trace = TRACER.start_trace(args.get('host'),
+                                           args.get('service'),
+                                           check_type,
+                                           now)
+                if trace is not None:
+                    trace.add_span("parse_args", parse_start)
+                if real_check:
                     # Make a SNMP check
-                    check_snmp(chk, args, self.db_client,
-                               self.task_queue, self.result_queue)
+                    nb_requests = check_snmp(chk, args, self.db_client,
+                                             self.task_queue, self.result_queue,
+                                             trace)
+                    self.track_real_check(chk, args)
+                    self.set_deadline(chk, now, nb_requests)
                     #logger.debug("CHECK SNMP %(host)s:%(service)s" % args)
                 else:
                     # Make fake check (get datas from DB)
-                    check_cache(chk, args, self.db_client)
+                    current_service = check_cache(chk, args, self.db_client, trace)
+                    if device_down:
+                        # Data (and errors) of the last requests
+                        chk.result['device_down'] = True
+                    elif args.get('real_check', False):
+                        # Shed real check
+                        chk.result['stale'] = True
+                    elif current_service is not None and self.inflight:
+                        self.handle_inflight(chk, args, current_service, now)
+                    self.set_deadline(chk, now)
                     #logger.debug("CHECK cache %(host)s:%(service)s" % args)
 
+    def parse_command(self, command):
+        """ Return the arguments of a check command
+
+        The command of a service is the same at each check, except the
+        options added to real checks by the Scheduler (-I and -r): the
+        arguments of the command without them are kept in a LRU cache
+        """
+        match = REGEX_REAL_CHECK_OPTIONS.search(command)
+        key = command[:match.start()]
+        args = self.parsed_commands.pop(key, None)
+        if args is None:
+            COMMAND_CACHE_LOOKUPS.labels("miss").inc()
+            # Parse it like a shell (shlex want str only), without the
+            # first member, check_snmp thing
+            args = parse_args(shlex.split(key)[1:])
+            if self.command_cache_size > 0:
+                if len(self.parsed_commands) >= self.command_cache_size:
+                    # Forget the least recently used command
+                    self.parsed_commands.popitem(last=False)
+                # Most recently used last
+                self.parsed_commands[key] = args
+        else:
+            COMMAND_CACHE_LOOKUPS.labels("hit").inc()
+            # Most recently used last
+            self.parsed_commands[key] = args
+        # The cached args are shared: give a copy
+        args = dict(args)
+        if match.group(2):
+            args['with_intervals'] = [int(interval) for interval
+                                      in match.group(2).split(',')]
+        if match.group(3):
+            args['real_check'] = True
+        return args
+
+    def set_deadline(self, chk, now, nb_requests=None):
+        """ Add the deadline of a launched check in the timing wheel
+        A real check can't last more than its SNMP timeouts with all
+        retries for each request, counted from the dispatch of its
+        requests by the SNMP worker (see check_deadline)
+        """
+        timeout = CHECK_TIMEOUT
+        db_data = getattr(chk, "result", {}).get('db_data')
+        if nb_requests and db_data is not None and chk.result.get('state') == 'sent':
+            timeout = (to_float(db_data.get('timeout', 5)) *
+                       (to_int(db_data.get('retry', 1)) + 1) *
+                       nb_requests + DEADLINE_MARGIN)
+            chk.result['deadline_budget'] = timeout
+        chk.deadline = self.deadlines.add(now + timeout, chk)
+
+    def check_deadline(self, chk, now):
+        """ Return True if a check which reached its deadline timed out
+        The time spent by the requests of a real check in the task
+        queue is not counted: while a request waits, or if the last one
+        was dispatched less than the budget ago, the deadline is moved
+        """
+        result = getattr(chk, "result", {})
+        budget = result.get('deadline_budget')
+        if budget is None or now > chk.check_time + CHECK_TIMEOUT:
+            return True
+        dispatched = [task.get('dispatched_time')
+                      for task in result.get('tasks', [])]
+        if None in dispatched:
+            # Still in the task queue
+            deadline = now + budget
+        else:
+            deadline = max(dispatched) + budget
+        if deadline <= now:
+            return True
+        chk.deadline = self.deadlines.add(deadline, chk)
+        return False
+
+    def admit_real_check(self, chk, now):
+        """ Admission control of a real check
+
+        Return
+        * True: the check can send SNMP requests
+        * None: the task queue is full, the check waits
+        * False: the check waited more than admission_timeout, it is
+          done as a cache check
+        """
+        deferred_since = getattr(chk, "deferred_since", None)
+        if self.task_queue.qsize() < self.max_queued_tasks:
+            ADMISSIONS.labels("admitted").inc()
+            return True
+        if deferred_since is None:
+            chk.deferred_since = deferred_since = now
+            ADMISSIONS.labels("deferred").inc()
+        if self.admission_timeout > 0 and now > deferred_since + self.admission_timeout:
+            ADMISSIONS.labels("shed").inc()
+            return False
+        self.deferred_checks += 1
+        return None
+
+    def track_real_check(self, chk, args):
+        """ Remember the real check running for its host and check_interval
+        (and the intervals it polls with the -I option)
+        """
+        db_data = getattr(chk, "result", {}).get('db_data')
+        if db_data is None or chk.result.get('state') != 'sent':
+            # Service not found, nothing is sent
+            return
+        chk.inflight_keys = [(db_data.get('host'), interval)
+                             for interval in [db_data.get('check_interval')] +
+                             args.get('with_intervals', [])]
+        for key in chk.inflight_keys:
+            self.inflight[key] = chk
+
+    def handle_inflight(self, chk, args, current_service, now):
+        """ Apply inflight_policy to a cache check whose host and
+        check_interval have a real check running
+        """
+        key = (args.get('host'), current_service.get('check_interval'))
+        if key not in self.inflight or self.inflight_policy == "none":
+            return
+        if self.inflight_policy == "stale":
+            # Return the database data now
+            chk.result['stale'] = True
+            INFLIGHT_CACHE_CHECKS.labels("stale").inc()
+        else:
+            # The check is finished when the real check is
+            chk.result['state'] = 'waiting'
+            self.inflight_waiters.setdefault(key, []).append((chk, args,
+                                                              now + self.inflight_timeout))
+            INFLIGHT_CACHE_CHECKS.labels("wait").inc()
+
+    def release_real_check(self, chk):
+        """ The real check is finished: waiting cache checks read the
+        new data in the database
+        """
+        keys = getattr(chk, "inflight_keys", None)
+        if keys is None:
+            return
+        del chk.inflight_keys
+        waiters = []
+        for key in keys:
+            if self.inflight.get(key) is chk:
+                del self.inflight[key]
+            waiters.extend(self.inflight_waiters.pop(key, []))
+        if not waiters:
+            return
+        # Save collected data before the waiting checks read it
+        self.save_results()
+        for waiter, args, _ in waiters:
+            trace = waiter.result.get('trace')
+            wait_start = waiter.result['start_time']
+            check_cache(waiter, args, self.db_client, trace)
+            # The execution time includes the wait
+            waiter.result['start_time'] = wait_start
+            if trace is not None:
+                trace.add_span("inflight_wait", wait_start)
+
+    def expire_inflight_waiters(self, now):
+        """ Cache checks waiting after their deadline return the
+        database data read when they were launched, flagged as stale
+        """
+        for key, waiters in self.inflight_waiters.items():
+            expired = [waiter for waiter in waiters if now > waiter[2]]
+            if not expired:
+                continue
+            for chk, _, _ in expired:
+                chk.result['state'] = 'received'
+                chk.result['stale'] = True
+            INFLIGHT_CACHE_CHECKS.labels("expired").inc(len(expired))
+            if len(expired) == len(waiters):
+                del self.inflight_waiters[key]
+            else:
+                self.inflight_waiters[key] = [waiter for waiter in waiters
+                                              if now <= waiter[2]]
+
     # Check the status of checks
     # if done, return message finished :)
     # REF: doc/shinken-action-queues.png (5)
@@ -145,27 +449,32 @@ class SnmpBoosterPoller(SnmpBooster):
         if now > prev_log + 5:
             logger.info("%s checks ongoing.." % len(self.checks))
             self.last_checks_counted = now
-        # First look for checks in timeout
-        for chk in self.checks:
-            if now > chk.check_time + 3600:
-                logger.warning("check timeout: %s" % chk.command)
-                chk.get_outputs("check timedout", 8012)
-                chk.status = "done"
-                chk.exit_status = 3
-                chk.execution_time = now - chk.check_time
-            if not hasattr(chk, "result"):
+        # Waiting cache checks can't wait more than inflight_timeout
+        if self.inflight_waiters:
+            self.expire_inflight_waiters(now)
+        # First look for checks which reached their deadline
+        # (finished checks cancel their deadline)
+        for chk in self.deadlines.advance(now):
+            if chk.status != 'launched' or not self.check_deadline(chk, now):
                 continue
-            if chk.status == 'launched' and chk.result.get('state') != 'received':
-                pass
-                # TODO compore check.result['execution_time'] > timeout
-                # chk.con.look_for_timeout()
+            logger.warning("[SnmpBooster] [code 1011] Check timed out after "
+                           "%d seconds: %s" % (now - chk.check_time,
+                                               chk.command))
+            chk.get_outputs("check timedout", 8012)
+            chk.status = "done"
+            chk.exit_status = 3
+            chk.execution_time = now - chk.check_time
 
         # Now we look for finished checks
         for chk in self.checks:
             # First manage check in error, bad formed
             if chk.status == 'done':
-                if hasattr(chk, "result"):
-                    del chk.result
+                self.release_real_check(chk)
+                # Keep the trace of checks in error or timed out
+                trace = getattr(chk, "result", {}).get('trace')
+                if trace is not None:
+                    TRACER.finish_trace(trace)
+                self.detach_check(chk)
                 to_del.append(chk)
                 try:
                     self.returns_queue.put(chk)
@@ -179,10 +488,21 @@ class SnmpBoosterPoller(SnmpBooster):
             if not hasattr(chk, "result"):
                 continue
             if chk.status == 'launched' and chk.result['state'] == 'received':
+                if 'tasks' in chk.result and not self.result_queue.empty():
+                    # A real check gives the values it collected
+                    self.save_results()
+                # Waiting cache checks get the new data
+                self.release_real_check(chk)
                 result = chk.result
+                trace = result.get('trace')
+                output_start = time.time()
                 # Format result
                 # Launch trigger
-                set_output_and_status(result)
+                with COMPUTE_TIME.labels("output").time():
+                    set_output_and_status(result)
+                if trace is not None:
+                    trace.add_span("set_output_and_status", output_start)
+                    TRACER.finish_trace(trace)
                 # Set status
                 chk.status = 'done'
                 # Get exit code
@@ -194,8 +514,7 @@ class SnmpBoosterPoller(SnmpBooster):
                 chk.execution_time = result.get('execution_time', 0.0)
 
                 # unlink our object from the original check
-                if hasattr(chk, 'result'):
-                    del chk.result
+                self.detach_check(chk)
 
                 # and set this check for deleting
                 # and try to send it
@@ -213,53 +532,69 @@ class SnmpBoosterPoller(SnmpBooster):
             self.checks.remove(chk)
             # Count checks done
             self.checks_done += 1
+        CHECKS_DONE.inc(len(to_del))
+
+    def detach_check(self, chk):
+        """ Remove what the module added to a finished check
+        The check is sent to the Poller: its deadline timer (which
+        references the check), its result and the admission and in-flight
+        data must not be pickled with it
+        """
+        self.deadlines.cancel(getattr(chk, "deadline", None))
+        for attr in ("result", "deadline", "deferred_since", "inflight_keys"):
+            if hasattr(chk, attr):
+                delattr(chk, attr)
 
     def save_results(self):
         """ Save results to database """
+        # All results are written in one request
+        to_save = []
+        traces = []
         while not self.result_queue.empty():
-            results = self.result_queue.get()
+            results, service_result = self.result_queue.get()
+            trace = service_result.get('trace')
+            db_data = service_result.get('db_data')
+            compute_start = time.time()
+            if trace is not None:
+                traces.append((trace, compute_start))
             for result in results.values():
                 # Check error
-                snmp_error = result.get('error')
-                # Get key from task
-                key = result.get('key')
+                snmp_error = result.error
                 if snmp_error is None:
                     # We don't got a SNMP error
                     # Clean raw_value:
-                    if result.get('type') in ['DERIVE', 'GAUGE', 'COUNTER']:
-                        if isinstance(result.get('value'), OctetString):
-                            result['value'] = raw_value = float(str(result.get('value')))
+                    if result.type in ['DERIVE', 'GAUGE', 'COUNTER']:
+                        if isinstance(result.value, OctetString):
+                            result.value = raw_value = float(str(result.value))
                         else:
-                            result['value'] = raw_value = float(result.get('value'))
-                    elif result.get('type') in ['DERIVE64', 'COUNTER64']:
-                        result['value'] = raw_value = float(result.get('value'))
-                    elif result.get('type') in ['TEXT', 'STRING']:
-                        result['value'] = raw_value = str(result.get('value'))
+                            result.value = raw_value = float(result.value)
+                    elif result.type in ['DERIVE64', 'COUNTER64']:
+                        result.value = raw_value = float(result.value)
+                    elif result.type in ['TEXT', 'STRING']:
+                        result.value = raw_value = str(result.value)
                     else:
                         logger.error("[SnmpBooster] [code 1004] [%s, %s] "
                                      "Value type is not in 'TEXT', 'STRING', "
                                      "'DERIVE', 'GAUGE', 'COUNTER', 'DERIVE64'"
-                                     ", 'COUNTER64'" % (key.get('host'),
-                                                        key.get('service'),
+                                     ", 'COUNTER64'" % (result.host,
+                                                        result.service,
                                                         ))
                         continue
                     # Compute value before saving
-                    if key.get('oid_type') == 'ds_oid':
+                    if result.oid_type == 'ds_oid':
                         # add max value
-                        result['ds_max'] = None
-                        if results.get(result['ds_max_oid']) is not None:
-                            result['ds_max'] = results.get(result['ds_max_oid']).get('value')
+                        if results.get(result.ds_max_oid) is not None:
+                            result.ds_max = results.get(result.ds_max_oid).value
                         # add min value
-                        result['ds_min'] = None
-                        if results.get(result['ds_min_oid']) is not None:
-                            result['ds_min'] = results.get(result['ds_min_oid']).get('value')
+                        if results.get(result.ds_min_oid) is not None:
+                            result.ds_min = results.get(result.ds_min_oid).value
                         try:
                             value = compute_value(result)
                         except Exception as exp:
                             logger.warning("[SnmpBooster] [code 1005]"
                                            " [%s, %s] "
-                                           "%s" % (key.get('host'),
-                                                   key.get('service'),
+                                           "%s" % (result.host,
+                                                   result.service,
                                                    str(exp)))
                             value = None
                     else:
@@ -273,21 +608,57 @@ class SnmpBoosterPoller(SnmpBooster):
                     value = None
                 # Save to database
                 new_data = {"ds": {} }
-                for ds_name in key.get('ds_names'):
-
-                    new_data["ds"][ds_name] = {}
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_last"] = result.get('value_last')
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value"] = raw_value
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_computed"] = value
-                    new_data["ds"][ds_name][key.get('oid_type') + "_value_computed_last"] = result.get('value_last_computed')
-                    new_data["ds"][ds_name]["error"] = snmp_error
-
-                new_data["check_time"] = result.get('check_time')
-                new_data["check_time_last"] = result.get('check_time_last')
-
-                self.db_client.update_service(key.get('host'), key.get('service'), new_data)
+                for ds_name in result.ds_names:
+                    new_data["ds"][ds_name] = {result.oid_type + "_value_last": result.value_last,
+                                               result.oid_type + "_value": raw_value,
+                                               result.oid_type + "_value_computed": value,
+                                               result.oid_type + "_value_computed_last": result.value_last_computed,
+                                               "error": snmp_error,
+                                               }
+
+                new_data["check_time"] = result.check_time
+                new_data["check_time_last"] = result.check_time_last
+
+                to_save.append((result.host, result.service, new_data))
+                # The real check gives the data just collected
+                if (db_data is not None
+                        and result.host == service_result.get('host')
+                        and result.service == service_result.get('service')):
+                    for ds_name, ds_data in new_data["ds"].items():
+                        db_data['ds'].setdefault(ds_name, {}).update(ds_data)
+                    db_data['check_time'] = new_data["check_time"]
+                    db_data['check_time_last'] = new_data["check_time_last"]
+            COMPUTE_TIME.labels("values").observe(time.time() - compute_start)
             # Remove task from queue
             self.result_queue.task_done()
+        if to_save:
+            with DB_LATENCY.labels("update_services").time():
+                self.db_client.update_services(to_save)
+        # All results of the loop are saved together
+        for trace, compute_start in traces:
+            trace.add_span("save_results", compute_start,
+                           results=len(to_save))
+
+    def clear_old_services(self):
+        """ Delete services which are not checked anymore
+        It uses the check_time index, so it can run on large databases
+        """
+        if self.max_service_age <= 0:
+            return
+        now = time.time()
+        # Run it once per hour
+        if now < self.last_clear_old + 3600:
+            return
+        self.last_clear_old = now
+        try:
+            nb_del = self.db_client.delete_old_services(self.max_service_age * 3600)
+        except Exception as exp:
+            logger.error("[SnmpBooster] [code 1008] Can not delete old "
+                         "services: %s" % str(exp))
+            return
+        if nb_del > 0:
+            logger.info("[SnmpBooster] [code 1009] %d old service(s) "
+                        "deleted" % nb_del)
 
     # id = id of the worker
     # master_slave_queue = Global Queue Master->Slave
@@ -305,9 +676,17 @@ class SnmpBoosterPoller(SnmpBooster):
         self.returns_queue = returns_queue
         self.master_slave_queue = master_slave_queue
         self.t_each_loop = time.time()
-        self.snmpworker = SNMPWorker(self.task_queue, self.max_prepared_tasks)
+        self.snmpworker = SNMPWorker(self.task_queue, self.max_prepared_tasks,
+                                     self.request_coalescing)
         self.snmpworker.start()
 
+        # Gauges read when metrics are requested
+        TASK_QUEUE_DEPTH.set_function(self.task_queue.qsize)
+        RESULT_QUEUE_DEPTH.set_function(self.result_queue.qsize)
+        CHECKS_ONGOING.set_function(lambda: len(self.checks))
+        DEFERRED_CHECKS.set_function(lambda: self.deferred_checks)
+        self.start_metrics()
+
         dt_start = datetime.now()
         dt_mid = dt_start.replace(hour=12, minute=0, second=0, microsecond=0)
         if dt_mid < dt_start:
@@ -323,7 +702,9 @@ class SnmpBoosterPoller(SnmpBooster):
                 # The snmpworker seems down ...
                 # We respawn one
                 self.snmpworker.join()
-                self.snmpworker = SNMPWorker(self.task_queue, self.max_prepared_tasks)
+                self.snmpworker = SNMPWorker(self.task_queue,
+                                             self.max_prepared_tasks,
+                                             self.request_coalescing)
                 # and start it
                 self.snmpworker.start()
 
@@ -338,6 +719,8 @@ class SnmpBoosterPoller(SnmpBooster):
             self.save_results()
             # Prepare checks output
             self.manage_finished_checks()
+            # Delete services not checked since max_service_age
+            self.clear_old_services()
 
             # Now get order from master
             try:
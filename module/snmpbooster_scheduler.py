@@ -26,7 +26,37 @@ of SNMP Booster loaded in the Scheduler
 """
 
 
+
+import sys
+import time
+from collections import namedtuple
+
+from shinken.action import Action
+from shinken.log import logger
+from shinken.util import to_int
+
 from snmpbooster import SnmpBooster
+from libs.metrics import Counter, Gauge
+
+
+ELECTIONS = Gauge("snmpbooster_scheduler_elections",
+                  "Host/interval with an elected (real) check")
+ELECTION_MEMORY = Gauge("snmpbooster_scheduler_election_memory_bytes",
+                        "Approximate size of the election state")
+ELECTED_CHECKS = Counter("snmpbooster_scheduler_checks",
+                         "Checks set as real or cache checks",
+                         ("type", ))
+
+
+# Election state of a (host, interval)
+# t_to_go: time of the last elected (real) check
+# check_id: id of the service of the last elected check
+# freq: interval in seconds
+# slot: second of the interval used by real checks
+# weight: load added by the (host, interval) on its slot
+# last_seen: last time we saw a check of this (host, interval)
+Election = namedtuple("Election", ['t_to_go', 'check_id', 'freq',
+                                   'slot', 'weight', 'last_seen'])
 
 
 class SnmpBoosterScheduler(SnmpBooster):
@@ -35,8 +65,44 @@ class SnmpBoosterScheduler(SnmpBooster):
     """
     def __init__(self, mod_conf):
         SnmpBooster.__init__(self, mod_conf)
-        self.last_check_mapping = {}
-        self.offset_mapping = {}
+        # (host, interval) => Election
+        self.elections = {}
+        # Number of real checks for each second of an interval
+        # freq => [load of second 0, load of second 1, ...]
+        self.slot_load = {}
+        # Weight a (host, interval) by its number of services
+        self.weighted_spreading = bool(to_int(getattr(mod_conf,
+                                                      'weighted_spreading',
+                                                      0)))
+        # Log slot distribution every slot_stats_interval seconds
+        self.slot_stats_interval = to_int(getattr(mod_conf,
+                                                  'slot_stats_interval',
+                                                  300))
+        self.last_slot_stats = time.time()
+        # Forget a (host, interval) not seen since election_expiry intervals
+        self.election_expiry = to_int(getattr(mod_conf,
+                                              'election_expiry', 3))
+        self.last_prune = time.time()
+        # Align real checks of the intervals of a host which are
+        # multiples of each other, so they share SNMP requests
+        self.harmonic_alignment = bool(to_int(getattr(mod_conf,
+                                                      'harmonic_alignment',
+                                                      0)))
+        # Intervals of each host in the election state
+        # host => set of intervals
+        self.host_intervals = {}
+        # Scheduler configuration used to build the election state
+        self.sched_conf = None
+        ELECTIONS.set_function(lambda: len(self.elections))
+        ELECTION_MEMORY.set_function(self.get_memory_usage)
+        # Checks ids are given by the Action.id counter, so the checks
+        # created since the last tick are the ones with an id greater
+        # or equal to this one
+        self.next_check_id = None
+        # Scheduled checks already seen, with their t_to_go after the
+        # election: they are seen again if the Scheduler moves them
+        # check id => (check, t_to_go)
+        self.seen_checks = {}
 
     @staticmethod
     def get_frequence(chk):
@@ -49,22 +115,225 @@ class SnmpBoosterScheduler(SnmpBooster):
             return chk.ref.retry_interval
 
     @staticmethod
-    def set_true_check(check, real=False):
-        """ Add -r option to the command line """
+    def get_weight(chk, serv_interval):
+        """ Return the number of snmp_booster services of the host
+        with the same interval
+        """
+        weight = len([serv for serv in chk.ref.host.services
+                      if serv.check_command.command.module_type == 'snmp_booster'
+                      and serv.check_interval == serv_interval])
+        return max(weight, 1)
+
+    def get_slot(self, freq, weight, base=0, step=1):
+        """ Get the least loaded second of the interval for
+        a new (host, interval)
+        Only seconds base, base + step, base + 2 * step, ... are used
+        """
+        loads = self.slot_load.setdefault(freq, [0] * freq)
+        slot = min(xrange(base % step, freq, step), key=loads.__getitem__)
+        loads[slot] += weight
+        return slot
+
+    def get_aligned_slots(self, host, freq):
+        """ Return (base, step) of the seconds of a new (host, interval)
+        which are aligned with the host intervals multiple or divisor
+        of freq
+        """
+        multiples = []
+        divisors = []
+        for interval in self.host_intervals.get(host, ()):
+            election = self.elections.get((host, interval))
+            if election is None or election.freq == freq:
+                continue
+            if election.freq % freq == 0:
+                multiples.append(election)
+            elif freq % election.freq == 0:
+                divisors.append(election)
+        if multiples:
+            # Only one second of freq is aligned with the multiple
+            election = min(multiples, key=lambda e: e.freq)
+            return election.slot % freq, freq
+        if divisors:
+            # One second out of election.freq
+            election = max(divisors, key=lambda e: e.freq)
+            return election.slot, election.freq
+        return 0, 1
+
+    @staticmethod
+    def is_aligned(small, big):
+        """ Are real checks of the big interval done at the same time
+        as real checks of the small one ?
+        """
+        return (small.freq < big.freq and big.freq % small.freq == 0
+                and (big.slot - small.slot) % small.freq == 0)
+
+    def get_covered_intervals(self, key, t_to_go):
+        """ Return (covered, intervals)
+        covered: a smaller interval of the host is aligned with this
+        one, its real check gets our services
+        intervals: bigger intervals of the host with a real check at
+        t_to_go, which our real check gets
+        """
+        host, serv_interval = key
+        election = self.elections[key]
+        covered = False
+        intervals = []
+        for interval in self.host_intervals.get(host, ()):
+            other = self.elections.get((host, interval))
+            if other is None or interval == serv_interval:
+                continue
+            if self.is_aligned(other, election):
+                covered = True
+            elif self.is_aligned(election, other) and \
+                    (int(round(t_to_go)) - other.slot) % other.freq == 0:
+                intervals.append(interval)
+        return covered, sorted(intervals)
+
+    def add_election(self, key, election):
+        """ Add a new (host, interval) to the election state """
+        self.elections[key] = election
+        self.host_intervals.setdefault(key[0], set()).add(key[1])
+
+    def remove_election(self, key):
+        """ Remove a (host, interval) from the election state """
+        election = self.elections.pop(key)
+        intervals = self.host_intervals.get(key[0])
+        if intervals is not None:
+            intervals.discard(key[1])
+            if not intervals:
+                del self.host_intervals[key[0]]
+        return election
+
+    def release_slot(self, election):
+        """ Remove the load of a (host, interval) from its slot """
+        loads = self.slot_load.get(election.freq)
+        if loads is None:
+            return
+        loads[election.slot] -= election.weight
+        if not any(loads):
+            # No more (host, interval) with this interval
+            del self.slot_load[election.freq]
+
+    def prune_elections(self, now):
+        """ Forget (host, interval) not seen since election_expiry
+        intervals (host removed, SOFT/HARD interval switch, ...)
+        """
+        expired = [key for key, election in self.elections.items()
+                   if now > election.last_seen + self.election_expiry * election.freq]
+        for key in expired:
+            self.release_slot(self.remove_election(key))
+        if expired:
+            logger.info("[SnmpBooster] [code 1403] %d expired host/interval "
+                        "removed from election state" % len(expired))
+
+    def rebuild_elections(self, sche):
+        """ Keep only elections of hosts still in the new scheduler
+        configuration and compute slot loads again
+        """
+        self.elections = dict([(key, election)
+                               for key, election in self.elections.items()
+                               if sche.hosts.find_by_name(key[0]) is not None])
+        self.slot_load = {}
+        self.host_intervals = {}
+        for host, interval in self.elections:
+            self.host_intervals.setdefault(host, set()).add(interval)
+        for election in self.elections.values():
+            loads = self.slot_load.setdefault(election.freq,
+                                              [0] * election.freq)
+            loads[election.slot] += election.weight
+        # Checks of the new configuration must be all seen
+        self.next_check_id = None
+        self.seen_checks = {}
+        self.sched_conf = sche.conf
+        logger.info("[SnmpBooster] [code 1404] Election state rebuilt: "
+                    "%d host/interval kept" % len(self.elections))
+
+    def get_memory_usage(self):
+        """ Return an approximation of the election state size in bytes """
+        size = sys.getsizeof(self.elections) + sys.getsizeof(self.slot_load)
+        for key, election in self.elections.iteritems():
+            size += sys.getsizeof(key) + sys.getsizeof(election)
+        for loads in self.slot_load.itervalues():
+            size += sys.getsizeof(loads)
+        return size
+
+    def dump_slot_stats(self):
+        """ Log the distribution of real checks over the seconds
+        of each interval
+        """
+        for freq, loads in sorted(self.slot_load.items()):
+            nb_keys = len([1 for election in self.elections.values()
+                           if election.freq == freq])
+            busiest = sorted(xrange(freq), key=loads.__getitem__,
+                             reverse=True)[:5]
+            logger.info("[SnmpBooster] [code 1401] Interval %ds: %d "
+                        "host/interval, load %d, min %d, max %d, "
+                        "mean %0.2f, busiest seconds %s" % (
+                            freq, nb_keys, sum(loads), min(loads),
+                            max(loads), sum(loads) / float(freq),
+                            ", ".join(["%d (%d)" % (slot, loads[slot])
+                                       for slot in busiest])))
+        logger.info("[SnmpBooster] [code 1402] Election state: %d "
+                    "host/interval, %d intervals, about %d "
+                    "bytes" % (len(self.elections), len(self.slot_load),
+                               self.get_memory_usage()))
+
+    @staticmethod
+    def set_true_check(check, real=False, intervals=()):
+        """ Add -r option to the command line
+        The real check also gets services of intervals (-I option)
+        """
         if real:
+            if intervals:
+                check.command = (check.command + " -I " +
+                                 ",".join([str(interval)
+                                           for interval in intervals]))
             check.command = check.command + " -r"
         else:
             if check.command.endswith(" -r"):
                 check.command = check.command[:-3]
 
+    def get_new_checks(self, sche):
+        """ Return checks created since the last call """
+        last_id = Action.id
+        first_id = self.next_check_id
+        self.next_check_id = last_id
+        if first_id is None or first_id > last_id or \
+           last_id - first_id > len(sche.checks):
+            # First call (or the counter is not the one we know)
+            # We look at all checks
+            return sche.checks.values()
+        return [sche.checks[c_id] for c_id in xrange(first_id, last_id)
+                if c_id in sche.checks]
+
+    def get_moved_checks(self):
+        """ Return checks already seen which got a new t_to_go (forced
+        check, new schedule) and forget checks which are launched
+        """
+        moved = []
+        for c_id, (chk, t_to_go) in self.seen_checks.items():
+            if chk.status != 'scheduled':
+                del self.seen_checks[c_id]
+            elif chk.t_to_go != t_to_go:
+                moved.append(chk)
+        return moved
+
     def hook_get_new_actions(self, sche):
         """ Set if is a SNMP or Cache check """
-        # Get all snmp checks and sort checks by tuple (host, interval)
+        now = time.time()
+        # Configuration reloaded
+        if sche.conf is not self.sched_conf:
+            self.rebuild_elections(sche)
+        # Get new snmp checks and sort checks by tuple (host, interval)
+        # Checks already seen keep their election, so we only look at
+        # them again if they were moved
+        checks = dict([(c.id, c) for c in self.get_new_checks(sche)])
+        checks.update([(c.id, c) for c in self.get_moved_checks()])
         check_by_host_inter = [((c.ref.host.get_name(),
                                  self.get_frequence(c)
                                  ),
                                 c)
-                               for c in sche.checks.values()
+                               for c in checks.itervalues()
                                if c.module_type == 'snmp_booster'
                                and c.status == 'scheduled']
         # Sort checks by t_to_go
@@ -74,29 +343,66 @@ class SnmpBoosterScheduler(SnmpBooster):
             # get frequency
             _, serv_interval = key
             freq = serv_interval * chk.ref.interval_length
-            # Check if the key if already defined on last_check_mapping
+            election = self.elections.get(key)
+            # Check if the key if already defined on elections
             # and if the next check is scheduled after the saved
             # timestamps for the key (host, frequency)
-            if key in self.last_check_mapping and self.last_check_mapping[key][0] + freq > chk.t_to_go:
-                if self.last_check_mapping[key][1] == chk.ref.id:
+            if election is not None and election.t_to_go + freq > chk.t_to_go:
+                if now > election.last_seen + election.freq:
+                    self.elections[key] = election._replace(last_seen=now)
+                if election.check_id == chk.ref.id:
                     # We don't want to unelected an elected check
                     continue
                 # None elected
                 # Set none Elected
                 self.set_true_check(chk, False)
+                ELECTED_CHECKS.labels("cache").inc()
                 continue
             # Elected
             # Saved the new timestamp
-            if key not in self.last_check_mapping:
+            if election is None:
                 # Done to smooth check over the interval of freq.
-                # We remember the offset for a specific interval and move the elected (real) check to this time
-                if serv_interval not in self.offset_mapping:
-                    self.offset_mapping[serv_interval] = 0
-                self.last_check_mapping[key] = (chk.t_to_go - chk.t_to_go % freq + self.offset_mapping[serv_interval], chk.ref.id)
-                self.offset_mapping[serv_interval] = (self.offset_mapping[serv_interval] + 1) % freq
+                # We put the (host, interval) on the least loaded second
+                # of the interval and move the elected (real) check to this time
+                weight = 1
+                if self.weighted_spreading:
+                    weight = self.get_weight(chk, serv_interval)
+                base, step = 0, 1
+                if self.harmonic_alignment:
+                    base, step = self.get_aligned_slots(key[0], int(freq))
+                slot = self.get_slot(int(freq), weight, base, step)
+                self.add_election(key, Election(chk.t_to_go - chk.t_to_go % freq + slot,
+                                                chk.ref.id, int(freq), slot,
+                                                weight, now))
             else:
-                self.last_check_mapping[key] = (self.last_check_mapping[key][0] + freq,
-                                                chk.ref.id)
-                chk.t_to_go = self.last_check_mapping[key][0]
+                self.elections[key] = election._replace(t_to_go=election.t_to_go + freq,
+                                                        check_id=chk.ref.id,
+                                                        last_seen=now)
+                chk.t_to_go = self.elections[key].t_to_go
+            intervals = ()
+            if self.harmonic_alignment:
+                covered, intervals = self.get_covered_intervals(key,
+                                                                self.elections[key].t_to_go)
+                if covered:
+                    # The real check of a smaller interval gets our
+                    # services at the same time
+                    self.set_true_check(chk, False)
+                    ELECTED_CHECKS.labels("covered").inc()
+                    continue
             # Set Elected
-            self.set_true_check(chk, True)
+            self.set_true_check(chk, True, intervals)
+            ELECTED_CHECKS.labels("real").inc()
+        # Remember the t_to_go given to the checks
+        for _, chk in check_by_host_inter:
+            self.seen_checks[chk.id] = (chk, chk.t_to_go)
+
+        # Forget old (host, interval), once a minute
+        if self.election_expiry > 0 and now > self.last_prune + 60:
+            self.last_prune = now
+            self.prune_elections(now)
+
+        # Show slot distribution
+        if self.slot_stats_interval > 0 and \
+           now > self.last_slot_stats + self.slot_stats_interval:
+            self.last_slot_stats = now
+            self.dump_slot_stats()
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+""" SNMP Booster database backends benchmark
+
+Fills a database with fake services, then measures the queries done
+by the Arbiter (update_service_init) and the Poller (get_service,
+get_services, update_services).
+The database is cleared before and after the benchmark: don't use it on
+a production database.
+
+Example:
+    bench_backends.py --redis localhost:6379 --mongodb localhost:27017
+"""
+
+import argparse
+import importlib
+import sys
+import time
+
+
+# Backend => module of libs which contains the DBClient
+DB_BACKENDS = {"redis": "redisclient",
+               "mongodb": "dbclient",
+               }
+
+
+def make_service(host, service, nb_ds):
+    """ Build a service like the ones written by the Arbiter """
+    ds_list = {}
+    for index in xrange(nb_ds):
+        ds_list["ds%d" % index] = {"ds_oid": ".1.3.6.1.2.1.2.2.1.%d.%%(instance)s" % index,
+                                   "ds_type": "DERIVE",
+                                   "ds_calc": None,
+                                   "ds_max_oid": None,
+                                   "ds_min_oid": None,
+                                   }
+    return {"host": host,
+            "service": service,
+            "address": "127.0.0.1",
+            "community": "public",
+            "version": "2c",
+            "port": 161,
+            "timeout": 5,
+            "retry": 1,
+            "check_interval": 60,
+            "instance": "1",
+            "ds": ds_list,
+            "triggers": {"trigger0": {"critical": ["ds0", 100, "gt"],
+                                      "warning": None,
+                                      "default_status": 3,
+                                      }},
+            }
+
+
+def make_results(host, service, nb_ds):
+    """ Build the data saved by the Poller for a service """
+    now = time.time()
+    return [(host, service, {"ds": {"ds%d" % index: {"ds_oid_value": float(index),
+                                                     "ds_oid_value_last": None,
+                                                     "ds_oid_value_computed": float(index),
+                                                     "ds_oid_value_computed_last": None,
+                                                     "error": None,
+                                                     }},
+                             "check_time": now,
+                             "check_time_last": None,
+                             })
+            for index in xrange(nb_ds)]
+
+
+def timeit(name, func, nb_ops):
+    """ Run func and print the operation rate """
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print "  %-22s %8d ops %8.3fs %10.0f ops/s" % (name,
+                                                   nb_ops,
+                                                   elapsed,
+                                                   nb_ops / elapsed if elapsed else 0)
+
+
+def bench(name, db_client, args):
+    """ Benchmark a backend """
+    hosts = ["host%d" % index for index in xrange(args.hosts)]
+    services = ["service%d" % index for index in xrange(args.services)]
+    keys = [(host, service) for host in hosts for service in services]
+    print "%s (%d services, %d datasources by service)" % (name,
+                                                           len(keys),
+                                                           args.datasources)
+    db_client.clear_cache()
+
+    def init():
+        for host, service in keys:
+            db_client.update_service_init(host, service,
+                                          make_service(host, service,
+                                                       args.datasources))
+
+    def get_service():
+        for host, service in keys:
+            db_client.get_service(host, service)
+
+    def get_services():
+        for host in hosts:
+            db_client.get_services(host, 60)
+
+    def update_service():
+        for host, service in keys:
+            for result in make_results(host, service, args.datasources):
+                db_client.update_service(*result)
+
+    def update_services():
+        # One batch by host, like the results of a SNMP request
+        for host in hosts:
+            results = []
+            for service in services:
+                results.extend(make_results(host, service, args.datasources))
+            db_client.update_services(results)
+
+    timeit("update_service_init", init, len(keys))
+    for _ in xrange(args.loops):
+        timeit("get_service", get_service, len(keys))
+        timeit("get_services", get_services, len(hosts))
+        timeit("update_service", update_service, len(keys) * args.datasources)
+        timeit("update_services", update_services, len(keys) * args.datasources)
+    db_client.clear_cache()
+
+
+def main():
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description='SNMP Booster backends benchmark')
+    parser.add_argument('--redis', type=str,
+                        help='Redis server address:port')
+    parser.add_argument('--mongodb', type=str,
+                        help='MongoDB server address:port')
+    parser.add_argument('-d', '--db-name', type=str, default='booster_snmp_bench',
+                        help='Database name. Default=booster_snmp_bench')
+    parser.add_argument('-H', '--hosts', type=int, default=100,
+                        help='Number of hosts. Default=100')
+    parser.add_argument('-S', '--services', type=int, default=10,
+                        help='Number of services by host. Default=10')
+    parser.add_argument('-D', '--datasources', type=int, default=10,
+                        help='Number of datasources by service. Default=10')
+    parser.add_argument('-l', '--loops', type=int, default=3,
+                        help='Number of query loops. Default=3')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    backends = [(name, getattr(args, name)) for name in ("redis", "mongodb")
+                if getattr(args, name) is not None]
+    if not backends:
+        parser.error("Set at least one backend: --redis or --mongodb")
+
+    for name, address in backends:
+        try:
+            dbmodule = importlib.import_module("shinken.modules.snmp_booster.libs.%s" % DB_BACKENDS[name])
+        except ImportError as exp:
+            print("Import error. %s" % str(exp))
+            sys.exit(1)
+        host, port = address.rsplit(":", 1)
+        db_client = dbmodule.DBClient(host, int(port), args.db_name)
+        if not db_client.connect():
+            sys.exit(2)
+        bench(name, db_client, args)
+
+
+if __name__ == "__main__":
+    main()
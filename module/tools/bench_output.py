@@ -0,0 +1,79 @@
+#!/usr/bin/python
+""" SNMP Booster output benchmark
+
+Measures the rendering of the output and the perfdata of services with
+5, 50 and 500 datasources (get_output is called for each check).
+
+Example:
+    bench_output.py --loops 2000 --datasources 5 50 500
+"""
+
+import argparse
+import sys
+import time
+
+
+def make_service(nb_ds, error_every=10):
+    """ Build a service like the ones read by the Poller """
+    ds_dict = {}
+    for index in xrange(nb_ds):
+        ds_data = {"ds_name": "ds%d" % index,
+                   "ds_unit": "B/s",
+                   "ds_oid_value_computed": index * 1.5,
+                   "ds_min_oid_value_computed": 0.0,
+                   "ds_max_oid_value_computed": 1000000.0,
+                   "error": None,
+                   }
+        if error_every and index % error_every == error_every - 1:
+            ds_data["error"] = "Oid not found on the device: .1.3.6.1.2.1.%d" % index
+        ds_dict["ds%d" % index] = ds_data
+    return {"host": "host",
+            "service": "service",
+            "dstemplate": "bench%d" % nb_ds,
+            # Template key set by the Redis backend
+            "ds_template": "snmpbooster:template:ds:bench%d" % nb_ds,
+            "ds": ds_dict,
+            }
+
+
+def main():
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description='SNMP Booster output benchmark')
+    parser.add_argument('-D', '--datasources', type=int, nargs='+',
+                        default=[5, 50, 500],
+                        help='Numbers of datasources by service. Default=5 50 500')
+    parser.add_argument('-l', '--loops', type=int, default=1000,
+                        help='Number of outputs by service. Default=1000')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        from shinken.modules.snmp_booster.libs import output
+    except ImportError as exp:
+        print("Import error. %s" % str(exp))
+        sys.exit(1)
+
+    print "%12s %12s %14s %14s" % ("datasources", "outputs", "first (us)",
+                                   "output (us)")
+    for nb_ds in args.datasources:
+        service = make_service(nb_ds)
+        # The first output compiles the renderer
+        output.RENDERERS.clear()
+        start = time.time()
+        output.get_output(service)
+        first = time.time() - start
+
+        start = time.time()
+        for _ in xrange(args.loops):
+            output.get_output(service)
+        elapsed = time.time() - start
+        print "%12d %12d %14.1f %14.1f" % (nb_ds,
+                                           args.loops,
+                                           first * 1000000,
+                                           elapsed * 1000000 / args.loops)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+""" SNMP Booster OID results benchmark
+
+Measures the records created for each OID of the real checks: the time
+of prepare_oids and compute_value, the memory of the records, and the
+objects tracked by the garbage collector (which trigger collections).
+
+Example:
+    bench_results.py --services 1000 --datasources 10
+"""
+
+import argparse
+import gc
+import sys
+import time
+
+
+def make_service(host, service, nb_ds):
+    """ Build a service like the ones read by the Poller """
+    ds_dict = {}
+    for index in xrange(nb_ds):
+        ds_dict["ds%d" % index] = {"ds_oid": ".1.3.6.1.2.1.2.2.1.%d.%%(instance)s" % (10 + index),
+                                   "ds_type": "GAUGE",
+                                   "ds_calc": ["%(ds_max)s", "div", "100", "mul"],
+                                   "ds_max_oid": ".1.3.6.1.2.1.2.2.1.5.%(instance)s",
+                                   "ds_min_oid": None,
+                                   "ds_oid_value": float(index),
+                                   "ds_oid_value_computed": float(index),
+                                   }
+    return {"host": host,
+            "service": service,
+            "instance": "1",
+            "mapping": None,
+            "check_time": time.time(),
+            "ds": ds_dict,
+            }
+
+
+def deep_size(obj, seen=None):
+    """ Memory used by an object and its containers (bytes) """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            size += deep_size(value, seen)
+    elif hasattr(obj, "__slots__"):
+        for name in obj.__slots__:
+            size += deep_size(getattr(obj, name, None), seen)
+    elif hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def main():
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description='SNMP Booster OID results benchmark')
+    parser.add_argument('-s', '--services', type=int, default=1000,
+                        help='Number of services. Default=1000')
+    parser.add_argument('-D', '--datasources', type=int, default=10,
+                        help='Number of datasources by service. Default=10')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        from shinken.modules.snmp_booster.libs import checks
+        from shinken.modules.snmp_booster.libs.utils import compute_value
+    except ImportError as exp:
+        print("Import error. %s" % str(exp))
+        sys.exit(1)
+
+    services = [make_service("host%d" % (index // 10), "service%d" % index,
+                             args.datasources)
+                for index in xrange(args.services)]
+
+    # Records of all services, created like the Poller does
+    gc.collect()
+    gc.disable()
+    objects = len(gc.get_objects())
+    start = time.time()
+    oids_lists = [reduce(checks.prepare_oids, [service], [{}])
+                  for service in services]
+    prepare_time = time.time() - start
+    objects = len(gc.get_objects()) - objects
+    gc.enable()
+    results = [result for oids_list in oids_lists
+               for oids in oids_list for result in oids.values()]
+    nb_oids = len(results)
+    size = deep_size(oids_lists)
+
+    # Values received and computed
+    for result in results:
+        result.value = 100.0
+        result.check_time = time.time()
+        result.ds_max = 1000.0
+    start = time.time()
+    for result in results:
+        compute_value(result)
+    compute_time = time.time() - start
+
+    print "%10s %10s %16s %16s %14s %14s" % ("services", "oids", "prepare (us/oid)",
+                                             "compute (us/oid)", "bytes/oid",
+                                             "gc objects/oid")
+    print "%10d %10d %16.2f %16.2f %14.1f %14.2f" % (args.services, nb_oids,
+                                                     prepare_time * 1000000 / nb_oids,
+                                                     compute_time * 1000000 / nb_oids,
+                                                     float(size) / nb_oids,
+                                                     float(objects) / nb_oids)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+""" SNMP Booster startup benchmark
+
+Measures, for each daemon (loaded_by), the time to import the module and
+the class of the daemon, the resident memory after the import, and the
+optional dependencies loaded.
+Each measure is done in a new Python process, so nothing is already
+imported; the median of the runs is printed.
+
+Example:
+    bench_startup.py --runs 10 --roles arbiter scheduler poller
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+
+# Code run in a new process for each measure
+MEASURE = """
+import json, resource, sys, time
+start = time.time()
+from shinken.modules.snmp_booster import module
+if %(role)r:
+    module.get_role_class(%(role)r)
+elapsed = time.time() - start
+# ru_maxrss is in kB on Linux
+print json.dumps({"time": elapsed,
+                  "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  "modules": len(sys.modules),
+                  "deps": sorted([name for name in %(deps)r
+                                  if name in sys.modules])})
+"""
+
+# Optional dependencies to look for in sys.modules
+DEPENDENCIES = ("pysnmp", "pyasn1", "configobj", "redis", "pymongo",
+                "shinken.macroresolver")
+
+
+def measure(role):
+    """ Import the module (and the class of role) in a new process """
+    output = subprocess.check_output([sys.executable, "-c",
+                                      MEASURE % {"role": role,
+                                                 "deps": DEPENDENCIES}])
+    return json.loads(output)
+
+
+def median(values):
+    """ Median of a list """
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description='SNMP Booster startup benchmark')
+    parser.add_argument('-R', '--roles', nargs='+',
+                        default=['arbiter', 'scheduler', 'poller'],
+                        help='Daemons to measure. Default=arbiter scheduler poller')
+    parser.add_argument('-r', '--runs', type=int, default=5,
+                        help='Number of processes by daemon. Default=5')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        measure(None)
+    except subprocess.CalledProcessError as exp:
+        print("Import error. %s" % str(exp))
+        sys.exit(1)
+
+    print "%12s %12s %12s %10s  %s" % ("daemon", "import (ms)", "rss (kB)",
+                                       "modules", "dependencies")
+    # module.py alone, then each daemon
+    for role in [None] + args.roles:
+        results = [measure(role) for _ in xrange(args.runs)]
+        print "%12s %12.1f %12d %10d  %s" % (role or "module.py",
+                                             median([res["time"] for res in results]) * 1000,
+                                             median([res["rss"] for res in results]),
+                                             median([res["modules"] for res in results]),
+                                             ", ".join(results[0]["deps"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,176 @@
 #!/usr/bin/python
-import redis 
+""" SNMP Booster Redis dump and restore tool
+
+The dump file is a gzip file. Each line is a JSON object:
+* the first line is the header: {"version": 1, ...}
+* next lines are chunks of keys: {"keys": [[key, type, value], ...]}
+
+Keys are read with SCAN and written with pipelines, so Redis is not
+blocked and the memory used only depends on the batch size.
+Index keys are not dumped, run `sbcm reindex` after a restore.
+"""
+
+import argparse
+import gzip
+import json
 import re
-import ast
-
-
-def dump_redis():
-    conn = redis.StrictRedis()
-    out = {}
-    for key in  conn.keys():
-        if re.search(":[0-9]*$", key) is not None:
-            out[key] = conn.smembers(key)
-            #print '"%s":%s' % (key, conn.smembers(key))
-        else:
-            out[key] = conn.get(key)
-            #print '"%s":%s' % (key, conn.get(key))
-
-
-    # Todo : write dump.py with data = out or use JSON
-    print out
-    return out
-
-def load_redis():
-    conn = redis.StrictRedis()
-    # dump.py should be generated by a previous dump_redis run
-    # you have to name the variable data then. data = {...}
-    from dump import data
-    for key in data:
-        if re.search(":[0-9]*$", key) is not None:
-            conn.sadd(key, data[key])
-        else:
-            conn.set(key, data[key])
-            
-
-#dump_redis()
-load_redis()
+import sys
+import time
+
+import redis
+
+
+# Bump it when the dump format changes
+DUMP_VERSION = 1
+# Prefix of SNMP Booster keys which are not host:service or host:interval keys
+META_PREFIX = "snmpbooster:"
+INDEX_PREFIX = META_PREFIX + "index:"
+TEMPLATE_PREFIX = META_PREFIX + "template:"
+
+
+def keep_key(key, host_pattern=None):
+    """ Is the key dumped ?
+
+    >>> keep_key("snmpbooster:index:hosts")
+    False
+    >>> keep_key("myhost:60", "^other")
+    False
+    """
+    # Indexes are rebuilt by `sbcm reindex`
+    if key.startswith(INDEX_PREFIX):
+        return False
+    # Templates are shared by all hosts, we keep all of them
+    if key.startswith(TEMPLATE_PREFIX) or host_pattern is None:
+        return True
+    return re.search(host_pattern, key.split(":", 1)[0]) is not None
+
+
+def read_chunk(conn, keys):
+    """ Read values of keys with two pipelined requests
+
+    Return
+    :chunk: list of [key, type, value]
+    """
+    pipe = conn.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+    types = pipe.execute()
+    for key, key_type in zip(keys, types):
+        if key_type == "string":
+            pipe.get(key)
+        elif key_type == "set":
+            pipe.smembers(key)
+        elif key_type == "zset":
+            pipe.zrange(key, 0, -1, withscores=True)
+    values = iter(pipe.execute())
+    chunk = []
+    for key, key_type in zip(keys, types):
+        if key_type == "string":
+            chunk.append([key, key_type, values.next()])
+        elif key_type in ("set", "zset"):
+            chunk.append([key, key_type, list(values.next())])
+        # Other types are not used by SNMP Booster
+        # Removed keys have the type 'none'
+    return chunk
+
+
+def dump(conn, filename, host_pattern=None, batch_size=500):
+    """ Dump keys in a compressed file """
+    nb_keys = 0
+    keys = []
+    with gzip.open(filename, "wb") as dump_file:
+        dump_file.write(json.dumps({"version": DUMP_VERSION,
+                                    "date": time.time(),
+                                    "host_pattern": host_pattern,
+                                    }) + "\n")
+        for key in conn.scan_iter(count=batch_size):
+            if not keep_key(key, host_pattern):
+                continue
+            keys.append(key)
+            if len(keys) >= batch_size:
+                chunk = read_chunk(conn, keys)
+                dump_file.write(json.dumps({"keys": chunk}) + "\n")
+                nb_keys += len(chunk)
+                keys = []
+        if keys:
+            chunk = read_chunk(conn, keys)
+            dump_file.write(json.dumps({"keys": chunk}) + "\n")
+            nb_keys += len(chunk)
+    return nb_keys
+
+
+def restore(conn, filename, batch_size=500):
+    """ Restore keys from a dump file """
+    nb_keys = 0
+    pipe = conn.pipeline(transaction=False)
+    with gzip.open(filename, "rb") as dump_file:
+        header = json.loads(dump_file.readline())
+        if header.get("version") != DUMP_VERSION:
+            raise Exception("Unsupported dump version: "
+                            "%s" % header.get("version"))
+        for line in dump_file:
+            for key, key_type, value in json.loads(line)["keys"]:
+                # JSON gives unicode strings
+                key = key.encode("utf-8")
+                if key_type == "string":
+                    pipe.set(key, value.encode("utf-8"))
+                elif key_type == "set" and value:
+                    pipe.sadd(key, *[member.encode("utf-8")
+                                     for member in value])
+                elif key_type == "zset" and value:
+                    pipe.zadd(key, dict([(member.encode("utf-8"), score)
+                                         for member, score in value]))
+                nb_keys += 1
+                if len(pipe) >= batch_size:
+                    pipe.execute()
+    pipe.execute()
+    return nb_keys
+
+
+def main():
+
+    # Argument parsing
+    parser = argparse.ArgumentParser(description='SNMP Booster Redis dump and restore')
+    parser.add_argument('-r', '--redis-address', type=str, default='localhost',
+                        help='Redis server address.')
+    parser.add_argument('-p', '--redis-port', type=int, default=6379,
+                        help='Redis server port.')
+    parser.add_argument('-s', '--redis-socket', type=str,
+                        help='Redis server unix socket. Overrides address and port.')
+    parser.add_argument('-B', '--batch-size', type=int, default=500,
+                        help='Number of keys read or written in one request. Default=500')
+    subparsers = parser.add_subparsers(help='sub-command help')
+    # Dump
+    dump_parser = subparsers.add_parser('dump', help='Dump keys in a file')
+    dump_parser.add_argument('-f', '--file', type=str, required=True,
+                             help='Dump file (gzip)')
+    dump_parser.add_argument('-H', '--host-name', type=str,
+                             help='Only dump hosts which match this pattern')
+    dump_parser.set_defaults(command='dump')
+    # Restore
+    restore_parser = subparsers.add_parser('restore', help='Restore keys from a file')
+    restore_parser.add_argument('-f', '--file', type=str, required=True,
+                                help='Dump file (gzip)')
+    restore_parser.set_defaults(command='restore')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    conn = redis.StrictRedis(host=args.redis_address, port=args.redis_port,
+                             unix_socket_path=args.redis_socket)
+
+    try:
+        if args.command == 'dump':
+            nb_keys = dump(conn, args.file, args.host_name, args.batch_size)
+            print "%d key(s) dumped in %s" % (nb_keys, args.file)
+        elif args.command == 'restore':
+            nb_keys = restore(conn, args.file, args.batch_size)
+            print "%d key(s) restored from %s" % (nb_keys, args.file)
+            print "Run `sbcm reindex` to rebuild indexes"
+    except Exception as exp:
+        print(exp)
+        sys.exit(2)
+
 
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,6 @@ import argparse
 import sys
 import pprint
 import importlib
-import time
 
 printer = pprint.PrettyPrinter()
 
@@ -76,20 +75,22 @@ def clear_old(db_client, max_age=None, pending=False):
     else:
         max_age *= 3600  # convert in seconds
 
-    now = time.time()
-    to_del = []
-    for svc in db_client.get_all_services():
-        last_up = svc.get("check_time", None)
-        if last_up is not None and now - last_up > max_age or last_up is None and pending:
-            to_del.append((svc["host"], svc["service"]))
-    if len(to_del) == 0:
-        nb_del = 0
-    else:
-        nb_del = db_client.delete_services(to_del)
+    nb_del = db_client.delete_old_services(max_age, pending)
 
     print "%d old key(s) deleted in database" % nb_del
 
 
+def clear_templates(db_client):
+    """ Delete templates not used by any service """
+    if not hasattr(db_client, "delete_unused_templates"):
+        print "This backend doesn't use templates"
+        return
+
+    nb_del = db_client.delete_unused_templates()
+
+    print "%d unused template(s) deleted in database" % nb_del
+
+
 def delete(db_client, host=None, service=None):
     """ Delete service """
     if service is not None:
@@ -100,6 +101,18 @@ def delete(db_client, host=None, service=None):
     print "%d key(s) deleted in database" % nb_del
 
 
+def datasource(ds_module, datasource_path, action):
+    """ Build or verify the compiled datasource """
+    if action == "build":
+        ds_module.compile_datasource(datasource_path)
+        print "Compiled datasource written in '%s'" % ds_module.get_cache_path(datasource_path)
+    else:
+        valid, message = ds_module.verify_datasource_cache(datasource_path)
+        print message
+        if not valid:
+            sys.exit(1)
+
+
 def main():
 
     # Argument parsing
@@ -107,11 +120,15 @@ def main():
     parser.add_argument('-d', '--db-name', type=str, default='booster_snmp',
                         help='Database name. Default=booster_snmp')
     parser.add_argument('-b', '--backend', type=str, default='redis',
-                        help='Backend. Supported : redis. Unsupported: mongodb, memcache')
+                        help='Backend. Supported : redis, sharded (comma separated REDIS_ADDRESS list), mongodb, sqlite. Unsupported: memcache')
     parser.add_argument('-r', '--redis-address', type=str, default='localhost',
                         help='Redis server address.')
-    parser.add_argument('-p', '--redis-port', type=int, default=6379,
-                        help='Redis server port.')
+    parser.add_argument('-p', '--db-port', '--redis-port', dest='db_port', type=int,
+                        help='Database server port. Default=6379 (redis, sharded), 27017 (mongodb)')
+    parser.add_argument('-s', '--redis-socket', type=str,
+                        help='Redis server unix socket. Overrides address and port.')
+    parser.add_argument('-f', '--db-path', type=str,
+                        help='SQLite database file (sqlite backend).')
     # Search
     subparsers = parser.add_subparsers(help='sub-command help')
     search_parser = subparsers.add_parser('search', help='search help')
@@ -162,18 +179,66 @@ def main():
                                  help='No data since ... hours. Default to 2160 (90 days)')
     clearold_parser.add_argument('-P', '--pending', default=False, action='store_true',
                                  help='Clear also pending check (check_time None in database)')
+    # Clear unused templates
+    cleartemplates_parser = clear_subparsers.add_parser('templates', help='Delete templates not used by any service')
+    cleartemplates_parser.set_defaults(command='clear-templates')
+
+    # Rebuild indexes
+    reindex_parser = subparsers.add_parser('reindex', help='Rebuild database indexes')
+    reindex_parser.set_defaults(command='reindex')
+    # Compiled datasource
+    datasource_parser = subparsers.add_parser('datasource', help='datasource help')
+    datasource_subparsers = datasource_parser.add_subparsers(help='datasource sub-command help')
+    # Build compiled datasource
+    dsbuild_parser = datasource_subparsers.add_parser('build', help='Compile the datasource files')
+    dsbuild_parser.set_defaults(command='datasource-build')
+    dsbuild_parser.add_argument('-D', '--datasource', type=str, required=True,
+                                help='Datasource file or folder')
+    # Verify compiled datasource
+    dsverify_parser = datasource_subparsers.add_parser('verify', help='Check the compiled datasource')
+    dsverify_parser.set_defaults(command='datasource-verify')
+    dsverify_parser.add_argument('-D', '--datasource', type=str, required=True,
+                                 help='Datasource file or folder')
 
     # Parse arguments
     args = parser.parse_args()
-    # Import snmpbooster db backend
+
+    # Datasource commands don't need the database
+    if args.command.startswith("datasource"):
+        try:
+            ds_module = importlib.import_module("shinken.modules.snmp_booster.libs.datasource")
+        except ImportError as exp:
+            print("[SBCM] [code 0002] Import error. %s" % str(exp))
+            sys.exit(1)
+        try:
+            datasource(ds_module, args.datasource, args.command.split("-", 1)[1])
+        except Exception as exp:
+            print(exp)
+            sys.exit(2)
+        sys.exit(0)
+
+    # Import snmpbooster db backend (same backends as the module)
     try:
-        dbmodule = importlib.import_module("shinken.modules.snmp_booster.libs.%sclient" % args.backend)
+        booster = importlib.import_module("shinken.modules.snmp_booster.snmpbooster")
+        if args.backend not in booster.DB_BACKENDS:
+            print("[SBCM] [code 0003] Unknown backend: %s. Supported: %s" % (args.backend,
+                                                                            ", ".join(booster.DB_BACKENDS)))
+            sys.exit(1)
+        DBClient = booster.get_db_client_class(args.backend)
     except ImportError as exp:
         print("[SBCM] [code 0001] Import error. %s seems missing." % args.backend)
         sys.exit(1)
 
     # Check database connection
-    db_client = dbmodule.DBClient(args.redis_address, args.redis_port)
+    if args.backend == "sqlite":
+        db_client = DBClient(db_path=args.db_path)
+    else:
+        db_kwargs = {}
+        if args.db_port is not None:
+            db_kwargs['db_port'] = args.db_port
+        # Without port, each backend uses its default one
+        db_client = DBClient(args.redis_address, db_name=args.db_name,
+                             unix_socket=args.redis_socket, **db_kwargs)
     db_client.connect()
 
     try:
@@ -190,6 +255,12 @@ def main():
         # Remove all keys not in host:interval set (members)
         elif args.command == "clear-old":
             clear_old(db_client, args.hour, args.pending)
+        # Remove templates without service
+        elif args.command == "clear-templates":
+            clear_templates(db_client)
+        # Build indexes of a database filled by an old version
+        elif args.command == "reindex":
+            print "%d service(s) indexed" % db_client.rebuild_indexes()
         # Delete host/service
         elif args.command.startswith("delete"):
             # Remove host:* key
@@ -14,7 +14,7 @@ setup(
     author_email='thibault.cohen@savoirfairelinux.com',
     url='https://github.com/savoirfairelinux/mod-booster-snmp',
     license='AGPLv3',
-    install_requires=["redis",
+    install_requires=["redis>=3.0",
                       "pysnmp",
                       "pyasn1",
                       "configobj",
@@ -24,9 +24,11 @@ setup(
     include_package_data=True,
 #    namespace_packages=['shinken.modules.snmp_booster'],
     test_suite='nose.collector',
+    tests_require=["fakeredis"],
     entry_points={
     'console_scripts': [
         'sbcm = module.tools.sbcm:main',
+        'sbdump = module.tools.dump_redis:main',
         ],
     }
 )
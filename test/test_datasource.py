@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the datasource loading """
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from libs.datasource import load_datasource
+
+
+class TestLoadDatasource(unittest.TestCase):
+    """ Datasource errors are reported with the datasource codes """
+
+    def check_error(self, datasource_path):
+        try:
+            load_datasource(datasource_path)
+        except Exception as exp:
+            self.assertTrue("[code 0905]" in str(exp), str(exp))
+        else:
+            self.fail("No error for %r" % datasource_path)
+
+    def test_no_path(self):
+        self.check_error(None)
+
+    def test_empty_path(self):
+        self.check_error("")
+
+
+if __name__ == '__main__':
+    unittest.main()
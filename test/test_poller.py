@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the SnmpBoosterPoller """
+
+
+import os
+import sys
+import time
+import pickle
+import unittest
+from Queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from snmpbooster_poller import SnmpBoosterPoller
+
+
+COMMAND = ("check_snmp_booster -H host1 -S service1 -A 127.0.0.1 "
+           "-C public -t tpl -V 2")
+
+
+class ModConf(object):
+    """ Module configuration """
+    properties = {'daemons': ['poller', 'scheduler', 'arbiter'],
+                  'type': 'snmp_booster',
+                  }
+
+    def __init__(self, **params):
+        self.loaded_by = "poller"
+        self.__dict__.update(params)
+
+    def get_name(self):
+        return "snmp_booster"
+
+
+def make_poller(**params):
+    """ Poller without database """
+    return SnmpBoosterPoller(ModConf(**params))
+
+
+class FakeDB(object):
+    """ Database client with services in a dict """
+
+    def __init__(self):
+        self.services = {}
+
+    def add_service(self, host, service, value=1.0):
+        self.services[(host, service)] = {
+            'host': host, 'service': service, 'check_interval': 60,
+            'address': '127.0.0.1', 'port': 161, 'community': 'public',
+            'version': '2c', 'timeout': 1, 'retry': 0, 'instance': None,
+            'mapping': None, 'triggers': {},
+            'ds': {'ds1': {'ds_name': 'ds1', 'ds_unit': '',
+                           'ds_oid': '.1.3.6.1.2.1.1.3.%d' % len(self.services),
+                           'ds_type': 'GAUGE', 'ds_calc': None,
+                           'ds_min_oid_value_computed': None,
+                           'ds_max_oid_value_computed': None,
+                           'ds_oid_value_computed': value, 'error': None}},
+            }
+
+    def get_service(self, host, service):
+        data = self.services[(host, service)]
+        return dict(data, ds=dict((name, dict(ds_data))
+                                  for name, ds_data in data['ds'].items()))
+
+    def get_services(self, host, check_interval):
+        return [self.get_service(*key) for key in self.services
+                if key[0] == host]
+
+    def update_services(self, services):
+        for host, service, data in services:
+            for ds_name, ds_data in data['ds'].items():
+                self.services[(host, service)]['ds'][ds_name].update(ds_data)
+        return (None, False)
+
+
+class Check(object):
+    """ Check given by the Poller """
+
+    def __init__(self, command):
+        self.command = command
+        self.status = 'queue'
+        self.check_time = 0
+        self.output = None
+
+    def get_outputs(self, output, max_len):
+        self.output = output
+
+
+def make_poller_with_db(**params):
+    """ Poller with a FakeDB and a service host1/service1 """
+    poller = make_poller(**params)
+    poller.db_client = FakeDB()
+    poller.db_client.add_service("host1", "service1")
+    poller.returns_queue = Queue()
+    return poller
+
+
+class TestParseCommand(unittest.TestCase):
+    """ Check commands parsed with and without the cache """
+
+    def check_real_check(self, cache_size):
+        poller = make_poller(command_cache_size=cache_size)
+        for _ in range(2):
+            args = poller.parse_command(COMMAND + " -r")
+            self.assertTrue(args['real_check'])
+            self.assertEqual(args['with_intervals'], [])
+            args = poller.parse_command(COMMAND + " -I 300,3600 -r")
+            self.assertTrue(args['real_check'])
+            self.assertEqual(args['with_intervals'], [300, 3600])
+            args = poller.parse_command(COMMAND)
+            self.assertFalse(args['real_check'])
+            self.assertEqual(args['service'], "service1")
+        return poller
+
+    def test_real_check_without_cache(self):
+        poller = self.check_real_check(0)
+        self.assertEqual(len(poller.parsed_commands), 0)
+
+    def test_real_check_with_cache(self):
+        poller = self.check_real_check(10)
+        # -r and -I are not in the cache key
+        self.assertEqual(len(poller.parsed_commands), 1)
+
+    def test_cache_is_bounded(self):
+        poller = make_poller(command_cache_size=2)
+        for index in range(5):
+            poller.parse_command(COMMAND + " -i %d" % index)
+        self.assertEqual(len(poller.parsed_commands), 2)
+
+    def test_cached_args_are_not_shared(self):
+        poller = make_poller(command_cache_size=10)
+        poller.parse_command(COMMAND + " -I 300 -r")['service'] = "changed"
+        args = poller.parse_command(COMMAND)
+        self.assertEqual(args['service'], "service1")
+        self.assertFalse(args['real_check'])
+        self.assertEqual(args['with_intervals'], [])
+
+
+class TestDeadlines(unittest.TestCase):
+    """ Deadlines of real checks """
+
+    def test_queue_wait_is_not_counted(self):
+        poller = make_poller_with_db(max_queued_tasks=0)
+        chk = Check(COMMAND + " -r")
+        poller.checks = [chk]
+        poller.launch_new_checks()
+        budget = chk.result['deadline_budget']
+        now = time.time() + budget + 1
+        # The get request is still in the task queue
+        self.assertFalse(poller.check_deadline(chk, now))
+        # The request was dispatched just now
+        for task in chk.result['tasks']:
+            task['dispatched_time'] = now - 1
+        self.assertFalse(poller.check_deadline(chk, now))
+        # The request was dispatched more than the budget ago
+        for task in chk.result['tasks']:
+            task['dispatched_time'] = now - budget - 1
+        self.assertTrue(poller.check_deadline(chk, now))
+
+    def test_finished_check_is_detached(self):
+        poller = make_poller_with_db(max_queued_tasks=0)
+        chk = Check(COMMAND + " -r")
+        poller.checks = [chk]
+        poller.launch_new_checks()
+        chk.deferred_since = time.time()
+        chk.result['state'] = 'received'
+        poller.manage_finished_checks()
+        returned = poller.returns_queue.get(block=False)
+        self.assertTrue(returned is chk)
+        for attr in ("result", "deadline", "deferred_since", "inflight_keys"):
+            self.assertFalse(hasattr(returned, attr), attr)
+        pickle.dumps(returned)
+
+    def test_timed_out_check_trace_is_kept(self):
+        from libs.tracing import TRACER
+        poller = make_poller_with_db(max_queued_tasks=0, trace_hosts="host1")
+        self.addCleanup(TRACER.configure)
+        chk = Check(COMMAND + " -r")
+        poller.checks = [chk]
+        poller.launch_new_checks()
+        trace = chk.result['trace']
+        # As the deadline loop does
+        chk.status = 'done'
+        poller.manage_finished_checks()
+        self.assertEqual(TRACER.get_traces("host1"), [trace])
+        self.assertTrue(trace.end is not None)
+
+
+class TestRealCheckOutput(unittest.TestCase):
+    """ Output of real checks """
+
+    def answer(self, poller, value):
+        """ Give value to the get requests, as the SNMP worker does """
+        from pysnmp.proto.rfc1902 import ObjectName, Gauge32
+        while not poller.task_queue.empty():
+            task = poller.task_queue.get()
+            callback, callback_ctx = task['data']['cbInfo']
+            var_binds = [(ObjectName(oid), Gauge32(value))
+                         for oid in task['data']['varNames']]
+            callback(None, None, 0, 0, var_binds, callback_ctx)
+
+    def test_output_uses_collected_value(self):
+        poller = make_poller_with_db(max_queued_tasks=0)
+        chk = Check(COMMAND + " -r")
+        poller.checks = [chk]
+        poller.launch_new_checks()
+        self.answer(poller, 42)
+        poller.manage_finished_checks()
+        self.assertEqual(chk.status, 'done')
+        self.assertTrue("ds1 = OK (42.00)" in chk.output, chk.output)
+        # The value is saved too
+        ds_data = poller.db_client.services[("host1", "service1")]['ds']['ds1']
+        self.assertEqual(ds_data['ds_oid_value_computed'], 42.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the Redis database client """
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from libs.redisclient import DBClient, INDEX_CHECK_TIME
+
+
+def make_service(host, service, check_interval=60):
+    """ Service like the ones written by the Arbiter """
+    return {'host': host, 'service': service,
+            'check_interval': check_interval,
+            'address': '127.0.0.1', 'port': 161, 'community': 'public',
+            'version': '2c', 'timeout': 1, 'retry': 0,
+            'dstemplate': 'tpl', 'instance': None, 'mapping': None,
+            'ds': {'ds1': {'ds_name': 'ds1', 'ds_unit': '',
+                           'ds_oid': '.1.3.6.1.2.1.1.3.0',
+                           'ds_type': 'GAUGE', 'ds_calc': None}},
+            'triggers': {'trigger1': {'critical': None, 'warning': None}},
+            }
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is missing")
+class TestDBClient(unittest.TestCase):
+    """ Writes and reads of services """
+
+    def setUp(self):
+        self.client = DBClient("localhost")
+        self.client.db_conn = fakeredis.FakeStrictRedis()
+        self.client.db_conn.flushall()
+
+    def test_arbiter_write(self):
+        ret = self.client.update_service_init("host1", "service1",
+                                              make_service("host1", "service1"))
+        self.assertEqual(ret, (None, False))
+        service = self.client.get_service("host1", "service1")
+        self.assertEqual(service['ds']['ds1']['ds_oid'], '.1.3.6.1.2.1.1.3.0')
+        self.assertEqual(service['triggers'].keys(), ['trigger1'])
+        self.assertEqual([serv['service'] for serv
+                          in self.client.get_services("host1", 60)],
+                         ["service1"])
+
+    def test_poller_write(self):
+        self.client.update_service_init("host1", "service1",
+                                        make_service("host1", "service1"))
+        ret = self.client.update_services([("host1", "service1",
+                                            {'check_time': 1000.0,
+                                             'ds': {'ds1': {'ds_oid_value': 42}}})])
+        self.assertEqual(ret, (None, False))
+        ret = self.client.update_service("host1", "service1",
+                                         {'check_time': 1060.0})
+        self.assertEqual(ret, (None, False))
+        service = self.client.get_service("host1", "service1")
+        self.assertEqual(service['ds']['ds1']['ds_oid_value'], 42)
+        self.assertEqual(service['check_time'], 1060.0)
+        # The age index follows the writes
+        self.assertEqual(self.client.db_conn.zscore(INDEX_CHECK_TIME,
+                                                    "host1:service1"),
+                         1060.0)
+
+    def test_unused_templates(self):
+        self.client.update_service_init("host1", "service1",
+                                        make_service("host1", "service1"))
+        other = make_service("host2", "service2")
+        other['ds']['ds1']['ds_unit'] = 'B'
+        self.client.update_service_init("host2", "service2", other)
+        self.client.update_service("host2", "service2", {'check_time': 1.0})
+        # Old services don't take their templates with them
+        self.assertEqual(self.client.delete_old_services(60), 1)
+        # 2 datasources templates and 1 triggers template
+        self.assertEqual(len(self.client.db_conn.keys("snmpbooster:template:*")), 3)
+        # Only the ds template of service2 is unused
+        self.assertEqual(self.client.delete_unused_templates(), 1)
+        self.assertTrue(self.client.get_service("host1", "service1") is not None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the SnmpBoosterScheduler """
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from shinken.action import Action
+
+from snmpbooster_scheduler import SnmpBoosterScheduler
+
+
+class ModConf(object):
+    """ Module configuration """
+    properties = {'daemons': ['poller', 'scheduler', 'arbiter'],
+                  'type': 'snmp_booster',
+                  }
+
+    def __init__(self, **params):
+        self.loaded_by = "scheduler"
+        self.__dict__.update(params)
+
+    def get_name(self):
+        return "snmp_booster"
+
+
+class Host(object):
+    """ Host of the Scheduler configuration """
+
+    def __init__(self, name):
+        self.name = name
+        self.services = []
+
+    def get_name(self):
+        return self.name
+
+
+class Service(object):
+    """ Service of the Scheduler configuration """
+    state_type = 'HARD'
+    check_interval = 1
+    retry_interval = 1
+    interval_length = 60
+
+    def __init__(self, service_id, host):
+        self.id = service_id
+        self.host = host
+
+
+class Check(object):
+    """ Check of the Scheduler """
+
+    def __init__(self, ref, t_to_go):
+        self.id = Action.id
+        Action.id += 1
+        self.ref = ref
+        self.t_to_go = t_to_go
+        self.status = 'scheduled'
+        self.module_type = 'snmp_booster'
+        self.command = "check_snmp_booster -H %s" % ref.host.get_name()
+
+
+class Hosts(object):
+    """ Hosts of the Scheduler configuration """
+
+    def __init__(self, hosts):
+        self.hosts = dict([(host.get_name(), host) for host in hosts])
+
+    def find_by_name(self, name):
+        return self.hosts.get(name)
+
+
+class Scheduler(object):
+    """ Scheduler with checks in a dict """
+
+    def __init__(self, hosts):
+        self.conf = object()
+        self.hosts = Hosts(hosts)
+        self.checks = {}
+
+    def add_check(self, check):
+        self.checks[check.id] = check
+
+
+class TestElection(unittest.TestCase):
+    """ Checks seen once are seen again when they are moved """
+
+    def setUp(self):
+        Action.id = 1
+        self.host = Host("host1")
+        self.sched = Scheduler([self.host])
+        self.module = SnmpBoosterScheduler(ModConf(slot_stats_interval=0))
+
+    def test_moved_check_is_elected_again(self):
+        services = [Service(index, self.host) for index in range(2)]
+        first = Check(services[0], 60)
+        self.sched.add_check(first)
+        self.module.hook_get_new_actions(self.sched)
+        self.assertTrue(first.command.endswith(" -r"))
+        second = Check(services[1], 70)
+        self.sched.add_check(second)
+        self.module.hook_get_new_actions(self.sched)
+        # Same interval: the real check of service 0 gets its data
+        self.assertFalse(second.command.endswith(" -r"))
+        # Checks which are not moved are not seen again
+        self.assertEqual(self.module.get_moved_checks(), [])
+        # The Scheduler moves the check of service 1 after the
+        # interval of the real check (forced check, new schedule)
+        first.status = 'inpoller'
+        second.t_to_go = 200
+        self.module.hook_get_new_actions(self.sched)
+        self.assertTrue(second.command.endswith(" -r"))
+        # Launched checks are forgotten
+        self.assertEqual(self.module.seen_checks.keys(), [second.id])
+
+
+if __name__ == '__main__':
+    unittest.main()
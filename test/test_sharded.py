@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the hash ring of the sharded Redis client """
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from libs.shardedclient import DBClient
+
+
+HOSTS = ["host%d" % index for index in range(10000)]
+
+
+class FakeShard(object):
+    """ Redis client which records the hosts it is asked """
+
+    def __init__(self, name):
+        self.name = name
+        self.hosts = []
+
+    def get_service(self, host, service):
+        self.hosts.append(host)
+        return {'host': host, 'service': service, 'shard': self.name}
+
+    def get_services(self, host, check_interval):
+        self.hosts.append(host)
+        return [{'host': host, 'check_interval': check_interval,
+                 'shard': self.name}]
+
+
+def make_client(nb_shards):
+    """ Sharded client with FakeShards """
+    names = ["10.0.0.%d" % index for index in range(1, nb_shards + 1)]
+    client = DBClient(",".join(names))
+    for name in names:
+        client.shards[name] = FakeShard(name)
+    return client
+
+
+class TestRing(unittest.TestCase):
+    """ Distribution of the hosts on the shards """
+
+    def test_hosts_are_spread(self):
+        client = make_client(4)
+        counts = dict((name, 0) for name in client.shards)
+        for host in HOSTS:
+            counts[client.get_shard_name(host)] += 1
+        # Each shard gets about 1/4 of the hosts
+        for name, count in counts.items():
+            self.assertTrue(0.15 < count / float(len(HOSTS)) < 0.35,
+                            (name, count))
+
+    def test_host_queries_use_the_owner(self):
+        client = make_client(4)
+        for host in HOSTS[:200]:
+            owner = client.get_shard_name(host)
+            self.assertEqual(client.get_service(host, "svc")['shard'], owner)
+            self.assertEqual(client.get_services(host, 60)[0]['shard'], owner)
+        # No other shard was asked
+        for name, shard in client.shards.items():
+            self.assertTrue(all([client.get_shard_name(host) == name
+                                 for host in shard.hosts]))
+
+    def test_new_shard_moves_its_hosts_only(self):
+        before = make_client(4)
+        after = make_client(5)
+        moved = [host for host in HOSTS
+                 if before.get_shard_name(host) != after.get_shard_name(host)]
+        # About 1/5 of the hosts move, all to the new shard
+        self.assertTrue(0.1 < len(moved) / float(len(HOSTS)) < 0.3,
+                        len(moved))
+        self.assertEqual(set([after.get_shard_name(host) for host in moved]),
+                         set(["10.0.0.5"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
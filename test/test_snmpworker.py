@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the down devices of the SNMP worker """
+
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from pysnmp.proto.errind import requestTimedOut
+
+from libs import snmpworker
+from libs.snmpworker import DEVICE_HEALTH, timed_callback, callback_probe
+
+
+DEVICE = "192.0.2.1"
+
+
+def callback_get(*args):
+    """ Callback of a task """
+    return False
+
+
+def answer(callback, error_indication):
+    """ Give an answer to a request, as the dispatcher does """
+    snmpworker.SNMP_IN_FLIGHT.inc()
+    timed_callback(None, error_indication, 0, 0, [],
+                   (callback, None, DEVICE, [0], None))
+
+
+class TestDeviceHealth(unittest.TestCase):
+    """ Probes of down devices """
+
+    def setUp(self):
+        DEVICE_HEALTH.configure(max_timeouts=2, probe_interval=10)
+        self.addCleanup(DEVICE_HEALTH.configure)
+        DEVICE_HEALTH.remember(DEVICE, {'authData': None,
+                                        'transportTarget': None})
+        answer(callback_get, requestTimedOut)
+        answer(callback_get, requestTimedOut)
+        self.state = DEVICE_HEALTH.devices[DEVICE]
+
+    def send_probe(self):
+        """ Return True if a probe of the device is sent now """
+        now = self.state.next_probe
+        return [probe[0] for probe in DEVICE_HEALTH.get_probes(now)] == [DEVICE]
+
+    def test_device_is_down(self):
+        self.assertTrue(DEVICE_HEALTH.is_down(DEVICE))
+        self.assertEqual(self.state.backoff, 10)
+
+    def test_late_timeouts_keep_the_interval(self):
+        # Requests sent before the device was down
+        answer(callback_get, requestTimedOut)
+        answer(callback_get, requestTimedOut)
+        self.assertEqual(self.state.backoff, 10)
+
+    def test_probe_timeout(self):
+        self.assertTrue(self.send_probe())
+        answer(callback_probe, requestTimedOut)
+        self.assertEqual(self.state.backoff, 20)
+        self.assertTrue(self.send_probe())
+
+    def test_probe_error(self):
+        self.assertTrue(self.send_probe())
+        answer(callback_probe, "No route to host")
+        # An other probe is scheduled
+        self.assertEqual(self.state.backoff, 20)
+        self.assertTrue(self.send_probe())
+        self.assertTrue(DEVICE_HEALTH.is_down(DEVICE))
+
+    def test_probe_answer(self):
+        self.assertTrue(self.send_probe())
+        answer(callback_probe, None)
+        self.assertFalse(DEVICE_HEALTH.is_down(DEVICE))
+
+
+if __name__ == '__main__':
+    unittest.main()
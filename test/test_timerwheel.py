@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2014:
+#    Thibault Cohen, thibault.cohen@savoirfairelinux.com
+#
+# This file is part of SNMP Booster Shinken Module.
+#
+# Shinken is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Shinken is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with SNMP Booster Shinken Module.
+# If not, see <http://www.gnu.org/licenses/>.
+
+
+""" Tests of the timing wheel of the check deadlines """
+
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "module"))
+
+from libs.timerwheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+    """ Timers expire at their deadline, not before """
+
+    def check_deadlines(self, deadlines, **params):
+        """ Advance the wheel one tick at a time and check each
+        deadline expires at its tick
+        """
+        wheel = TimerWheel(tick=1, now=0, **params)
+        for index, deadline in enumerate(deadlines):
+            wheel.add(deadline, index)
+        for now in xrange(1, max(deadlines) + 1):
+            for index in wheel.advance(now):
+                self.assertEqual(deadlines[index], now,
+                                 "deadline %d expired at %d" % (deadlines[index], now))
+        self.assertEqual(len(wheel), 0)
+
+    def test_out_of_range_one_level(self):
+        # The wheel covers 4 ticks
+        self.check_deadlines([3, 10, 11, 100], wheel_size=4, levels=1)
+
+    def test_out_of_range_levels(self):
+        # The wheel covers 64 ticks
+        self.check_deadlines([70, 200, 1000], wheel_size=4, levels=3)
+
+    def test_random_deadlines(self):
+        rand = random.Random(42)
+        for levels in (1, 2, 4):
+            self.check_deadlines([rand.randint(1, 3000) for _ in xrange(200)],
+                                 wheel_size=8, levels=levels)
+
+    def test_cancelled_timer(self):
+        wheel = TimerWheel(tick=1, now=0, wheel_size=4, levels=1)
+        timer = wheel.add(10, "check1")
+        wheel.cancel(timer)
+        self.assertEqual(wheel.advance(20), [])
+        self.assertEqual(len(wheel), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()